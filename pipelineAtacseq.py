@@ -1,4 +1,3 @@
-import copy
 import pysam
 import collections
 import os
@@ -9,11 +8,23 @@ import cgatcore.pipeline as P
 from cgat import GTF
 import tempfile
 import re
-from cgat import Bed
+import array
+import concurrent.futures
+import hashlib
+import gzip
+import heapq
+import io
+import json
+import multiprocessing
+import shutil
+import struct
+import subprocess
+import sys
+import zlib
 
 import pandas as pd
 #from pandas.core.frame import DataFrame
-#import numpy as np
+import numpy as np
 #import matplotlib as mpl
 #mpl.use('Agg') # So that matplotlib.pyplot doesn't try to find the X-server and give an error
 #import matplotlib.pyplot as plt
@@ -21,109 +32,507 @@ import pandas as pd
 #sys.path.insert(0, "/home/mbp15ja/dev/AuxiliaryPrograms/StringOperations/")
 #import StringOperations
 
+#------------------------------------------------------------------------------
+# Counts the total, mapped and unmapped reads (a read is mapped if any of its
+# segments is mapped) of a Sam/Bam file SORTED BY READNAME and writes the 
+# names of the mapped and unmapped reads to <outfile>.mapped.txt.gz and
+# <outfile>.unmapped.txt.gz.
+# With threads > 1 the Bam file is split in shards processed in parallel
+# (see getBamShards), each shard writing its own read name files, which are
+# concatenated at the end.
+# With name_format="hash" the read names are stored instead as ReadNameSet
+# files (<outfile>.mapped.names.npy and <outfile>.unmapped.names.npy).
+#
+# Inputs:
+#    -infile: Sam/Bam file sorted by readname
+#    -outfile: Outfile with the counters
+#    -threads: Number of processes to use
+#    -name_format: "text" (gzipped read names) or "hash" (ReadNameSet)
+#
+# Outputs:
+#    -writes the counters to the outfile and the read name files
 @cluster_runnable
-def getMappedUnmappedReads(infile, outfile):
-    
-    # Determine the extension of the file (BAM or SAM), done this for SAM/BAM compatibility
-    # At the moment, all calls should only pass SAM, if it stops working just leave 
-    # samfile = pysam.AlignmentFile(infile, "r")
-    _ , file_extension = os.path.splitext(infile)
+def getMappedUnmappedReads(infile, outfile, threads=1, name_format="text"):
     
-    if (file_extension.lower() == '.sam'):
-        samfile = pysam.AlignmentFile(infile, "r")   
-    elif (file_extension.lower() == '.bam'):
-        samfile = pysam.AlignmentFile(infile, "rb")
+    if name_format == "hash":
+        extension = '.names.npy'
+    elif name_format == "text":
+        extension = '.txt.gz'
+    else:
+        raise ValueError("Read name format not recognised: %s" % name_format)
     
     # Create the name of the files for the unmapped and mapped reads
-    out_unmapped_basename = P.snip(os.path.basename(outfile), '.tsv') + '.unmapped.txt.gz'
+    out_unmapped_basename = P.snip(os.path.basename(outfile), '.tsv') + '.unmapped' + extension
     out_unmapped = os.path.join(os.path.dirname(outfile), (out_unmapped_basename))
       
-    out_mapped_basename = P.snip(os.path.basename(outfile), '.tsv') + '.mapped.txt.gz'
+    out_mapped_basename = P.snip(os.path.basename(outfile), '.tsv') + '.mapped' + extension
     out_mapped = os.path.join(os.path.dirname(outfile), (out_mapped_basename))
     
-    # Unmapped readnames
-    unmapped = IOTools.open_file(out_unmapped, "w")
+    shards = getBamShards(infile, threads)
     
-    # Mapped readnames
-    mapped = IOTools.open_file(out_mapped, "w")
+    if len(shards) == 1:
+        shard_outfiles = [(out_mapped, out_unmapped, name_format)]
+    else:
+        shard_outfiles = [(P.snip(out_mapped, extension) + ".shard%i" % i + extension,
+                           P.snip(out_unmapped, extension) + ".shard%i" % i + extension,
+                           name_format)
+                          for i in range(len(shards))]
     
-    dictionary = {'read_name': 'first', 'mapped': 'no'}
+    counters = processBamShards(infile, 
+                                shards, 
+                                countMappedUnmappedReadsInShard,
+                                shard_outfiles,
+                                threads)
     
-    c = collections.Counter()
-       
-    # Go through the reads
-    for read in samfile:
-           
-        # Get the read name
-        read_name = read.query_name
-           
-        # First case, assign the read name to the dictionary
-        if dictionary['read_name'] == 'first':
-            dictionary['read_name'] = read_name
-            # Add one read to the total
-            c["total"] += 1
-                 
-        # If a fragment from the read has been seen before
-        if dictionary['read_name'] == read_name:  
-               
-            # If that fragment was mapped
-            if dictionary['mapped'] == 'yes':
-                # Skip to the next data line
-                continue
-               
-            # If all the prior fragments from the read haven't been mapped
+    if len(shards) > 1:
+        
+        for i, merged_outfile in enumerate((out_mapped, out_unmapped)):
+            
+            shard_files = [files[i] for files in shard_outfiles]
+            
+            # BGZF files can be concatenated
+            if name_format == "text":
+                concatenateBgzfFiles(shard_files, merged_outfile)
+                for f in shard_files:
+                    os.unlink(f)
             else:
-                # If it is mapped, change the state to mapped (the default beginning state is unmapped)
-                if not read.is_unmapped:
-                    # Put the read as mapped
-                    dictionary['mapped'] = 'yes'
+                ReadNameSet.write(merged_outfile, 
+                                  np.concatenate([ReadNameSet(f).hashes 
+                                                  for f in shard_files]))
+                for f in shard_files:
+                    os.unlink(f)
+    
+    c = sumCounters(counters)
     
-        # If a fragment from the same read hasn't been seen before (new read)        
-        else:
-  
-            # If the last read wasn't mapped, store it
-            if dictionary['mapped'] == 'no':
-                unmapped.write(dictionary['read_name']+"\n")   
-                # Add one read to the unmapped
-                c["unmapped"] += 1
-                  
-            else:
-                  
-                mapped.write(dictionary['read_name'] + "\n") 
-                # Add one read to the mapped
-                c["mapped"] += 1
-               
-               
-            # Add one read to the unmapped
-            c["total"] += 1
-               
-            # Create a new dictionary with unmapped and the current read name
-            dictionary = {'read_name': read_name, 'mapped': 'no'}
-               
-            # If it is mapped, change the state to mapped (the default beginning state is unmapped)
-            if not read.is_unmapped: 
-                # Put the read as mapped
-                dictionary['mapped'] = 'yes'
-
-    # The last read is hanging
-    # If it is unmapped, store it
-    if dictionary['mapped'] == 'no':
-        unmapped.write(read_name + "\n")  
-        # Add one read to the unmapped
-        c["unmapped"] += 1    
-    else:          
-        mapped.write(dictionary['read_name'] + "\n")
-
-        # Add one read to the mapped
-        c["mapped"] += 1
-  
-    # Store the counters        
-     
     # Create a name for the counters
     with IOTools.open_file(outfile, "w") as output_file_write:   
         for counter in c:  
             output_file_write.write(counter + ':\t' + str(c[counter]) + '\n')
-             
+
+
+#------------------------------------------------------------------------------
+# Shard function of getMappedUnmappedReads: counts the total, mapped and 
+# unmapped reads of an iterator of reads sorted by readname, writing the 
+# read names to out_mapped and out_unmapped.
+#
+# Inputs:
+#    -reads: iterator of reads sorted by readname
+#    -out_mapped: File for the mapped read names
+#    -out_unmapped: File for the unmapped read names
+#    -name_format: "text" (gzipped read names) or "hash" (ReadNameSet)
+#
+# Outputs:
+#    -returns the Counter
+def countMappedUnmappedReadsInShard(reads, out_mapped, out_unmapped, 
+                                    name_format="text"):
+    
+    c = collections.Counter()
+    
+    if name_format == "hash":
+        
+        # Read name hashes
+        unmapped = array.array("Q")
+        mapped = array.array("Q")
+        
+        def store(names, read_name):
+            names.append(getReadNameHash(read_name))
+    
+    else:
+        
+        # Unmapped readnames
+        unmapped = openCompressedFile(out_unmapped, "w")
+        
+        # Mapped readnames
+        mapped = openCompressedFile(out_mapped, "w")
+        
+        def store(names, read_name):
+            names.write(read_name + "\n")
+    
+    for read_name, group in iterateReadNameGroups(reads):
+        
+        c["total"] += 1
+        
+        # Mapped if any of the fragments is mapped
+        if any(not read.is_unmapped for read in group):
+            store(mapped, read_name)
+            c["mapped"] += 1
+        else:
+            store(unmapped, read_name)
+            c["unmapped"] += 1
+    
+    if name_format == "hash":
+        ReadNameSet.write(out_mapped, np.frombuffer(mapped, dtype=np.uint64))
+        ReadNameSet.write(out_unmapped, 
+                          np.frombuffer(unmapped, dtype=np.uint64))
+    else:
+        mapped.close()
+        unmapped.close()
+    
+    return c
+
+
+#------------------------------------------------------------------------------
+# Gets a 64 bit hash of a read name. Unlike hash() it is the same in every
+# process and run, so hashes from different jobs can be compared.
+#
+# Inputs:
+#    -read_name: The name of the read
+#
+# Outputs:
+#    -returns the hash as an unsigned 64 bit integer
+def getReadNameHash(read_name):
+    
+    return int.from_bytes(
+        hashlib.blake2b(read_name.encode(), digest_size=8).digest(), "little")
+
+
+#------------------------------------------------------------------------------
+# Set of read names stored as a sorted array of unique 64 bit read name 
+# hashes (see getReadNameHash) in a .npy file, which is memory mapped
+# so membership tests don't need to load or decompress the whole set.
+# Different read names can share a hash (with a probability of ~n^2/2^65 
+# for n read names), so a read name not in the set can, rarely, be reported
+# as contained.
+#
+# Inputs:
+#    -infile: .npy file written by ReadNameSet.write
+class ReadNameSet(object):
+    
+    def __init__(self, infile):
+        
+        self.hashes = np.load(infile, mmap_mode="r")
+    
+    # Writes the read name hashes (array in any order, with duplicates) as 
+    # a ReadNameSet file
+    @staticmethod
+    def write(outfile, hashes):
+        
+        with open(outfile, "wb") as writer:
+            np.save(writer, np.unique(np.asarray(hashes, dtype=np.uint64)))
+    
+    # Writes a ReadNameSet file from a raw file of already sorted and unique 
+    # read name hashes, without loading them into memory. The raw file is
+    # removed.
+    @staticmethod
+    def writeFromSortedRawFile(outfile, raw_file):
+        
+        if os.path.getsize(raw_file) == 0:
+            hashes = np.zeros(0, dtype=np.uint64)
+        else:
+            hashes = np.memmap(raw_file, dtype=np.uint64, mode="r")
+        
+        with open(outfile, "wb") as writer:
+            np.save(writer, hashes)
+        
+        del hashes
+        os.unlink(raw_file)
+    
+    def __len__(self):
+        
+        return len(self.hashes)
+    
+    # Whether the read names are in the set: a bool for a single read name,
+    # a boolean array for a list of read names
+    def contains(self, read_names):
+        
+        if isinstance(read_names, str):
+            return bool(self.containsHashes(
+                np.array([getReadNameHash(read_names)], dtype=np.uint64))[0])
+        
+        return self.containsHashes(
+            np.array([getReadNameHash(read_name) for read_name in read_names],
+                     dtype=np.uint64))
+    
+    # Whether the read name hashes (array) are in the set
+    def containsHashes(self, hashes):
+        
+        if len(self.hashes) == 0:
+            return np.zeros(len(hashes), dtype=bool)
+        
+        index = np.searchsorted(self.hashes, hashes)
+        index[index == len(self.hashes)] = 0
+        
+        return self.hashes[index] == hashes
+    
+    # Returns the sorted array of read name hashes in both this set and 
+    # other (ReadNameSet)
+    def intersect(self, other):
+        
+        return np.intersect1d(self.hashes, other.hashes, assume_unique=True)
+    
+    # Number of read names in the set or, if read_names are given, 
+    # number of them in the set
+    def count(self, read_names=None):
+        
+        if read_names is None:
+            return len(self.hashes)
+        
+        return int(np.count_nonzero(self.contains(list(read_names))))
+
+
+#------------------------------------------------------------------------------
+# Table recording, for every read name hash seen, whether any segment of the
+# read has been seen mapped. The hashes are split into partitions by their 
+# top bits, each partition being kept as sorted, deduplicated chunks. When 
+# more than max_names_in_memory entries are held, all the partitions are 
+# spilled to files in tmp_dir and merged back one partition at a time at the
+# end, so the memory used is bounded by the largest partition. The spilled
+# partitions of other tables (Eg. from other processes) can be added to be
+# merged too.
+#
+# Inputs:
+#    -tmp_dir: Directory for the spilled partitions
+#    -max_names_in_memory: Number of entries held before spilling to disk
+#    -partition_bits: The table has 2**partition_bits partitions
+class MappedReadNameTable(object):
+    
+    entry_dtype = np.dtype([("hash", "<u8"), ("mapped", "u1")])
+    
+    def __init__(self, tmp_dir=None, max_names_in_memory=20000000,
+                 partition_bits=6):
+        
+        self.tmp_dir = tmp_dir
+        self.max_names_in_memory = max_names_in_memory
+        self.partition_bits = partition_bits
+        self.partitions = [[] for _ in range(2 ** partition_bits)]
+        self.names_in_memory = 0
+        self.spill_dir = None
+        self.added_spill_dirs = []
+    
+    # Collapses the entries with the same hash, a hash is mapped if any of
+    # its entries is mapped. Returns the entries sorted by hash.
+    @staticmethod
+    def reduce(entries):
+        
+        if len(entries) == 0:
+            return entries
+        
+        entries = np.sort(entries, order=["hash", "mapped"])
+        
+        # Keep the last entry of each hash: the mapped one if any
+        last = np.ones(len(entries), dtype=bool)
+        last[:-1] = entries["hash"][1:] != entries["hash"][:-1]
+        
+        return entries[last]
+    
+    # Adds the read name hashes and mapped status (arrays) to the table
+    def add(self, hashes, mapped):
+        
+        entries = np.empty(len(hashes), dtype=self.entry_dtype)
+        entries["hash"] = hashes
+        entries["mapped"] = mapped
+        entries = self.reduce(entries)
+        
+        # Entries are sorted by hash, so each partition is a contiguous slice
+        partition = entries["hash"] >> np.uint64(64 - self.partition_bits)
+        bounds = np.searchsorted(partition, 
+                                 np.arange(len(self.partitions) + 1))
+        
+        for i in range(len(self.partitions)):
+            if bounds[i] < bounds[i + 1]:
+                self.partitions[i].append(entries[bounds[i]:bounds[i + 1]])
+        
+        self.names_in_memory += len(entries)
+        
+        if self.names_in_memory > self.max_names_in_memory:
+            self.spill()
+    
+    def getSpillFile(self, i, spill_dir=None):
+        
+        if spill_dir is None:
+            spill_dir = self.spill_dir
+        
+        return os.path.join(spill_dir, "partition_%i.bin" % i)
+    
+    # Adds the partitions spilled to disk by another table (Eg. filled in
+    # another process) to be merged with the ones of this table
+    def addSpilledTable(self, spill_dir):
+        
+        self.added_spill_dirs.append(spill_dir)
+    
+    # Appends the partitions held in memory to their files on disk
+    def spill(self):
+        
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        
+        for i, chunks in enumerate(self.partitions):
+            if chunks:
+                with open(self.getSpillFile(i), "ab") as writer:
+                    self.reduce(np.concatenate(chunks)).tofile(writer)
+        
+        self.partitions = [[] for _ in range(len(self.partitions))]
+        self.names_in_memory = 0
+    
+    # Yields the reduced entries of each partition (sorted by hash), 
+    # removing any spilled files
+    def iteratePartitions(self):
+        
+        spill_dirs = list(self.added_spill_dirs)
+        
+        if self.spill_dir is not None:
+            spill_dirs.append(self.spill_dir)
+        
+        for i, chunks in enumerate(self.partitions):
+            
+            for spill_dir in spill_dirs:
+                
+                spill_file = self.getSpillFile(i, spill_dir)
+                
+                if os.path.exists(spill_file):
+                    chunks = chunks + [np.fromfile(spill_file, 
+                                                   dtype=self.entry_dtype)]
+                    os.unlink(spill_file)
+            
+            if chunks:
+                yield self.reduce(np.concatenate(chunks))
+            
+            self.partitions[i] = []
+        
+        for spill_dir in spill_dirs:
+            os.rmdir(spill_dir)
+        
+        self.spill_dir = None
+        self.added_spill_dirs = []
+
+
+#------------------------------------------------------------------------------
+# Order independent version of getMappedUnmappedReads: counts the total, 
+# mapped and unmapped reads (a read is mapped if any of its segments is 
+# mapped) of a Sam/Bam file in any order (eg. coordinate sorted), so it 
+# doesn't need a previous sort by readname. 
+# Read names are tracked as 64 bit hashes in a MappedReadNameTable, the 
+# read names themselves are not kept so the mapped/unmapped read name 
+# lists are not written, but the hashes can be written as ReadNameSet files
+# (<outfile>.mapped.names.npy and <outfile>.unmapped.names.npy).
+# With threads > 1 the Bam file is split in shards processed in parallel,
+# the tables of the shards being merged partition by partition.
+#
+# Inputs:
+#    -infile: Sam/Bam file in any order
+#    -outfile: Outfile with the counters
+#    -tmp_dir: Directory for the read name hashes spilled to disk
+#    -max_names_in_memory: Number of read name hashes held before spilling
+#        to disk (per process)
+#    -threads: Number of processes to use
+#    -write_name_sets: Write the mapped and unmapped ReadNameSet files
+#
+# Outputs:
+#    -writes the counters to the outfile
+@cluster_runnable
+def getMappedUnmappedReadsAnyOrder(infile, 
+                                   outfile, 
+                                   tmp_dir=None, 
+                                   max_names_in_memory=20000000,
+                                   threads=1,
+                                   write_name_sets=False):
+    
+    shards = getBamShards(infile, threads)
+    
+    # Each shard fills its own table, spilled to disk to be merged here
+    # when there is more than one
+    tables = processBamShards(infile,
+                              shards,
+                              addReadsToMappedReadNameTable,
+                              [(tmp_dir, max_names_in_memory, len(shards) > 1)] 
+                              * len(shards),
+                              threads,
+                              group_by_name=False)
+    
+    table = tables[0]
+    
+    for shard_table in tables[1:]:
+        table.addSpilledTable(shard_table.spill_dir)
+    
+    c = collections.Counter()
+    
+    # The partitions come in hash order, so the hashes can be appended to
+    # the raw sets as they come
+    if write_name_sets:
+        out_prefix = P.snip(outfile, '.tsv')
+        raw_mapped = open(out_prefix + '.mapped.names.bin', "wb")
+        raw_unmapped = open(out_prefix + '.unmapped.names.bin', "wb")
+    
+    for entries in table.iteratePartitions():
+        
+        n_mapped = int(np.count_nonzero(entries["mapped"]))
+        
+        c["total"] += len(entries)
+        c["mapped"] += n_mapped
+        c["unmapped"] += len(entries) - n_mapped
+        
+        if write_name_sets:
+            is_mapped = entries["mapped"] > 0
+            entries["hash"][is_mapped].tofile(raw_mapped)
+            entries["hash"][~is_mapped].tofile(raw_unmapped)
+    
+    if write_name_sets:
+        
+        raw_mapped.close()
+        raw_unmapped.close()
+        
+        ReadNameSet.writeFromSortedRawFile(out_prefix + '.mapped.names.npy',
+                                           raw_mapped.name)
+        ReadNameSet.writeFromSortedRawFile(out_prefix + '.unmapped.names.npy',
+                                           raw_unmapped.name)
+    
+    writeMappedUnmappedCounters(c, outfile)
+
+
+#------------------------------------------------------------------------------
+# Writes the total, mapped and unmapped counters of 
+# getMappedUnmappedReadsAnyOrder (mapped and unmapped only if not 0)
+def writeMappedUnmappedCounters(c, outfile):
+    
+    with IOTools.open_file(outfile, "w") as output_file_write:
+        for counter in ("total", "mapped", "unmapped"):
+            if c[counter] or counter == "total":
+                output_file_write.write(counter + ':\t' + str(c[counter]) + '\n')
+
+
+#------------------------------------------------------------------------------
+# Shard function of getMappedUnmappedReadsAnyOrder: adds the read name 
+# hashes and mapped status of an iterator of reads (in any order) to a new
+# MappedReadNameTable.
+#
+# Inputs:
+#    -reads: iterator of reads
+#    -tmp_dir: Directory for the read name hashes spilled to disk
+#    -max_names_in_memory: Number of read name hashes held before spilling
+#        to disk
+#    -spill: If True, the whole table is spilled to disk at the end (so it
+#        can be returned cheaply from another process)
+#
+# Outputs:
+#    -returns the MappedReadNameTable
+def addReadsToMappedReadNameTable(reads, tmp_dir, max_names_in_memory, spill):
+    
+    table = MappedReadNameTable(tmp_dir=tmp_dir,
+                                max_names_in_memory=max_names_in_memory)
+    
+    block_size = 1000000
+    hashes = array.array("Q")
+    mapped = array.array("B")
+    
+    for read in reads:
+        
+        hashes.append(getReadNameHash(read.query_name))
+        mapped.append(not read.is_unmapped)
+        
+        if len(hashes) == block_size:
+            table.add(np.frombuffer(hashes, dtype=np.uint64),
+                      np.frombuffer(mapped, dtype=np.uint8))
+            hashes = array.array("Q")
+            mapped = array.array("B")
+    
+    table.add(np.frombuffer(hashes, dtype=np.uint64),
+              np.frombuffer(mapped, dtype=np.uint8))
+    
+    if spill:
+        table.spill()
+    
+    return table
+
 
 #------------------------------------------------------------------------------
 # Looks into sample_table for the sample specified by sample_name
@@ -226,6 +635,8 @@ def getSampleQCShift(sample_name, sample_table):
 #     -infile: Sam/Bam file containing only unique mappings per pair in each read
 #         sorted by readname sorted by readname from any mapper output
 #     -stats_outfile: Outfile with the statistics
+#     -threads: Number of processes to use (the Bam file is split in shards
+#         processed in parallel, see getBamShards)
 #
 # Output:
 #     -returns printable output with the stats
@@ -233,209 +644,343 @@ def getSampleQCShift(sample_name, sample_table):
 # Exception:
 #     -If a multimapping (read alignment not being primary is found).
 @cluster_runnable
-def getUniquelyMappedPairsNoMultimapping(infile, stats_outfile):
+def getUniquelyMappedPairsNoMultimapping(infile, stats_outfile, threads=1):
     
-    c = collections.Counter()
+    shards = getBamShards(infile, threads)
     
-    # Determine the extension of the file (BAM or SAM), done this for SAM/BAM 
-    # compatibility At the moment, all calls should only pass SAM, if it stops
-    # working just leave samfile = pysam.AlignmentFile(infile, "r")
-    _ , file_extension = os.path.splitext(infile)
+    counters = processBamShards(infile, 
+                                shards, 
+                                countUniquelyMappedPairsInShard,
+                                [()] * len(shards),
+                                threads)
     
-    if (file_extension.lower() == '.sam'):
-        samfile = pysam.AlignmentFile(infile, "r")
+    createOutputStringFromCounters(sumCounters(counters), stats_outfile)
+
+
+#------------------------------------------------------------------------------
+# Shard function of getUniquelyMappedPairsNoMultimapping
+#
+# Inputs:
+#    -reads: iterator of reads sorted by readname
+#
+# Outputs:
+#    -returns the Counter
+def countUniquelyMappedPairsInShard(reads):
     
-    elif (file_extension.lower() == '.bam'):
-        samfile = pysam.AlignmentFile(infile, "rb")
+    c = collections.Counter()
     
+    # Process the reads in blocks of whole read pairs
+    for block in iterateReadFlagBlocks(reads):
+        countUniquelyMappedPairs(block, c)
     
-    # We need to know when the read name changes
-    last_read_name = "first"
+    return c
+
+
+#------------------------------------------------------------------------------
+# Writes the counters in the stats_outfile
+# Inputs:
+#     -counters: Counters with different keys and counts
+#     -stats_outfile: File with the output of the stats
+def createOutputStringFromCounters(counters, stats_outfile):
     
-    # We need to know the last read when the read name changes to assign
-    # the read_pair details from the last read when we have seen all the read 
-    # pair alignments
-    last_read = ""
+    with open(stats_outfile, 'w') as writer:
+        for key in counters:  
+            writer.write(key + ":\t" +str(counters[key]) + "\n")
+
+
+
+#------------------------------------------------------------------------------
+# Block of alignments from a Sam/Bam file SORTED BY READNAME, with the 
+# details used by the read pair counters held in arrays (one element per
+# alignment). A block always contains all the alignments of its read names.
+#    -flag: FLAG of each alignment
+#    -group: index of the read name of each alignment within the block
+#    -names: the read names of the block
+#    -alignment_score: AS of the alignment (*)
+#    -suboptimal_score: XS of the alignment (*)
+#    -additional_hits: the alignment has additional hits in XA (**)
+#    -chimeric: the alignment has chimeric hits in SA (**)
+# (*) Only filled for proper pair alignments with additional hits, 0 otherwise
+# (**) Only filled for proper pair alignments, False otherwise
+ReadFlagBlock = collections.namedtuple("ReadFlagBlock", 
+                                       ["flag",
+                                        "group",
+                                        "names",
+                                        "alignment_score",
+                                        "suboptimal_score",
+                                        "additional_hits",
+                                        "chimeric"])
+
+
+#------------------------------------------------------------------------------
+# Goes through a Sam/Bam file SORTED BY READNAME and yields ReadFlagBlocks
+# of at least block_size alignments (except the last one), without splitting
+# the alignments of a read name between blocks. The per alignment python
+# work is limited to reading the FLAG, the read name and, for proper pairs
+# only, the XA/SA/AS/XS tags.
+#
+# Inputs:
+#    -samfile: opened pysam.AlignmentFile (or any iterator of reads) sorted
+#        by readname
+#    -block_size: Number of alignments per block
+#
+# Outputs:
+#    -yields ReadFlagBlock
+def iterateReadFlagBlocks(samfile, block_size=500000):
     
-    # Create new dictionary template to store the details
-    read_pair_dict_template = {'read_pair_is_paired':"", # Read pair contains R1 and R2    
-            'read_pair_mapped_in_proper_pair':"", # Read pair contains proper mapped pair
-            'read_pair_is_pcr_duplicate':"", # Read pair is a PCR duplicate
-            'read_number_unmapped':0, # Number of R1 and R2 unmapped
-            'read_number_supplementary':0, # Number of R1 and R2 supplementary (Eg. Translocations) 
-            }
+    def makeBlock():
+        
+        return ReadFlagBlock(flag=np.frombuffer(flags, dtype=np.uint16),
+                             group=np.frombuffer(groups, dtype=np.int64),
+                             names=names,
+                             alignment_score=np.frombuffer(alignment_scores, 
+                                                           dtype=np.int32),
+                             suboptimal_score=np.frombuffer(suboptimal_scores, 
+                                                            dtype=np.int32),
+                             additional_hits=np.frombuffer(additional_hits, 
+                                                           dtype=np.uint8) > 0,
+                             chimeric=np.frombuffer(chimeric, 
+                                                    dtype=np.uint8) > 0)
     
-    # Create new copy of the template dictionary to store
-    read_pair_dict = copy.deepcopy(read_pair_dict_template)
+    def newArrays():
         
-    # Process the reads
+        return (array.array("H"), array.array("q"), [], array.array("i"),
+                array.array("i"), array.array("B"), array.array("B"))
+    
+    (flags, groups, names, alignment_scores, suboptimal_scores, 
+     additional_hits, chimeric) = newArrays()
+    
+    last_read_name = None
+    
     for read in samfile:
         
-        # If it is the first read, assign the name (it will consider
-        # it as read name hasn't changed)
-        if last_read_name == "first":
-            last_read_name = read.query_name
-            
-
-        # The read has changed excepting the first read from the file
-        if (last_read_name != read.query_name):       
-            # We have seen all the reads from a pair, fill the details
-            # of the pair
-            
-            # reads contain a pair (R1 and R2)
-            read_pair_dict['read_pair_is_paired'] = last_read.is_paired
-            
-            # Read pair contains proper mapped pair
-            read_pair_dict['read_pair_mapped_in_proper_pair'] = last_read.is_proper_pair
+        read_name = read.query_name
+        
+        # New read name: the block can be closed here 
+        if read_name != last_read_name:
             
-            # Read pair is a PCR duplicate
-            read_pair_dict['read_pair_is_pcr_duplicate'] = last_read.is_duplicate
+            if len(flags) >= block_size:
+                
+                yield makeBlock()
+                
+                (flags, groups, names, alignment_scores, suboptimal_scores, 
+                 additional_hits, chimeric) = newArrays()
             
-            # Store everything updating the counters
-            c = getUniquelyMappedPairsUpdateCounters(c, read_pair_dict)
- 
-            # Create new copy of the template dictionary to store
-            read_pair_dict = copy.deepcopy(read_pair_dict_template)
+            names.append(read_name)
+            last_read_name = read_name
+        
+        flag = read.flag
+        
+        alignment_score = 0
+        suboptimal_score = 0
+        additional_hit = False
+        chimeric_hit = False
+        
+        # The tags are only looked at for proper pairs
+        if flag & 3 == 3:
             
-
-        # Fill the dictionary with the details for the individual reads
-        if read.is_unmapped:      
-            read_pair_dict['read_number_unmapped'] += 1
-  
-        if read.is_supplementary: 
-            read_pair_dict['read_number_supplementary'] += 1
+            if read.has_tag("XA") and len(read.get_tag("XA").split(",")) > 1:
+                additional_hit = True
+                alignment_score = read.get_tag("AS")
+                suboptimal_score = read.get_tag("XS")
             
-        # If the read alignment is secondary, it means multimapping is enabled
-        # exit with exception
-        if read.is_secondary:
-            raise Exception("Secondary read found: "+ read.query_name + 
-                            " Multimapping was enabled")
-             
-        # Last command in the loop: update the last_read with
-        # the read currently viewed
-        last_read = read
-        last_read_name = read.query_name
-              
-    # Process the last read
-    # We have seen all the reads from a pair, fill the details
-    # of the pair
+            if read.has_tag("SA") and len(read.get_tag("SA").split(",")) > 1:
+                chimeric_hit = True
+        
+        flags.append(flag)
+        groups.append(len(names) - 1)
+        alignment_scores.append(alignment_score)
+        suboptimal_scores.append(suboptimal_score)
+        additional_hits.append(additional_hit)
+        chimeric.append(chimeric_hit)
     
-    # reads contain a pair (R1 and R2)
-    read_pair_dict['read_pair_is_paired'] = last_read.is_paired
+    if len(flags) > 0:
+        yield makeBlock()
+
+
+#------------------------------------------------------------------------------
+# Gets the position of the first alignment of each read name from the
+# (sorted) read name index of each alignment.
+def getGroupStarts(group):
     
-    # Read pair contains proper mapped pair
-    read_pair_dict['read_pair_mapped_in_proper_pair'] = last_read.is_proper_pair
+    if len(group) == 0:
+        return np.zeros(0, dtype=np.intp)
     
-    # Read pair is a PCR duplicate
-    read_pair_dict['read_pair_is_pcr_duplicate'] = last_read.is_duplicate
+    return np.flatnonzero(np.concatenate(([True], group[1:] != group[:-1])))
+
+
+#------------------------------------------------------------------------------
+# Adds to the counter key the number of True values in mask (the key is only
+# created if there is any).
+def addCountsToCounter(counter, key, mask):
     
+    count = int(np.count_nonzero(mask))
     
-    # Store everything updating the counters
-    c = getUniquelyMappedPairsUpdateCounters(c, read_pair_dict)
+    if count:
+        counter[key] += count
     
-    createOutputStringFromCounters(c, stats_outfile)
+    return counter
 
 
 #------------------------------------------------------------------------------
-# Updates the counters of reads taking into account the guidelines from
-# getUniquelyMappedPairs  
+# Updates the counters of getUniquelyMappedPairsNoMultimapping with the read
+# pairs from a ReadFlagBlock, using grouped reductions over the alignments 
+# of each read name instead of a dictionary per read pair.
+# The read pair details (paired, proper pair, PCR duplicate) are taken from
+# the last alignment of each read name.
+#
 # Inputs:
+#    -block: ReadFlagBlock
 #    -counter: Counter with the different keys and the counts
-#    -dictionary: Dictionary containing the counts for the different keys
-#        of the last read pair
+#    -mask: Optional boolean array selecting the alignments of the block to
+#        use (Eg. only primary alignments)
 #
 # Outputs:
 #    -updated_counter: Counter after adding the different keys and corresponding counts
-def getUniquelyMappedPairsUpdateCounters(counter, dictionary):
+#
+# Exception:
+#     -If a multimapping (read alignment not being primary is found).
+def countUniquelyMappedPairs(block, counter, mask=None):
     
-    # Get proper mapped pairs
-    if dictionary["read_pair_is_paired"] and dictionary["read_pair_mapped_in_proper_pair"]:
-        
-        counter["total_proper_mapped_pairs"] += 1
-        
-        # For supplementary, for now, all we want to know is whether a read
-        # has these alignments or not
-        if dictionary['read_number_supplementary'] != 0:  
-            counter["proper_mapped_pairs_with_supp_alignment"] += 1
-
-        if dictionary["read_pair_is_pcr_duplicate"]:    
-            counter["proper_mapped_pairs_pcr_duplicate"] += 1
-            
-        # -Read pairs which are all of the below (group1): 
-        #        -Read pair mapped in proper pair
-        #        -Doesn't contain supplementary alignments
-        #        -Doesn't contain secondary alignments
-        #        -Not PCR duplicate
-        #        -Contains R1 and R2
-        if ((dictionary['read_number_supplementary'] == 0) and \
-             not dictionary["read_pair_is_pcr_duplicate"]):
-            counter["proper_mapped_pairs_with_no_supp_or_pcr_duplicate"] += 1
-        
-        #    -Read pairs which are all of the below (group2): 
-        #        -Read pair mapped in proper pair
-        #        -Contains supplementary alignments (maybe translocations, inversions, etc..)
-        #        -Doesn't contain secondary alignments
-        #        -Not PCR duplicate
-        #        -Contains R1 and R2 
-        elif ((dictionary['read_number_supplementary'] != 0) and \
-             not dictionary["read_pair_is_pcr_duplicate"]):
-            counter["proper_mapped_pairs_with_supp_or_pcr_duplicate"] += 1
-        
-    return counter    
-
-
-#------------------------------------------------------------------------------
-# Writes the counters in the stats_outfile
-# Inputs:
-#     -counters: Counters with different keys and counts
-#     -stats_outfile: File with the output of the stats
-def createOutputStringFromCounters(counters, stats_outfile):
+    flag = block.flag
+    group = block.group
     
-    with open(stats_outfile, 'w') as writer:
-        for key in counters:  
-            writer.write(key + ":\t" +str(counters[key]) + "\n")
+    if mask is not None:
+        flag = flag[mask]
+        group = group[mask]
+    
+    if len(flag) == 0:
+        return counter
+    
+    # If the read alignment is secondary, it means multimapping is enabled
+    # exit with exception
+    secondary = np.flatnonzero(flag & 256)
+    if len(secondary):
+        raise Exception("Secondary read found: " + 
+                        block.names[group[secondary[0]]] + 
+                        " Multimapping was enabled")
+    
+    starts = getGroupStarts(group)
+    last_flag = flag[np.append(starts[1:], len(flag)) - 1]
+    
+    # For supplementary, for now, all we want to know is whether a read
+    # has these alignments or not
+    supplementary = np.add.reduceat(((flag & 2048) != 0).astype(np.int64),
+                                    starts) > 0
+    
+    proper_pair = (last_flag & 3) == 3
+    duplicate = (last_flag & 1024) != 0
+    
+    addCountsToCounter(counter, "total_proper_mapped_pairs", proper_pair)
+    
+    addCountsToCounter(counter, "proper_mapped_pairs_with_supp_alignment",
+                       proper_pair & supplementary)
+    
+    addCountsToCounter(counter, "proper_mapped_pairs_pcr_duplicate",
+                       proper_pair & duplicate)
+    
+    # -Read pairs which are all of the below (group1): 
+    #        -Read pair mapped in proper pair
+    #        -Doesn't contain supplementary alignments
+    #        -Doesn't contain secondary alignments
+    #        -Not PCR duplicate
+    #        -Contains R1 and R2
+    addCountsToCounter(counter, 
+                       "proper_mapped_pairs_with_no_supp_or_pcr_duplicate",
+                       proper_pair & ~supplementary & ~duplicate)
+    
+    #    -Read pairs which are all of the below (group2): 
+    #        -Read pair mapped in proper pair
+    #        -Contains supplementary alignments (maybe translocations, inversions, etc..)
+    #        -Doesn't contain secondary alignments
+    #        -Not PCR duplicate
+    #        -Contains R1 and R2 
+    addCountsToCounter(counter, 
+                       "proper_mapped_pairs_with_supp_or_pcr_duplicate",
+                       proper_pair & supplementary & ~duplicate)
+    
+    return counter
 
 
-#--------------------------------------------------------------------------------
-# Updates the counters of reads taking into account the guidelines from
-# getCorrectReadPairs  
+#------------------------------------------------------------------------------
+# Updates the counters of getCorrectReadPairs with the read pairs from a
+# ReadFlagBlock, using grouped reductions over the alignments of each read
+# name instead of a dictionary per read pair.
+# A read pair only needs one proper pair alignment to be a proper pair, and 
+# only one of its proper pair alignments to be a PCR duplicate, have an
+# additional hit equally good or be chimeric to be counted as such.
+#
 # Inputs:
+#    -block: ReadFlagBlock
 #    -counter: Counter with the different keys and the counts
-#    -dictionary: Dictionary containing the counts for the different keys
-#        of the last read pair
+#    -mask: Optional boolean array selecting the alignments of the block to
+#        use (Eg. only secondary alignments)
 #
 # Outputs:
 #    -updated_counter: Counter after adding the different keys and corresponding counts
-def getCorrectReadPairsUpdateCounters(counter, dictionary):
+def countCorrectReadPairs(block, counter, mask=None):
     
-    # Variable to control the pair isn't into any "incorrect category"
-    correct_pair = True
+    flag = block.flag
+    group = block.group
+    additional_hits = block.additional_hits
+    alignment_score = block.alignment_score
+    suboptimal_score = block.suboptimal_score
+    chimeric = block.chimeric
     
-    if (dictionary["read_pair_mapped_in_proper_pair"] and 
-        dictionary["read_pair_is_paired"]): 
-       
-        counter["read_pairs_mapped_in_proper_pair"] += 1
-        if dictionary["read_pair_is_pcr_duplicate"]:  
-            counter["proper_read_pair_is_pcr_duplicate"] += 1   
-            correct_pair = False
-
-        if dictionary['proper_pair_additional_hit_equally_good']:   
-            counter["proper_read_pair_additional_hit_equally_good"] += 1     
-            correct_pair = False
-                
-        if dictionary['proper_pair_with_chimeric_read']:    
-            counter["proper_read_pair_with_chimeric_read"] += 1       
-            correct_pair = False
-        
-        # After performing all the checks, see which are "correct" pairs    
-        if correct_pair:  
-            counter["proper_read_pair_no_dup_no_additional_hit_equally_good_no_chimeric"] += 1
+    if mask is not None:
+        flag = flag[mask]
+        group = group[mask]
+        additional_hits = additional_hits[mask]
+        alignment_score = alignment_score[mask]
+        suboptimal_score = suboptimal_score[mask]
+        chimeric = chimeric[mask]
     
-    # Not proper pairs    
-    else:
-        counter["read_pairs_mapped_not_in_proper_pair"] += 1
+    if len(flag) == 0:
+        return counter
+    
+    starts = getGroupStarts(group)
+    
+    def anyInPair(alignment_mask):
+        return np.maximum.reduceat(alignment_mask.astype(np.uint8), starts) > 0
+    
+    proper_alignment = (flag & 3) == 3
+    
+    proper_pair = anyInPair(proper_alignment)
+    
+    duplicate = anyInPair(proper_alignment & ((flag & 1024) != 0))
+    
+    # If the score on the additional hit (XS) is as good or better
+    # than the score of the original hit (AS)
+    additional_hit_equally_good = anyInPair(
+        proper_alignment & additional_hits & 
+        (alignment_score <= suboptimal_score))
+    
+    chimeric_read = anyInPair(proper_alignment & chimeric)
+    
+    addCountsToCounter(counter, "read_pairs_mapped_in_proper_pair", 
+                       proper_pair)
+    
+    addCountsToCounter(counter, "proper_read_pair_is_pcr_duplicate", 
+                       duplicate)
+    
+    addCountsToCounter(counter, "proper_read_pair_additional_hit_equally_good",
+                       additional_hit_equally_good)
+    
+    addCountsToCounter(counter, "proper_read_pair_with_chimeric_read",
+                       chimeric_read)
+    
+    # After performing all the checks, see which are "correct" pairs
+    addCountsToCounter(
+        counter, 
+        "proper_read_pair_no_dup_no_additional_hit_equally_good_no_chimeric",
+        proper_pair & ~duplicate & ~additional_hit_equally_good & ~chimeric_read)
+    
+    # Not proper pairs
+    addCountsToCounter(counter, "read_pairs_mapped_not_in_proper_pair",
+                       ~proper_pair)
+    
+    return counter
 
-    return counter 
 
 
 #------------------------------------------------------------------------------
@@ -456,406 +1001,4514 @@ def getCorrectReadPairsUpdateCounters(counter, dictionary):
 #     -infile: Sam/Bam file containing only unique mappings per pair in each read
 #         sorted by readname sorted by readname from BWA mem -M
 #     -stats_outfile: Outfile with the statistics
+#     -threads: Number of processes to use (the Bam file is split in shards
+#         processed in parallel, see getBamShards)
 #
 # Output:
 #     -returns printable output with the stats
 @cluster_runnable
-def getCorrectReadPairs(infile, stats_outfile):
+def getCorrectReadPairs(infile, stats_outfile, threads=1):
+    
+    shards = getBamShards(infile, threads)
+    
+    counters = processBamShards(infile, 
+                                shards, 
+                                countCorrectReadPairsInShard,
+                                [()] * len(shards),
+                                threads)
+    
+    createOutputStringFromCounters(sumCounters(counters), stats_outfile)
+
+
+#------------------------------------------------------------------------------
+# Shard function of getCorrectReadPairs
+#
+# Inputs:
+#    -reads: iterator of reads sorted by readname
+#
+# Outputs:
+#    -returns the Counter
+def countCorrectReadPairsInShard(reads):
     
     c = collections.Counter()
     
-    # Determine the extension of the file (BAM or SAM), done this for SAM/BAM compatibility
-    # At the moment, all calls should only pass SAM, if it stops working just leave 
-    # samfile = pysam.AlignmentFile(infile, "r")
-    filename, file_extension = os.path.splitext(infile)
+    # Process the reads in blocks of whole read pairs
+    for block in iterateReadFlagBlocks(reads):
+        countCorrectReadPairs(block, c)
+    
+    return c
+
+
+#------------------------------------------------------------------------------
+# Opens a Sam/Bam file choosing the mode from the extension of the file 
+# (done this for SAM/BAM compatibility)
+#
+# Inputs:
+#    -infile: Sam/Bam file
+#
+# Outputs:
+#    -returns the opened pysam.AlignmentFile
+def openAlignmentFile(infile):
+    
+    _ , file_extension = os.path.splitext(infile)
     
     if (file_extension.lower() == '.sam'):
-        samfile = pysam.AlignmentFile(infile, "r")
+        return pysam.AlignmentFile(infile, "r")
+    
+    return pysam.AlignmentFile(infile, "rb")
+
+
+#------------------------------------------------------------------------------
+# Goes through a Sam/Bam file SORTED BY READNAME and yields all the 
+# alignments (primary, secondary and supplementary) of each read name
+# together, in the order they appear in the file.
+#
+# Inputs:
+#    -samfile: opened pysam.AlignmentFile (or any iterator of reads) sorted
+#        by readname
+#
+# Outputs:
+#    -yields (read_name, list of reads) for each read name
+def iterateReadNameGroups(samfile):
+    
+    read_name = None
+    reads = []
+    
+    for read in samfile:
+        
+        # The read name has changed, all the alignments from the last
+        # read name have been seen
+        if read.query_name != read_name:
+            
+            if reads:
+                yield read_name, reads
+            
+            read_name = read.query_name
+            reads = []
+        
+        reads.append(read)
+    
+    # The last read name is hanging
+    if reads:
+        yield read_name, reads
+
+
+#------------------------------------------------------------------------------
+# Single pass equivalent of running getUniquelyMappedPairsNoMultimapping on
+# the primary alignments (samtools view -F 256), getCorrectReadPairs on all
+# the alignments and getCorrectReadPairs on the secondary alignments only
+# (samtools view -f 256) of a Sam/Bam file SORTED BY READNAME.
+# The three sets of counters are filled together while going through the
+# file once, without creating the primary/secondary split files.
+# Read names without any alignment in one of the sets are not counted
+# in that set (an empty secondary set gives an empty stats file).
+#
+# Inputs:
+#    -infile: Sam/Bam file sorted by readname
+#    -primary_stats_outfile: Outfile with the statistics from the primary
+#        alignments
+#    -stats_outfile: Outfile with the statistics from all the alignments
+#    -secondary_stats_outfile: Outfile with the statistics from the secondary
+#        alignments
+#    -threads: Number of processes to use (the Bam file is split in shards
+#        processed in parallel, see getBamShards)
+#
+# Outputs:
+#    -writes the three stats files
+@cluster_runnable
+def getPostDuplicationStatsSinglePass(infile, 
+                                      primary_stats_outfile,
+                                      stats_outfile,
+                                      secondary_stats_outfile,
+                                      threads=1):
+    
+    shards = getBamShards(infile, threads)
+    
+    shard_counters = processBamShards(infile, 
+                                      shards, 
+                                      countPostDuplicationStatsInShard,
+                                      [()] * len(shards),
+                                      threads)
+    
+    primary_counter, all_counter, secondary_counter = \
+        [sumCounters(counters) for counters in zip(*shard_counters)]
+    
+    createOutputStringFromCounters(primary_counter, primary_stats_outfile)
+    createOutputStringFromCounters(all_counter, stats_outfile)
+    createOutputStringFromCounters(secondary_counter, secondary_stats_outfile)
+
+
+#------------------------------------------------------------------------------
+# Shard function of getPostDuplicationStatsSinglePass
+#
+# Inputs:
+#    -reads: iterator of reads sorted by readname
+#
+# Outputs:
+#    -returns the primary, all and secondary Counters
+def countPostDuplicationStatsInShard(reads):
+    
+    primary_counter = collections.Counter()
+    all_counter = collections.Counter()
+    secondary_counter = collections.Counter()
+    
+    for block in iterateReadFlagBlocks(reads):
+        
+        secondary = (block.flag & 256) != 0
+        
+        countUniquelyMappedPairs(block, primary_counter, mask=~secondary)
+        countCorrectReadPairs(block, all_counter)
+        countCorrectReadPairs(block, secondary_counter, mask=secondary)
+    
+    return primary_counter, all_counter, secondary_counter
+
+
+#------------------------------------------------------------------------------
+# Bam files are series of BGZF blocks (gzip members of up to 64Kb of 
+# uncompressed data). A position in the Bam file is a virtual offset: the
+# offset of the BGZF block in the compressed file << 16 | the offset within
+# the uncompressed block.
+#
+# The functions below split a Bam file in shards (ranges of virtual offsets)
+# to be processed in parallel: the compressed file is cut at even byte
+# offsets and, from each cut, the next Bam record start is taken from the 
+# Bam index (.bai linear index) if there is one, or otherwise looked for
+# with a heuristic scan of the next BGZF blocks.
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+# Magic string of the Bam index (.bai) files
+BAI_MAGIC = b"BAI\x01"
+
+# Bin of the .bai files with the offsets and counts of a reference sequence
+BAI_PSEUDO_BIN = 37450
+
+# XLEN=6, SI1='B', SI2='C', SLEN=2
+BGZF_EXTRA_FIELD = b"\x06\x00BC\x02\x00"
+
+# Empty block marking the end of a BGZF file
+BGZF_EOF = BGZF_MAGIC + b"\x00\x00\x00\x00\x00\xff" + BGZF_EXTRA_FIELD + \
+           b"\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+# Maximum uncompressed data in a BGZF block written
+BGZF_BLOCK_SIZE = 0xff00
+
+# Compression level for temporary files
+TEMPORARY_COMPRESSION_LEVEL = 1
+
+# Compression level for the final outputs (as gzip)
+FINAL_COMPRESSION_LEVEL = 6
+
+# block_size, refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq,
+# next_refID, next_pos, tlen
+BAM_RECORD_HEADER = struct.Struct("<iiiBBHHHiiii")
+
+
+#------------------------------------------------------------------------------
+# Finds the compressed offset of the first BGZF block starting at or after 
+# offset.
+#
+# Inputs:
+#    -handle: Bam file opened in binary mode
+#    -offset: Offset in the compressed file
+#
+# Outputs:
+#    -returns the offset of the BGZF block or None if there is none
+def findBgzfBlockStart(handle, offset):
+    
+    chunk_size = 1 << 17
+    
+    while True:
+        
+        handle.seek(offset)
+        
+        # Overlap the chunks by the header size
+        data = handle.read(chunk_size + 17)
+        
+        if len(data) < 18:
+            return None
+        
+        index = data.find(BGZF_MAGIC)
+        
+        while index != -1 and index + 18 <= len(data):
+            
+            if data[index + 10:index + 16] == BGZF_EXTRA_FIELD:
+                return offset + index
+            
+            index = data.find(BGZF_MAGIC, index + 1)
+        
+        offset += chunk_size
+
+
+#------------------------------------------------------------------------------
+# Reads and decompresses the BGZF block starting at coffset.
+#
+# Inputs:
+#    -handle: Bam file opened in binary mode
+#    -coffset: Offset of the BGZF block in the compressed file
+#
+# Outputs:
+#    -returns (uncompressed data, offset of the next block) or None at the 
+#        end of the file
+def readBgzfBlock(handle, coffset):
+    
+    handle.seek(coffset)
+    header = handle.read(18)
+    
+    if len(header) < 18:
+        return None
+    
+    # BSIZE is the total block size - 1
+    block_size = struct.unpack("<H", header[16:18])[0] + 1
+    
+    # Remove the CRC32 and ISIZE at the end
+    compressed = handle.read(block_size - 18)[:-8]
+    
+    return zlib.decompress(compressed, -15), coffset + block_size
+
+
+#------------------------------------------------------------------------------
+# Checks whether a Bam record starts at position u of the uncompressed data:
+# the fixed length fields have to be consistent, the read name a NUL 
+# terminated printable string and the next depth records (as far as the data
+# goes) have to pass the same checks.
+#
+# Inputs:
+#    -data: uncompressed Bam data
+#    -u: position in data
+#    -n_references: Number of reference sequences in the Bam header
+#    -depth: Number of following records checked
+#
+# Outputs:
+#    -returns True if it looks like a Bam record start
+def isBamRecordStart(data, u, n_references, depth=3):
+    
+    if u + BAM_RECORD_HEADER.size > len(data):
+        return False
+    
+    (block_size, ref_id, pos, l_read_name, _, _, n_cigar_op, _, l_seq,
+     next_ref_id, next_pos, _) = BAM_RECORD_HEADER.unpack_from(data, u)
+    
+    if not (-1 <= ref_id < n_references and 
+            -1 <= next_ref_id < n_references and
+            pos >= -1 and next_pos >= -1 and 
+            l_read_name >= 2 and l_seq >= 0):
+        return False
+    
+    # The variable length fields have to fit in the record
+    if block_size < (32 + l_read_name + 4 * n_cigar_op + 
+                     (l_seq + 1) // 2 + l_seq):
+        return False
+    
+    name_start = u + BAM_RECORD_HEADER.size
+    name = data[name_start:name_start + l_read_name]
+    
+    if len(name) < l_read_name or name[-1] != 0 or \
+       any(c < 33 or c > 126 for c in name[:-1]):
+        return False
     
-    elif (file_extension.lower() == '.bam'):
-        samfile = pysam.AlignmentFile(infile, "rb")
+    following = u + 4 + block_size
+    
+    if depth == 0 or following + BAM_RECORD_HEADER.size > len(data):
+        return True
+    
+    return isBamRecordStart(data, following, n_references, depth - 1)
+
+
+#------------------------------------------------------------------------------
+# Finds the virtual offset of the first Bam record starting in the first 
+# BGZF block (with a record start) at or after offset.
+#
+# Inputs:
+#    -handle: Bam file opened in binary mode
+#    -offset: Offset in the compressed file
+#    -n_references: Number of reference sequences in the Bam header
+#
+# Outputs:
+#    -returns the virtual offset or None if there is none
+def findBamRecordStart(handle, offset, n_references):
+    
+    coffset = findBgzfBlockStart(handle, offset)
+    
+    while coffset is not None:
+        
+        block = readBgzfBlock(handle, coffset)
+        
+        if block is None:
+            return None
+        
+        data, next_coffset = block
+        
+        # Look ahead 2 more blocks to check the records following the 
+        # candidates
+        following_data = b""
+        following_coffset = next_coffset
+        
+        for _ in range(2):
+            
+            following_block = readBgzfBlock(handle, following_coffset)
+            
+            if following_block is None:
+                break
+            
+            following_data += following_block[0]
+            following_coffset = following_block[1]
+        
+        buffer = data + following_data
+        
+        for u in range(len(data)):
+            if isBamRecordStart(buffer, u, n_references):
+                return (coffset << 16) | u
+        
+        coffset = next_coffset
+    
+    return None
+
+
+#------------------------------------------------------------------------------
+# Reads the virtual offsets of Bam records stored in the Bam index (.bai) of
+# a coordinate sorted Bam file: the start of each reference sequence 
+# (pseudo-bin) and the first record overlapping each 16Kb window (linear 
+# index). The index is only used if it is not older than the Bam file.
+#
+# Inputs:
+#    -infile: Bam file
+#
+# Outputs:
+#    -returns a sorted numpy array with the virtual offsets (uint64) or None
+#        if there is no usable index
+def getBamIndexRecordStarts(infile):
+    
+    index_files = [infile + ".bai", re.sub(r"\.bam$", ".bai", infile)]
+    
+    index_files = [index_file for index_file in index_files 
+                   if os.path.exists(index_file) and 
+                   os.path.getmtime(index_file) >= os.path.getmtime(infile)]
+    
+    if len(index_files) == 0:
+        return None
+    
+    with open(index_files[0], "rb") as handle:
+        data = handle.read()
+    
+    if data[:4] != BAI_MAGIC:
+        return None
+    
+    n_references = struct.unpack_from("<i", data, 4)[0]
+    position = 8
+    
+    record_starts = []
+    
+    for _ in range(n_references):
+        
+        n_bins = struct.unpack_from("<i", data, position)[0]
+        position += 4
+        
+        for _ in range(n_bins):
+            
+            bin_id, n_chunks = struct.unpack_from("<Ii", data, position)
+            position += 8
+            
+            # The first chunk of the pseudo-bin is (start, end) of the 
+            # reference sequence
+            if bin_id == BAI_PSEUDO_BIN:
+                record_starts.append(
+                    np.frombuffer(data, dtype="<u8", count=1, offset=position))
+            
+            position += 16 * n_chunks
+        
+        n_intervals = struct.unpack_from("<i", data, position)[0]
+        position += 4
+        
+        record_starts.append(np.frombuffer(data, 
+                                           dtype="<u8", 
+                                           count=n_intervals, 
+                                           offset=position))
+        position += 8 * n_intervals
+    
+    if len(record_starts) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    
+    record_starts = np.unique(np.concatenate(record_starts))
+    
+    # Empty windows can be stored as 0
+    return record_starts[record_starts > 0]
+
+
+#------------------------------------------------------------------------------
+# Splits a Bam file in up to threads shards of similar compressed size.
+# The shard boundaries are Bam record starts from the Bam index when the Bam
+# file has an up to date one (see getBamIndexRecordStarts) and are found
+# with a heuristic otherwise (see findBamRecordStart), in which case they 
+# are checked while the shards are processed (see processBamShards).
+# Sam files (and threads=1) give a single shard.
+#
+# Inputs:
+#    -infile: Sam/Bam file
+#    -threads: Number of shards wanted
+#
+# Outputs:
+#    -returns a list of (start virtual offset, end virtual offset) with None
+#        as the end of the last shard (and as the start for Sam files)
+def getBamShards(infile, threads):
+    
+    _ , file_extension = os.path.splitext(infile)
+    
+    if file_extension.lower() == '.sam':
+        return [(None, None)]
+    
+    samfile = openAlignmentFile(infile)
+    
+    # After the header
+    first_record = samfile.tell()
+    n_references = samfile.nreferences
+    
+    samfile.close()
+    
+    starts = [first_record]
+    
+    if threads > 1:
+        
+        size = os.path.getsize(infile)
+        
+        index_record_starts = getBamIndexRecordStarts(infile)
+        
+        with open(infile, "rb") as handle:
+            
+            for i in range(1, threads):
+                
+                offset = (size * i) // threads
+                
+                if index_record_starts is not None:
+                    
+                    j = np.searchsorted(index_record_starts, 
+                                        np.uint64(offset << 16))
+                    
+                    if j == len(index_record_starts):
+                        break
+                    
+                    start = int(index_record_starts[j])
+                
+                else:
+                    
+                    start = findBamRecordStart(handle, offset, n_references)
+                    
+                    if start is None:
+                        break
+                
+                if start > starts[-1]:
+                    starts.append(start)
+    
+    return list(zip(starts, starts[1:] + [None]))
+
+
+#------------------------------------------------------------------------------
+# Raised when a shard boundary of a Bam file is not a Bam record start.
+class BamShardBoundaryError(ValueError):
+    pass
+
+
+#------------------------------------------------------------------------------
+# Yields the reads of a shard of a Bam file.
+# For a file sorted by readname (group_by_name), all the alignments of a 
+# read name go to the same shard: a shard continues past its end while the
+# read name is the one of the first read at or after the end, and the next
+# shard skips the reads with that read name.
+# The shard boundaries can be found with a heuristic (see 
+# findBamRecordStart), so they are checked: a read has to start exactly at 
+# the end.
+#
+# Inputs:
+#    -samfile: opened pysam.AlignmentFile
+#    -start: virtual offset of the first read (None to start from the 
+#        current position)
+#    -end: virtual offset where the shard ends (None for the end of the file)
+#    -skip_first_name: Skip the reads with the read name of the first read
+#        (it belongs to the previous shard)
+#    -group_by_name: Whether the file is sorted by readname
+#    -check_start: Whether start is the boundary with a previous shard (the
+#        reads which can't be decoded are then put down to the boundary)
+#
+# Outputs:
+#    -yields the reads
+#
+# Exception:
+#    -BamShardBoundaryError if no read starts at the end of the shard (or 
+#        with check_start, if a read can't be decoded)
+def iterateBamShard(samfile, start, end, skip_first_name, group_by_name,
+                    check_start=False):
+    
+    if start is not None:
+        samfile.seek(start)
+    
+    skip_name = None
+    boundary_name = None
+    
+    # Whether a read started at the end of the shard
+    reached_end = False
+    
+    while True:
+        
+        position = samfile.tell() if end is not None else None
+        
+        try:
+            read = next(samfile)
+        except StopIteration:
+            
+            if end is not None and not reached_end:
+                raise BamShardBoundaryError("Shard boundary %i is not a read "
+                                            "start: the file ends before it" 
+                                            % end)
+            return
+        except (OSError, ValueError) as error:
+            
+            if check_start:
+                raise BamShardBoundaryError("Shard boundary %i is not a read "
+                                            "start: %s" % (start, error))
+            raise
+        
+        read_name = read.query_name
+        
+        if end is not None and position >= end:
+            
+            if not reached_end and position != end:
+                raise BamShardBoundaryError("Shard boundary %i is not a read "
+                                            "start: a read starts at %i" 
+                                            % (end, position))
+            
+            reached_end = True
+            
+            if not group_by_name:
+                return
+            
+            if boundary_name is None:
+                boundary_name = read_name
+            
+            if read_name != boundary_name:
+                return
+        
+        if skip_first_name:
+            
+            if skip_name is None:
+                skip_name = read_name
+            
+            if read_name == skip_name:
+                continue
+            
+            skip_first_name = False
+        
+        yield read
+
+
+#------------------------------------------------------------------------------
+# Runs shard_function(reads, *args) on a shard of a Bam file, in the 
+# process pool of processBamShards. With start and end as False the shard is
+# empty (shard_function gets no reads).
+def runBamShard(infile, start, end, skip_first_name, group_by_name,
+                check_start, shard_function, args):
+    
+    if start is False and end is False:
+        return shard_function(iter(()), *args)
+    
+    samfile = openAlignmentFile(infile)
+    
+    reads = iterateBamShard(samfile, start, end, skip_first_name, 
+                            group_by_name, check_start)
+    
+    result = shard_function(reads, *args)
+    
+    samfile.close()
+    
+    return result
+
+
+#------------------------------------------------------------------------------
+# Processes the shards of a Bam file (from getBamShards) with shard_function
+# in a pool of processes.
+# If a shard boundary turns out not to be a Bam record start (see 
+# iterateBamShard), the whole file is processed again as the first shard,
+# the other shards being empty, so that there is still a result (and any
+# files written by shard_function) for every shard.
+#
+# Inputs:
+#    -infile: Sam/Bam file
+#    -shards: list of (start, end) virtual offsets
+#    -shard_function: function called as shard_function(reads, *args), it 
+#        has to be a module level function (it is pickled)
+#    -shard_args: list with the tuple of args of each shard
+#    -threads: Number of processes
+#    -group_by_name: Whether the file is sorted by readname (the alignments
+#        of a read name are kept in the same shard)
+#
+# Outputs:
+#    -returns the list of results of the shards, in order
+def processBamShards(infile, shards, shard_function, shard_args, threads,
+                     group_by_name=True):
+    
+    jobs = [(infile, start, end, group_by_name and i > 0, group_by_name, 
+             i > 0, shard_function, args) 
+            for i, ((start, end), args) in enumerate(zip(shards, shard_args))]
+    
+    if len(jobs) == 1:
+        return [runBamShard(*jobs[0])]
+    
+    try:
+        
+        with multiprocessing.Pool(min(threads, len(jobs))) as pool:
+            results = pool.starmap(runBamShard, jobs)
+    
+    except BamShardBoundaryError as error:
+        
+        E.warn("%s: %s, processing it as a single shard" % (infile, error))
+        
+        results = [runBamShard(infile, shards[0][0], None, False, 
+                               group_by_name, False, shard_function, 
+                               shard_args[0])]
+        
+        results.extend(runBamShard(infile, False, False, False, group_by_name,
+                                   False, shard_function, args) 
+                       for args in shard_args[1:])
+    
+    return results
+
+
+#------------------------------------------------------------------------------
+# Adds up a list of Counters, keeping the order of the keys as they first 
+# appear.
+def sumCounters(counters):
+    
+    c = collections.Counter()
+    
+    for counter in counters:
+        c.update(counter)
+    
+    return c
+
+
+#------------------------------------------------------------------------------
+# Goes through the reads of a Sam/Bam file SORTED BY READNAME and yields 
+# only the read names with less than k alignments (less than k alignment 
+# pairs for paired end data), as scripts/assign_multimappers.py (-k and 
+# --paired-end). Unlike the script, the last read name of the file is also 
+# yielded if it passes the filter.
+#
+# Inputs:
+#    -samfile: opened pysam.AlignmentFile (or any iterator of reads) sorted
+#        by readname
+#    -k: Alignment number cutoff
+#    -paired_end: Data is paired-end
+#
+# Outputs:
+#    -yields (read name, list of its reads) for the read names kept
+def iterateReadNameGroupsBelowAlignmentCutoff(samfile, k, paired_end=True):
+    
+    alignment_cutoff = int(k)
+    
+    if paired_end:
+        alignment_cutoff = alignment_cutoff * 2
+    
+    for read_name, reads in iterateReadNameGroups(samfile):
+        
+        if len(reads) < alignment_cutoff:
+            yield read_name, reads
+
+
+#------------------------------------------------------------------------------
+# Single pass first filtering: keeps the properly paired reads of a 
+# coordinate sorted Bam file (samtools view -F 524 -f 2), sorts them by 
+# readname (samtools sort -n) and reads the sorted stream directly from the 
+# pipe to filter out the multimappers (see 
+# iterateReadNameGroupsBelowAlignmentCutoff), so the proper pairs Bam file
+# is never written. 
+# In the same pass, the total/mapped/unmapped read counters of the filtered
+# reads (as getMappedUnmappedReadsAnyOrder) are written to stats_outfile.
+#
+# Inputs:
+#    -infile: Bam file
+#    -outfile: Bam file sorted by readname with the read names passing the
+#        filters
+#    -stats_outfile: Outfile with the counters of the filtered reads
+#    -k: Alignment number cutoff
+#    -paired_end: Data is paired-end
+#    -threads: Number of threads for samtools and the BGZF compression
+#    -tmp_dir: Directory for the samtools sort temporary files
+#    -log_file: File for the samtools stderr
+#    -write_name_sets: Write the mapped and unmapped ReadNameSet files next
+#        to the stats_outfile
+#
+# Outputs:
+#    -writes the filtered Bam file and the stats
+#
+# Exception:
+#    -If samtools fails
+@cluster_runnable
+def filterProperPairsAndMultimappers(infile, 
+                                     outfile,
+                                     stats_outfile,
+                                     k, 
+                                     paired_end=True,
+                                     threads=1,
+                                     tmp_dir=None,
+                                     log_file=os.devnull,
+                                     write_name_sets=False):
+    
+    # Samtools creates temporary files with a certain prefix
+    samtools_temp_dir = tempfile.mkdtemp(dir=tmp_dir)
+    samtools_temp_file = os.path.join(samtools_temp_dir, "sort")
+    
+    # Uncompressed Bam through the pipe
+    statement = ("set -o pipefail; "
+                 "samtools view -F 524 -f 2 -u %(infile)s | "
+                 "samtools sort -n -l 0 -O bam -@ %(threads)i "
+                 "-T %(samtools_temp_file)s -" % locals())
+    
+    with open(log_file, "a") as log:
+        
+        process = subprocess.Popen(statement, 
+                                   shell=True, 
+                                   executable="/bin/bash",
+                                   stdout=subprocess.PIPE,
+                                   stderr=log)
+        
+        try:
+            
+            samfile = pysam.AlignmentFile(process.stdout, "rb")
+            
+            outsamfile = pysam.AlignmentFile(outfile, "wb", template=samfile,
+                                             threads=threads)
+            
+            c = collections.Counter()
+            
+            mapped = array.array("Q")
+            unmapped = array.array("Q")
+            
+            for read_name, reads in iterateReadNameGroupsBelowAlignmentCutoff(
+                    samfile, k, paired_end):
+                
+                for read in reads:
+                    outsamfile.write(read)
+                
+                c["total"] += 1
+                
+                # Mapped if any of the fragments is mapped
+                if any(not read.is_unmapped for read in reads):
+                    c["mapped"] += 1
+                    names = mapped
+                else:
+                    c["unmapped"] += 1
+                    names = unmapped
+                
+                if write_name_sets:
+                    names.append(getReadNameHash(read_name))
+            
+            outsamfile.close()
+            samfile.close()
+        
+        finally:
+            
+            process.stdout.close()
+            returncode = process.wait()
+            
+            shutil.rmtree(samtools_temp_dir)
+            
+            # A failure in samtools also makes the reading fail
+            if returncode != 0:
+                raise ValueError("samtools failed filtering %s, see %s" % 
+                                 (infile, log_file))
+    
+    writeMappedUnmappedCounters(c, stats_outfile)
+    
+    if write_name_sets:
+        
+        out_prefix = P.snip(stats_outfile, '.tsv')
+        
+        ReadNameSet.write(out_prefix + '.mapped.names.npy', 
+                          np.frombuffer(mapped, dtype=np.uint64))
+        ReadNameSet.write(out_prefix + '.unmapped.names.npy', 
+                          np.frombuffer(unmapped, dtype=np.uint64))
+
+
+#------------------------------------------------------------------------------
+# Updates the mate details of two alignments of a read pair (as samtools 
+# fixmate): mate position and strand, template length (5' to 5') and, if
+# the pair is not plausibly a proper pair (mates on different contigs or 
+# not facing each other), removes the proper pair flag from both.
+#
+# Inputs:
+#    -read1, read2: pysam.AlignedSegment of the two mates (mapped)
+#
+# Outputs:
+#    -modifies the reads
+def syncMates(read1, read2):
+    
+    for read, mate in ((read1, read2), (read2, read1)):
+        read.is_paired = True
+        read.next_reference_id = mate.reference_id
+        read.next_reference_start = mate.reference_start
+        read.mate_is_reverse = mate.is_reverse
+        read.mate_is_unmapped = False
+    
+    five_prime1 = read1.reference_end if read1.is_reverse else read1.reference_start
+    five_prime2 = read2.reference_end if read2.is_reverse else read2.reference_start
+    
+    if read1.reference_id == read2.reference_id:
+        read1.template_length = five_prime2 - five_prime1
+        read2.template_length = five_prime1 - five_prime2
+    else:
+        read1.template_length = 0
+        read2.template_length = 0
+    
+    # Plausibly proper: same contig and the leftmost 5' end on the + strand
+    # facing the other on the - strand
+    if five_prime1 <= five_prime2:
+        first, second = read1, read2
+    else:
+        first, second = read2, read1
+    
+    if read1.reference_id != read2.reference_id or \
+       first.is_reverse or not second.is_reverse:
+        read1.is_proper_pair = False
+        read2.is_proper_pair = False
+
+
+#------------------------------------------------------------------------------
+# Goes through a Bam file SORTED BY READNAME and yields the alignments of 
+# the read pairs with a correct geometry. Equivalent to:
+#    -samtools fixmate -r (removes secondary and unmapped alignments and
+#        syncs the mate details, see syncMates; reads without mate are 
+#        flagged as mate unmapped)
+#    -samtools view -F 1804 -f 2
+#    -Removing the read pairs with the leftmost read (lowest start, R1 for 
+#        the same start, as bedtools bamtobed -bedpe) on the - strand and the
+#        other on the + strand "facing away" from each other with no overlap:
+#            <----------                    <--------
+#                      --------> Allowed             --------> Not allowed
+#        Because the enzyme introduces 4 bp in the start of + strand and 
+#        5bp in the start of the - strand, a read pair is removed when
+#        leftmost end - 1 - 5 < other start + 4, with the 5' ends of the 
+#        reads previously extended by any cuts performed in qc 
+#        (five_prime_correction).
+#
+# Inputs:
+#    -samfile: opened pysam.AlignmentFile (or any iterator of reads) sorted
+#        by readname
+#    -five_prime_correction: Number of bp trimmed from the 5' end of both 
+#        reads in qc (negative if the reads were extended)
+#
+# Outputs:
+#    -yields the reads kept
+def iterateReadsWithCorrectPairGeometry(samfile, five_prime_correction=0):
+    
+    for _, reads in iterateReadNameGroups(samfile):
+        
+        # fixmate -r
+        reads = [read for read in reads 
+                 if not read.is_secondary and not read.is_unmapped]
+        
+        primary = [read for read in reads if not read.is_supplementary]
+        
+        if len(primary) == 2:
+            syncMates(primary[0], primary[1])
+        else:
+            # Without a mate
+            for read in primary:
+                read.next_reference_id = -1
+                read.next_reference_start = -1
+                read.template_length = 0
+                if read.is_paired:
+                    read.mate_is_unmapped = True
+                    read.mate_is_reverse = False
+                    read.is_proper_pair = False
+        
+        # samtools view -F 1804 -f 2
+        reads = [read for read in reads 
+                 if not read.flag & 1804 and read.is_proper_pair]
+        
+        read1 = [read for read in reads 
+                 if read.is_read1 and not read.is_supplementary]
+        read2 = [read for read in reads 
+                 if read.is_read2 and not read.is_supplementary]
+        
+        if len(read1) == 1 and len(read2) == 1:
+            
+            left, right = read1[0], read2[0]
+            
+            if right.reference_start < left.reference_start:
+                left, right = right, left
+            
+            # Read pairs facing away
+            if left.is_reverse and not right.is_reverse and \
+               (left.reference_end - 1 + five_prime_correction - 5 < 
+                right.reference_start - five_prime_correction + 4):
+                continue
+        
+        for read in reads:
+            yield read
+
+
+#------------------------------------------------------------------------------
+# Removes orphan reads (pair was removed), read pairs mapping to different 
+# chromosomes and read pairs which are "facing against one another" with no 
+# overlap (see iterateReadsWithCorrectPairGeometry) from a Bam file sorted by
+# readname, piping the reads kept straight into samtools sort.
+#
+# Inputs:
+#    -infile: Bam file sorted by readname
+#    -outfile: Coordinate sorted Bam file with the reads kept
+#    -five_prime_correction: Number of bp trimmed from the 5' end of both 
+#        reads in qc (negative if the reads were extended)
+#    -threads: Number of threads for samtools sort and the BGZF 
+#        decompression
+#    -tmp_dir: Directory for the samtools sort temporary files
+#    -log_file: File for the samtools stderr
+#
+# Outputs:
+#    -writes the outfile
+#
+# Exception:
+#    -If samtools fails
+@cluster_runnable
+def filterPairGeometry(infile, 
+                       outfile, 
+                       five_prime_correction=0,
+                       threads=1,
+                       tmp_dir=None,
+                       log_file=os.devnull):
+    
+    # Samtools creates temporary files with a certain prefix
+    samtools_temp_dir = tempfile.mkdtemp(dir=tmp_dir)
+    samtools_temp_file = os.path.join(samtools_temp_dir, "sort")
+    
+    statement = ("samtools sort -@ %(threads)i -o %(outfile)s "
+                 "-T %(samtools_temp_file)s -" % locals())
+    
+    samfile = pysam.AlignmentFile(infile, "rb", threads=threads)
+    
+    with open(log_file, "a") as log:
+        
+        process = subprocess.Popen(statement, 
+                                   shell=True, 
+                                   stdin=subprocess.PIPE,
+                                   stderr=log)
+        
+        try:
+            
+            # Uncompressed Bam through the pipe
+            outsamfile = pysam.AlignmentFile(process.stdin, "wbu", 
+                                             template=samfile)
+            
+            for read in iterateReadsWithCorrectPairGeometry(
+                    samfile, five_prime_correction):
+                outsamfile.write(read)
+            
+            outsamfile.close()
+        
+        finally:
+            
+            samfile.close()
+            
+            process.stdin.close()
+            returncode = process.wait()
+            
+            shutil.rmtree(samtools_temp_dir)
+            
+            if returncode != 0:
+                raise ValueError("samtools failed sorting %s, see %s" % 
+                                 (outfile, log_file))
+
+
+#------------------------------------------------------------------------------
+# Gets the unclipped 5' coordinate (0 based) of a read: the start for reads
+# in the + strand or the end for reads in the - strand, including the 
+# soft/hard clipped bases (as Picard).
+def getUnclippedFivePrime(read):
+    
+    cigar = read.cigartuples
+    
+    if read.is_reverse:
+        
+        clipped = 0
+        
+        for operation, length in reversed(cigar):
+            if operation not in (4, 5):
+                break
+            clipped += length
+        
+        return read.reference_end - 1 + clipped
+    
+    clipped = 0
+    
+    for operation, length in cigar:
+        if operation not in (4, 5):
+            break
+        clipped += length
+    
+    return read.reference_start - clipped
+
+
+# Translation table setting the base qualities < 15 to 0
+BASE_QUALITIES_AT_LEAST_15 = bytes(q if q >= 15 else 0 for q in range(256))
+
+
+#------------------------------------------------------------------------------
+# Gets the sum of the base qualities >= 15 of a read, used (as Picard) to 
+# choose which read pair of a set of duplicates is kept. The qualities are
+# filtered and added up as bytes, without any per read numpy work.
+def getSumOfBaseQualities(read):
+    
+    qualities = read.query_qualities
+    
+    if qualities is None:
+        return 0
+    
+    return sum(qualities.tobytes().translate(BASE_QUALITIES_AT_LEAST_15))
+
+
+# Orientations of the read ends (as Picard ReadEnds)
+READ_ENDS_F, READ_ENDS_R, READ_ENDS_FF, READ_ENDS_FR, READ_ENDS_RR, READ_ENDS_RF = range(6)
+
+
+#------------------------------------------------------------------------------
+# Gets the orientation of a read pair from the strands of the read with the
+# lower and the read with the higher unclipped 5' coordinate
+def getPairOrientation(read1_reverse, read2_reverse):
+    
+    if read1_reverse:
+        return READ_ENDS_RR if read2_reverse else READ_ENDS_RF
+    
+    return READ_ENDS_FR if read2_reverse else READ_ENDS_FF
+
+
+#------------------------------------------------------------------------------
+# Columns of read ends (one value per read or read pair) built with 
+# array.array, turned into numpy arrays to find the duplicates.
+#
+# Inputs:
+#    -columns: list of (name, array.array typecode)
+class ReadEndsBuffer(object):
+    
+    def __init__(self, columns):
+        
+        self.columns = columns
+        self.clear()
+    
+    def clear(self):
+        
+        self.data = dict((name, array.array(typecode)) 
+                         for name, typecode in self.columns)
+    
+    def __len__(self):
+        
+        return len(self.data[self.columns[0][0]])
+    
+    def add(self, *values):
+        
+        for (name, _), value in zip(self.columns, values):
+            self.data[name].append(value)
+    
+    # Returns a dictionary with the columns as numpy arrays and empties the 
+    # buffer
+    def pop(self):
+        
+        arrays = dict((name, np.array(self.data[name])) 
+                      for name, _ in self.columns)
+        
+        self.clear()
+        
+        return arrays
+
+
+PAIR_ENDS_COLUMNS = [("library", "i"), ("reference1", "i"), ("coordinate1", "q"),
+                     ("orientation", "b"), ("reference2", "i"), 
+                     ("coordinate2", "q"), ("score", "q"), ("index1", "q"),
+                     ("index2", "q")]
+
+FRAGMENT_ENDS_COLUMNS = [("library", "i"), ("reference", "i"), 
+                         ("coordinate", "q"), ("orientation", "b"), 
+                         ("paired", "B"), ("score", "q"), ("index", "q")]
+
+
+#------------------------------------------------------------------------------
+# Packs the key columns of the read ends in a single int64 key which sorts
+# as the columns do: each column (minus its minimum) takes just the bits its
+# range needs, the first column in the most significant bits.
+#
+# Inputs:
+#    -ends: dictionary of arrays with the read ends
+#    -keys: names of the key columns
+#
+# Outputs:
+#    -returns the int64 keys or None if the columns don't fit in 63 bits
+def packReadEndKeys(ends, keys):
+    
+    packed = np.zeros(len(ends[keys[0]]), dtype=np.int64)
+    bits = 0
+    
+    for key in keys:
+        
+        values = ends[key].astype(np.int64)
+        minimum = values.min()
+        width = int(values.max() - minimum).bit_length()
+        
+        bits += width
+        
+        if bits > 63:
+            return None
+        
+        packed <<= width
+        packed |= values - minimum
+    
+    return packed
+
+
+#------------------------------------------------------------------------------
+# Sorts the read ends by the keys (one sort on the packed key, see 
+# packReadEndKeys, or on all the columns if they don't fit) and finds the
+# read end kept in each group with the same key: the one with the highest
+# score or, for the same score, the first in the file.
+#
+# Inputs:
+#    -ends: dictionary of arrays with the read ends
+#    -keys: names of the key columns
+#    -index: name of the column with the index in the file
+#
+# Outputs:
+#    -returns the sort order and two boolean arrays (in sort order), True 
+#        for the first read end of each key and for the read end kept
+def sortReadEnds(ends, keys, index):
+    
+    packed = packReadEndKeys(ends, keys)
+    
+    if packed is not None:
+        
+        order = np.argsort(packed)
+        
+        packed = packed[order]
+        first = np.empty(len(order), dtype=bool)
+        first[:1] = True
+        first[1:] = packed[1:] != packed[:-1]
+    
+    else:
+        
+        order = np.lexsort([ends[key] for key in reversed(keys)])
+        
+        first = np.zeros(len(order), dtype=bool)
+        first[:1] = True
+        
+        for key in keys:
+            
+            values = ends[key][order]
+            first[1:] |= values[1:] != values[:-1]
+    
+    starts = np.flatnonzero(first)
+    group = np.cumsum(first) - 1
+    
+    score = ends["score"][order]
+    file_index = ends[index][order]
+    
+    best_score = np.maximum.reduceat(score, starts)[group]
+    
+    # The first in the file of the read ends with the best score
+    candidate_index = np.where(score == best_score, file_index, 
+                               np.iinfo(np.int64).max)
+    kept_index = np.minimum.reduceat(candidate_index, starts)[group]
+    
+    kept = file_index == kept_index
+    
+    return order, first, kept
+
+
+#------------------------------------------------------------------------------
+# Finds the duplicate read pairs (as Picard MarkDuplicates): the read pairs
+# with the same library, contig and unclipped 5' coordinate of both reads and
+# orientation are duplicates of each other, only the one with the highest
+# score (sum of base qualities), or the first in the file for the same 
+# score, is not a duplicate.
+#
+# Inputs:
+#    -pairs: dictionary of arrays with the PAIR_ENDS_COLUMNS
+#
+# Outputs:
+#    -returns the array of the indexes in the file of the duplicate reads
+def findDuplicatePairs(pairs):
+    
+    if len(pairs["index1"]) == 0:
+        return np.zeros(0, dtype=np.int64)
+    
+    order, _, kept = sortReadEnds(pairs, 
+                                  ["library", "reference1", "coordinate1", 
+                                   "orientation", "reference2", "coordinate2"],
+                                  "index1")
+    
+    duplicate = order[~kept]
+    
+    return np.concatenate((pairs["index1"][duplicate], 
+                           pairs["index2"][duplicate]))
+
+
+#------------------------------------------------------------------------------
+# Finds the duplicate unpaired reads (as Picard MarkDuplicates): reads with
+# the same library, contig, unclipped 5' coordinate and strand as a read 
+# from a read pair are duplicates, otherwise only the one with the highest 
+# score, or the first in the file, of the unpaired reads with the same key 
+# is not a duplicate.
+#
+# Inputs:
+#    -fragments: dictionary of arrays with the FRAGMENT_ENDS_COLUMNS, with
+#        both the unpaired reads and the reads from read pairs
+#
+# Outputs:
+#    -returns the array of the indexes in the file of the duplicate reads
+def findDuplicateFragments(fragments):
+    
+    if len(fragments["index"]) == 0:
+        return np.zeros(0, dtype=np.int64)
+    
+    order, first, kept = sortReadEnds(fragments, 
+                                      ["library", "reference", "coordinate", 
+                                       "orientation"],
+                                      "index")
+    
+    paired = fragments["paired"][order] > 0
+    
+    # Whether there is any read pair in the group of each read end
+    starts = np.flatnonzero(first)
+    group = np.cumsum(first) - 1
+    group_paired = np.maximum.reduceat(paired.astype(np.uint8), starts) > 0
+    
+    duplicate = ~paired & (group_paired[group] | ~kept)
+    
+    return fragments["index"][order[duplicate]]
+
+
+#------------------------------------------------------------------------------
+# Picard ESTIMATED_LIBRARY_SIZE: estimates the size of a library from the
+# number of read pairs and unique read pairs, using the Lander-Waterman 
+# equation. Returns None if it can't be estimated (no duplicates).
+def estimateLibrarySize(read_pairs, unique_read_pairs):
+    
+    read_pair_duplicates = read_pairs - unique_read_pairs
+    
+    if read_pairs <= 0 or read_pair_duplicates <= 0:
+        return None
+    
+    n = float(read_pairs)
+    c = float(unique_read_pairs)
+    
+    def f(x):
+        return c / x - 1 + np.exp(-n / x)
+    
+    m = 1.0
+    M = 100.0
+    
+    if c >= n or f(m * c) < 0:
+        raise ValueError("Invalid values for pairs and unique pairs: %i, %i" %
+                         (read_pairs, unique_read_pairs))
+    
+    while f(M * c) >= 0:
+        M *= 10.0
+    
+    for _ in range(40):
+        
+        r = (m + M) / 2.0
+        u = f(r * c)
+        
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    
+    return int(c * (m + M) / 2.0)
+
+
+#------------------------------------------------------------------------------
+# Formats a value as Picard metrics files do
+def formatPicardMetric(value):
+    
+    if value is None:
+        return ""
+    
+    if isinstance(value, float):
+        if np.isnan(value):
+            return "?"
+        return ("%.6f" % value).rstrip("0").rstrip(".") if value != 0 else "0"
+    
+    return str(value)
+
+
+#------------------------------------------------------------------------------
+# Writes a Picard MarkDuplicates (1.141) style metrics file, with one line 
+# per library and, for a single library, the histogram of the estimated 
+# return of investment of sequencing x times more.
+#
+# Inputs:
+#    -metrics: dictionary library: Counter with the metrics
+#    -metrics_file: Outfile
+#    -command_line: Command line written in the header
+def writeDuplicationMetrics(metrics, metrics_file, command_line):
+    
+    columns = ["LIBRARY", "UNPAIRED_READS_EXAMINED", "READ_PAIRS_EXAMINED", 
+               "UNMAPPED_READS", "UNPAIRED_READ_DUPLICATES", 
+               "READ_PAIR_DUPLICATES", "READ_PAIR_OPTICAL_DUPLICATES",
+               "PERCENT_DUPLICATION", "ESTIMATED_LIBRARY_SIZE"]
+    
+    lines = []
+    
+    for library, c in metrics.items():
+        
+        values = {"LIBRARY": library,
+                  "UNPAIRED_READS_EXAMINED": c["unpaired_reads"],
+                  "READ_PAIRS_EXAMINED": c["paired_reads"] // 2,
+                  "UNMAPPED_READS": c["unmapped_reads"],
+                  "UNPAIRED_READ_DUPLICATES": c["unpaired_duplicates"],
+                  "READ_PAIR_DUPLICATES": c["paired_duplicates"] // 2,
+                  "READ_PAIR_OPTICAL_DUPLICATES": 0}
+        
+        examined = (values["UNPAIRED_READS_EXAMINED"] + 
+                    values["READ_PAIRS_EXAMINED"] * 2)
+        
+        if examined > 0:
+            values["PERCENT_DUPLICATION"] = (
+                (values["UNPAIRED_READ_DUPLICATES"] + 
+                 values["READ_PAIR_DUPLICATES"] * 2) / float(examined))
+        else:
+            values["PERCENT_DUPLICATION"] = float("nan")
+        
+        values["ESTIMATED_LIBRARY_SIZE"] = estimateLibrarySize(
+            values["READ_PAIRS_EXAMINED"] - values["READ_PAIR_OPTICAL_DUPLICATES"],
+            values["READ_PAIRS_EXAMINED"] - values["READ_PAIR_DUPLICATES"])
+        
+        lines.append(values)
+    
+    with IOTools.open_file(metrics_file, "w") as output_file_write:
+        
+        output_file_write.write("## htsjdk.samtools.metrics.StringHeader\n")
+        output_file_write.write("# %s\n" % command_line)
+        output_file_write.write("\n## METRICS CLASS\tpicard.sam.DuplicationMetrics\n")
+        output_file_write.write("\t".join(columns) + "\n")
+        
+        for values in lines:
+            output_file_write.write(
+                "\t".join(formatPicardMetric(values[column]) 
+                          for column in columns) + "\n")
+        
+        if len(lines) == 1 and lines[0]["ESTIMATED_LIBRARY_SIZE"]:
+            
+            library_size = float(lines[0]["ESTIMATED_LIBRARY_SIZE"])
+            read_pairs = lines[0]["READ_PAIRS_EXAMINED"]
+            unique_read_pairs = read_pairs - lines[0]["READ_PAIR_DUPLICATES"]
+            
+            output_file_write.write("\n## HISTOGRAM\tjava.lang.Double\n")
+            output_file_write.write("BIN\tVALUE\n")
+            
+            for x in range(1, 101):
+                roi = (library_size * 
+                       (1 - np.exp(-(x * read_pairs) / library_size)) / 
+                       unique_read_pairs)
+                output_file_write.write("%.1f\t%s\n" % 
+                                        (x, formatPicardMetric(float(roi))))
+        
+        output_file_write.write("\n")
+
+
+#------------------------------------------------------------------------------
+# Marks the duplicates (0x400 flag, not deleted) of a coordinate sorted Bam 
+# file as Picard MarkDuplicates does for paired end data, without optical 
+# duplicate detection, in two passes through the file:
+#    -First pass: the unclipped 5' coordinates, strands and scores of the 
+#        reads are collected and paired (by readname) as they come, the
+#        read ends of each contig being sorted once on a packed integer key
+#        (see sortReadEnds) to find the duplicates when the contig is 
+#        finished.
+#    -Second pass: the duplicate flag is set on the duplicate primary 
+#        alignments (and removed from any other alignment) and the 
+#        Picard style metrics are counted.
+#
+# Inputs:
+#    -infile: Coordinate sorted Bam file
+#    -outfile: Bam file with the duplicates marked
+#    -metrics_file: Outfile with the duplication metrics
+#    -threads: Number of threads for the BGZF decompression/compression
+#
+# Outputs:
+#    -writes the outfile and the metrics file
+@cluster_runnable
+def markDuplicatesPairedEnd(infile, outfile, metrics_file, threads=1):
+    
+    samfile = pysam.AlignmentFile(infile, "rb", threads=threads)
+    
+    header = samfile.header.to_dict()
+    
+    # Libraries of the read groups
+    read_group_libraries = dict((read_group["ID"], 
+                                 read_group.get("LB", "Unknown Library"))
+                                for read_group in header.get("RG", []))
+    
+    libraries = sorted(set(read_group_libraries.values())) or ["Unknown Library"]
+    library_ids = dict((library, i) for i, library in enumerate(libraries))
+    
+    def getLibraryId(read):
+        
+        if read.has_tag("RG"):
+            return library_ids.get(
+                read_group_libraries.get(read.get_tag("RG")), 0)
+        
+        return 0
+    
+    pairs = ReadEndsBuffer(PAIR_ENDS_COLUMNS)
+    fragments = ReadEndsBuffer(FRAGMENT_ENDS_COLUMNS)
+    
+    # Pairs with the reads in different contigs, only complete at the end
+    cross_contig_pairs = ReadEndsBuffer(PAIR_ENDS_COLUMNS)
+    
+    # Read ends waiting for their mate
+    pending = {}
+    
+    duplicates = []
+    
+    current_contig = None
+    
+    for index, read in enumerate(samfile):
+        
+        if read.is_unmapped:
+            
+            # Unmapped reads at the end of the file
+            if read.reference_id == -1:
+                break
+            
+            continue
+        
+        if read.is_secondary or read.is_supplementary:
+            continue
+        
+        # The contig is finished, all its read ends have been seen
+        if read.reference_id != current_contig:
+            
+            duplicates.append(findDuplicatePairs(pairs.pop()))
+            duplicates.append(findDuplicateFragments(fragments.pop()))
+            
+            current_contig = read.reference_id
+        
+        library_id = getLibraryId(read)
+        coordinate = getUnclippedFivePrime(read)
+        score = getSumOfBaseQualities(read)
+        is_paired = read.is_paired and not read.mate_is_unmapped
+        
+        fragments.add(library_id, read.reference_id, coordinate, 
+                      READ_ENDS_R if read.is_reverse else READ_ENDS_F,
+                      is_paired, score, index)
+        
+        if not is_paired:
+            continue
+        
+        key = (read.get_tag("RG") if read.has_tag("RG") else None, 
+               read.query_name)
+        
+        mate = pending.pop(key, None)
+        
+        if mate is None:
+            pending[key] = (read.reference_id, coordinate, read.is_reverse, 
+                            score, index)
+            continue
+        
+        mate_contig, mate_coordinate, mate_reverse, mate_score, mate_index = mate
+        
+        # The read with the lower unclipped 5' coordinate goes first
+        if (read.reference_id > mate_contig or 
+            (read.reference_id == mate_contig and 
+             coordinate >= mate_coordinate)):
+            end1 = (mate_contig, mate_coordinate, mate_reverse, mate_index)
+            end2 = (read.reference_id, coordinate, read.is_reverse, index)
+        else:
+            end1 = (read.reference_id, coordinate, read.is_reverse, index)
+            end2 = (mate_contig, mate_coordinate, mate_reverse, mate_index)
+        
+        if mate_contig == read.reference_id:
+            buffer = pairs
+        else:
+            buffer = cross_contig_pairs
+        
+        buffer.add(library_id, end1[0], end1[1], 
+                   getPairOrientation(end1[2], end2[2]), end2[0], end2[1],
+                   score + mate_score, end1[3], end2[3])
+    
+    samfile.close()
+    
+    duplicates.append(findDuplicatePairs(pairs.pop()))
+    duplicates.append(findDuplicateFragments(fragments.pop()))
+    duplicates.append(findDuplicatePairs(cross_contig_pairs.pop()))
+    
+    duplicates = np.unique(np.concatenate(duplicates))
+    
+    # Second pass: mark the duplicates and count the metrics
+    samfile = pysam.AlignmentFile(infile, "rb", threads=threads)
+    
+    header.setdefault("PG", []).append(
+        {"ID": "MarkDuplicates", "PN": "pipelineAtacseq.markDuplicatesPairedEnd"})
+    
+    outsamfile = pysam.AlignmentFile(outfile, "wb", header=header,
+                                     threads=threads)
+    
+    metrics = collections.OrderedDict(
+        (library, collections.Counter()) for library in libraries)
+    
+    next_duplicate = 0
+    
+    for index, read in enumerate(samfile):
+        
+        is_duplicate = (next_duplicate < len(duplicates) and 
+                        duplicates[next_duplicate] == index)
+        
+        if is_duplicate:
+            next_duplicate += 1
+        
+        read.is_duplicate = is_duplicate
+        
+        if not read.is_secondary and not read.is_supplementary:
+            
+            c = metrics[libraries[getLibraryId(read)]]
+            
+            if read.is_unmapped:
+                c["unmapped_reads"] += 1
+            elif not read.is_paired or read.mate_is_unmapped:
+                c["unpaired_reads"] += 1
+                if is_duplicate:
+                    c["unpaired_duplicates"] += 1
+            else:
+                c["paired_reads"] += 1
+                if is_duplicate:
+                    c["paired_duplicates"] += 1
+        
+        outsamfile.write(read)
+    
+    outsamfile.close()
+    samfile.close()
+    
+    writeDuplicationMetrics(
+        metrics, metrics_file,
+        "pipelineAtacseq.markDuplicatesPairedEnd INPUT=%s OUTPUT=%s "
+        "METRICS_FILE=%s REMOVE_DUPLICATES=false" % 
+        (infile, outfile, metrics_file))
+
+
+#------------------------------------------------------------------------------
+# Calculates the library complexity (NRF, PBC1, PBC2) of a coordinate sorted
+# paired end Bam file without sorting it by readname, as:
+#    bedtools bamtobed -bedpe | (fragment: contig, start of the leftmost read,
+#    end of the other read, strands) | grep -v chrM | sort | uniq -c 
+# The reads are paired by readname as they come and the fragments are 
+# counted in a hash map grouped by their start. As identical fragments
+# share their start, the counts of the fragments starting before the 
+# current position (and before any read still waiting for its mate) are 
+# final and are moved to the multiplicity histogram, so only the fragments
+# around the current position are held in memory.
+#
+# Inputs:
+#    -infile: Coordinate sorted Bam file
+#    -outfile: Outfile with the header and:
+#        TotalReadPairs DistinctReadPairs OneReadPair TwoReadPairs 
+#        NRF=Distinct/Total PBC1=OnePair/Distinct PBC2=OnePair/TwoPair
+#    -histogram_outfile: Outfile with the number of distinct fragments 
+#        (distinct_fragments) seen each number of times (multiplicity)
+#    -excluded_contigs: Fragments on contigs matching this are excluded 
+#        (see ContigRegistry)
+#    -threads: Number of threads for the BGZF decompression
+#
+# Outputs:
+#    -writes the outfile and the histogram_outfile
+@cluster_runnable
+def calculateLibraryComplexity(infile, 
+                               outfile, 
+                               histogram_outfile,
+                               excluded_contigs="chrM",
+                               threads=1):
+    
+    samfile = pysam.AlignmentFile(infile, "rb", threads=threads)
+    
+    references = samfile.references
+    
+    # Indexed by reference_id
+    excluded = ContigRegistry.fromBamHeader(samfile, 
+                                            excluded_contigs).excluded.tolist()
+    
+    # Number of fragments seen each number of times
+    histogram = collections.Counter()
+    
+    # Counts of the fragments in the current contig by start:
+    # start: Counter((end, strand1, strand2))
+    fragments = {}
+    fragment_starts = []
+    
+    # Fragments with the reads on different contigs
+    cross_contig_fragments = collections.Counter()
+    
+    # Reads waiting for their mate
+    pending = {}
+    pending_starts = []
+    
+    current_contig = None
+    
+    # Reads processed since the last flush
+    processed = 0
+    
+    # Moves the counts of the fragments starting before limit to the 
+    # histogram
+    def flush(limit):
+        
+        while fragment_starts and fragment_starts[0] < limit:
+            
+            for count in fragments.pop(heapq.heappop(fragment_starts)).values():
+                histogram[count] += 1
+    
+    for read in samfile:
+        
+        if read.is_unmapped or read.is_secondary or read.is_supplementary or \
+           not read.is_paired or read.mate_is_unmapped:
+            continue
+        
+        processed += 1
+        
+        if read.reference_id != current_contig:
+            
+            flush(float("inf"))
+            
+            # Reads from the previous contig still waiting are not taken 
+            # into account to flush
+            pending_starts = []
+            
+            current_contig = read.reference_id
+        
+        read_name = read.query_name
+        
+        mate = pending.pop(read_name, None)
+        
+        if mate is None:
+            
+            pending[read_name] = (read.reference_id, read.reference_start,
+                                  read.reference_end, read.is_reverse, 
+                                  read.is_read1)
+            
+            heapq.heappush(pending_starts, (read.reference_start, read_name))
+        
+        elif mate[0] != read.reference_id:
+            
+            # bedtools order: read 1 first, swapped if the contig name of 
+            # read 2 is lower
+            ends = [(references[mate[0]], mate[1], mate[2], mate[3]),
+                    (references[read.reference_id], read.reference_start, 
+                     read.reference_end, read.is_reverse)]
+            
+            if not mate[4]:
+                ends.reverse()
+            
+            if ends[0][:2] > ends[1][:2]:
+                ends.reverse()
+            
+            if not excluded[mate[0]] and not excluded[read.reference_id]:
+                cross_contig_fragments[(ends[0][0], ends[0][1], ends[1][0], 
+                                        ends[1][2], ends[0][3], 
+                                        ends[1][3])] += 1
+        
+        elif not excluded[read.reference_id]:
+            
+            # The leftmost read goes first, read 1 for the same start
+            left = mate[1:4]
+            right = (read.reference_start, read.reference_end, 
+                     read.is_reverse)
+            
+            if left[0] == right[0] and not mate[4]:
+                left, right = right, left
+            
+            # Both reads in the same place are counted as +/-
+            if left[:2] == right[:2]:
+                key = (right[1], False, True)
+            else:
+                key = (right[1], left[2], right[2])
+            
+            start = left[0]
+            
+            if start not in fragments:
+                fragments[start] = collections.Counter()
+                heapq.heappush(fragment_starts, start)
+            
+            fragments[start][key] += 1
+        
+        # Every 100000 reads processed, flush the fragments which can't be 
+        # seen again
+        if processed >= 100000:
+            
+            processed = 0
+            
+            while pending_starts and \
+                  (pending_starts[0][1] not in pending or 
+                   pending[pending_starts[0][1]][1] != pending_starts[0][0]):
+                heapq.heappop(pending_starts)
+            
+            limit = read.reference_start
+            
+            if pending_starts:
+                limit = min(limit, pending_starts[0][0])
+            
+            flush(limit)
+    
+    samfile.close()
+    
+    flush(float("inf"))
+    
+    for count in cross_contig_fragments.values():
+        histogram[count] += 1
+    
+    total = sum(multiplicity * n for multiplicity, n in histogram.items())
+    distinct = sum(histogram.values())
+    one_pair = histogram[1]
+    two_pairs = histogram[2]
+    
+    def ratio(numerator, denominator):
+        
+        if denominator == 0:
+            return float("nan")
+        
+        return float(numerator) / denominator
+    
+    header = ("TotalReadPairs\tDistinctReadPairs\tOneReadPair\tTwoReadPairs\t"
+              "NRF=Distinct/Total\tPBC1=OnePair/Distinct\tPBC2=OnePair/TwoPair")
+    
+    with IOTools.open_file(outfile, "w") as output_file_write:
+        
+        output_file_write.write(header + "\n")
+        output_file_write.write("%d\t%d\t%d\t%d\t%f\t%f\t%f\n" % 
+                                (total, distinct, one_pair, two_pairs, 
+                                 ratio(distinct, total), 
+                                 ratio(one_pair, distinct),
+                                 ratio(one_pair, two_pairs)))
+    
+    with IOTools.open_file(histogram_outfile, "w") as output_file_write:
+        
+        output_file_write.write("multiplicity\tdistinct_fragments\n")
+        
+        for multiplicity in sorted(histogram):
+            output_file_write.write("%i\t%i\n" % 
+                                    (multiplicity, histogram[multiplicity]))
+
+
+#------------------------------------------------------------------------------
+# Counters of samtools flagstat, filled one read at a time
+class FlagstatCounter(object):
+    
+    fields = ["reads", "secondary", "supplementary", "duplicates", "mapped", 
+              "paired", "read1", "read2", "properly_paired", 
+              "with_mate_mapped", "singletons", "mate_different_chr", 
+              "mate_different_chr_mapq5"]
+    
+    def __init__(self):
+        
+        # [QC-passed, QC-failed] for each field
+        self.counts = dict((field, [0, 0]) for field in self.fields)
+    
+    def add(self, read):
+        
+        c = self.counts
+        flag = read.flag
+        w = 1 if flag & 512 else 0
+        
+        c["reads"][w] += 1
+        
+        if flag & 256:
+            c["secondary"][w] += 1
+        elif flag & 2048:
+            c["supplementary"][w] += 1
+        elif flag & 1:
+            
+            c["paired"][w] += 1
+            
+            if flag & 2 and not flag & 4:
+                c["properly_paired"][w] += 1
+            
+            if flag & 64:
+                c["read1"][w] += 1
+            
+            if flag & 128:
+                c["read2"][w] += 1
+            
+            if flag & 8 and not flag & 4:
+                c["singletons"][w] += 1
+            
+            if not flag & 4 and not flag & 8:
+                
+                c["with_mate_mapped"][w] += 1
+                
+                if read.next_reference_id != read.reference_id:
+                    
+                    c["mate_different_chr"][w] += 1
+                    
+                    if read.mapping_quality >= 5:
+                        c["mate_different_chr_mapq5"][w] += 1
+        
+        if not flag & 4:
+            c["mapped"][w] += 1
+        
+        if flag & 1024:
+            c["duplicates"][w] += 1
+    
+    # Percentage as samtools (single precision division)
+    @staticmethod
+    def percent(n, total):
+        
+        if total == 0:
+            return "N/A"
+        
+        return "%.2f%%" % (float(np.float32(n) / np.float32(total)) * 100.0)
+    
+    # Writes the counters in the samtools flagstat (1.9) format
+    def write(self, outfile):
+        
+        c = self.counts
+        
+        lines = [
+            "%i + %i in total (QC-passed reads + QC-failed reads)" % tuple(c["reads"]),
+            "%i + %i secondary" % tuple(c["secondary"]),
+            "%i + %i supplementary" % tuple(c["supplementary"]),
+            "%i + %i duplicates" % tuple(c["duplicates"]),
+            "%i + %i mapped (%s : %s)" % (
+                c["mapped"][0], c["mapped"][1],
+                self.percent(c["mapped"][0], c["reads"][0]),
+                self.percent(c["mapped"][1], c["reads"][1])),
+            "%i + %i paired in sequencing" % tuple(c["paired"]),
+            "%i + %i read1" % tuple(c["read1"]),
+            "%i + %i read2" % tuple(c["read2"]),
+            "%i + %i properly paired (%s : %s)" % (
+                c["properly_paired"][0], c["properly_paired"][1],
+                self.percent(c["properly_paired"][0], c["paired"][0]),
+                self.percent(c["properly_paired"][1], c["paired"][1])),
+            "%i + %i with itself and mate mapped" % tuple(c["with_mate_mapped"]),
+            "%i + %i singletons (%s : %s)" % (
+                c["singletons"][0], c["singletons"][1],
+                self.percent(c["singletons"][0], c["paired"][0]),
+                self.percent(c["singletons"][1], c["paired"][1])),
+            "%i + %i with mate mapped to a different chr" % tuple(c["mate_different_chr"]),
+            "%i + %i with mate mapped to a different chr (mapQ>=5)" % tuple(c["mate_different_chr_mapq5"])]
+        
+        with IOTools.open_file(outfile, "w") as output_file_write:
+            output_file_write.write("\n".join(lines) + "\n")
+
+
+#------------------------------------------------------------------------------
+# Goes once through a coordinate sorted Bam file with the duplicates marked
+# and, for the reads passing samtools view -F 1804 -f 2, writes at the same
+# time:
+#    -The position sorted Bam file and its index
+#    -The samtools flagstat of the position sorted Bam file
+#    -Optionally, the read name sorted Bam file (the reads are piped to 
+#        samtools sort -n)
+#
+# Inputs:
+#    -infile: Coordinate sorted Bam file with the duplicates marked
+#    -position_sorted_bam: Outfile with the filtered reads
+#    -flagstats_outfile: Outfile with the flagstat
+#    -name_sorted_bam: If specified, outfile with the filtered reads sorted
+#        by readname
+#    -threads: Number of threads for the BGZF decompression/compression and
+#        samtools sort
+#    -tmp_dir: Directory for the samtools sort temporary files
+#    -log_file: File for the samtools stderr
+#
+# Outputs:
+#    -writes the outfiles
+#
+# Exception:
+#    -If samtools fails
+@cluster_runnable
+def fanOutDeduplicated(infile, 
+                       position_sorted_bam,
+                       flagstats_outfile,
+                       name_sorted_bam=None,
+                       threads=1,
+                       tmp_dir=None,
+                       log_file=os.devnull):
+    
+    samfile = pysam.AlignmentFile(infile, "rb", threads=threads)
+    
+    position_sorted = pysam.AlignmentFile(position_sorted_bam, "wb", 
+                                          template=samfile, threads=threads)
+    
+    flagstat = FlagstatCounter()
+    
+    if name_sorted_bam is not None:
+        
+        # Samtools creates temporary files with a certain prefix
+        samtools_temp_dir = tempfile.mkdtemp(dir=tmp_dir)
+        samtools_temp_file = os.path.join(samtools_temp_dir, "sort")
+        
+        statement = ("samtools sort -n -@ %(threads)i -o %(name_sorted_bam)s "
+                     "-T %(samtools_temp_file)s -" % locals())
+        
+        log = open(log_file, "a")
+        
+        process = subprocess.Popen(statement, 
+                                   shell=True, 
+                                   stdin=subprocess.PIPE,
+                                   stderr=log)
+        
+        # Uncompressed Bam through the pipe
+        name_sorted = pysam.AlignmentFile(process.stdin, "wbu", 
+                                          template=samfile)
+    
+    try:
+        
+        for read in samfile:
+            
+            # samtools view -F 1804 -f 2
+            if read.flag & 1804 or not read.flag & 2:
+                continue
+            
+            position_sorted.write(read)
+            
+            flagstat.add(read)
+            
+            if name_sorted_bam is not None:
+                name_sorted.write(read)
+    
+    finally:
+        
+        samfile.close()
+        position_sorted.close()
+        
+        if name_sorted_bam is not None:
+            
+            name_sorted.close()
+            
+            process.stdin.close()
+            returncode = process.wait()
+            
+            log.close()
+            
+            shutil.rmtree(samtools_temp_dir)
+            
+            if returncode != 0:
+                raise ValueError("samtools failed sorting %s, see %s" % 
+                                 (name_sorted_bam, log_file))
+    
+    pysam.index(position_sorted_bam)
+    
+    flagstat.write(flagstats_outfile)
+
+
+#------------------------------------------------------------------------------
+# Creates a statement to exclude from the infile the chrs
+# indicated in excluded_chrs and saves the processed file to outfile
+#
+# Inputs:
+#    -infile: peaks infile (compressed or uncompressed) to process.
+#    -excluded_chrs: list of chrs to exclude (separated by ,)
+#    -outfile: processed file without the chrs regions.
+#
+# Outputs:
+#    -Writes the processed file to outfile.
+def createExcludingChrFromBedStatement(infile, excluded_chrs, outfile):
+    
+    statement = ""
+    
+    # If no excluded chrs provided just copy the file
+    if excluded_chrs == "":
+        statement = "cp "+infile+" "+outfile
+   
+    else:        
+        
+        # See the extension of the file to determine the cat/zcat command
+        _, file_extension = os.path.splitext(infile)
+        
+        if file_extension == ".gz":
+            statement = "zcat "  
+        else:   
+            statement = "cat "
+            
+        # Create the statement
+        statement += infile
+        statement += " | egrep -v '("
+        statement += excluded_chrs
+        statement += ")' | gzip -c > "
+        statement += outfile
+
+    return statement
+
+
+#------------------------------------------------------------------------------
+# Given a contig_name, gets the corresponding length of the contig looking into 
+# contig_file for the corresponding contig_name. If it doesn't find it, returns
+# -1.
+#
+# contig_file format:
+# chr1    2500000
+# chr2    170000
+# 
+# Inputs:
+#    -contig_name: Name of the contig
+#    -contig_file: Name of the contig file
+#
+# Outputs:
+#    -contig_length: The length of the contig. If it doesn't find it, returns -1.
+def getContigLength(contig_name, contig_file):
+    
+    contig_length = -1
+    with open(contig_file, 'r') as reader:
+                    
+        for line in reader:  
+            # Remove the new line character from the line (avoids taking this into account downstream)
+            line = line.rstrip('\n') 
+            fields = line.split("\t")
+            
+            if( fields[0] == contig_name):
+                # Get the fragment length
+                contig_length = fields[1]
+                break
+            
+    return contig_length
+
+
+#------------------------------------------------------------------------------
+# Contigs with compact integer IDs (the order in which they are registered),
+# their lengths and whether they are excluded, so that the interval code
+# compares integers instead of contig names. 
+#
+# The contigs can be registered from a contig file (contig \t length pairs, 
+# see getContigLength, if a contig is repeated the first length is kept) or 
+# from the header of a Bam file (the IDs are then the reference_id of the
+# reads). Contigs registered without a known length have length -1.
+#
+# The excluded contigs are the ones matching excluded_contigs (separated by |)
+# with partial matching, as egrep in createExcludingChrFromBedStatement.
+#
+# Inputs:
+#    -contigs: (contig, length) pairs to register
+#    -excluded_contigs: contigs to exclude (separated by |)
+class ContigRegistry(object):
+    
+    def __init__(self, contigs=(), excluded_contigs=""):
+        
+        self.names = []
+        self.ids = {}
+        
+        # Indexed by contig ID
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.excluded = np.zeros(0, dtype=bool)
+        
+        if excluded_contigs == "":
+            self.excluded_pattern = None
+        else:
+            self.excluded_pattern = re.compile("(%s)" % excluded_contigs)
+        
+        self.register(contigs)
+    
+    @staticmethod
+    def fromFile(contig_file, excluded_contigs=""):
+        
+        contigs = []
+        
+        with IOTools.open_file(contig_file, "r") as reader:
+            
+            for line in reader:
+                
+                fields = line.rstrip("\n").split("\t")
+                
+                if len(fields) < 2:
+                    continue
+                
+                contigs.append((fields[0], int(fields[1])))
+        
+        return ContigRegistry(contigs, excluded_contigs)
+    
+    @staticmethod
+    def fromBamHeader(samfile, excluded_contigs=""):
+        
+        return ContigRegistry(zip(samfile.references, samfile.lengths), 
+                              excluded_contigs)
+    
+    def __len__(self):
+        
+        return len(self.names)
+    
+    def __contains__(self, contig):
+        
+        return contig in self.ids
+    
+    # Registers the (contig, length) pairs not registered yet, returns a
+    # numpy array with the IDs of all of them
+    def register(self, contigs):
+        
+        ids = []
+        new_lengths = []
+        new_excluded = []
+        
+        for contig, length in contigs:
+            
+            if contig not in self.ids:
+                
+                self.ids[contig] = len(self.names)
+                self.names.append(contig)
+                
+                new_lengths.append(length)
+                new_excluded.append(self.excluded_pattern is not None and 
+                                    self.excluded_pattern.search(contig) is not None)
+            
+            ids.append(self.ids[contig])
+        
+        if len(new_lengths) > 0:
+            
+            self.lengths = np.concatenate([self.lengths, 
+                                           np.array(new_lengths, dtype=np.int64)])
+            self.excluded = np.concatenate([self.excluded, 
+                                            np.array(new_excluded, dtype=bool)])
+        
+        return np.array(ids, dtype=np.int64)
+    
+    # ID of the contig, -1 if not registered
+    def getId(self, contig):
+        
+        return self.ids.get(contig, -1)
+    
+    # numpy array with the IDs of the contigs, -1 for the ones not registered.
+    # If register, the contigs not registered are registered with length -1.
+    def getIds(self, contigs, register=False):
+        
+        if register:
+            return self.register((contig, -1) for contig in contigs)
+        
+        return np.array([self.ids.get(contig, -1) for contig in contigs], 
+                        dtype=np.int64)
+    
+    def getName(self, contig_id):
+        
+        return self.names[contig_id]
+    
+    def getLength(self, contig_id):
+        
+        return int(self.lengths[contig_id])
+    
+    def isExcluded(self, contig_id):
+        
+        return bool(self.excluded[contig_id])
+
+
+#------------------------------------------------------------------------------
+# Manifest of a tagAlign/bed file: number of records (lines), size and md5 of
+# the uncompressed contents and size of the file. It is written next to the
+# file (<file>.manifest.json) when the file is written with a ManifestWriter,
+# so that the records don't need to be counted again downstream.
+#
+# Inputs:
+#    -infile: tagAlign/bed file
+#
+# Outputs:
+#    -manifest_file: Name of the manifest of the file
+def getManifestFile(infile):
+    
+    return infile + ".manifest.json"
+
+
+#------------------------------------------------------------------------------
+# Reads the manifest of a file (see getManifestFile). The manifest is only
+# used if the size of the file is the one recorded.
+#
+# Inputs:
+#    -infile: tagAlign/bed file
+#
+# Outputs:
+#    -manifest: dictionary with records, uncompressed_bytes, md5 and bytes.
+#        None if there is no manifest or it doesn't correspond to the file.
+def readManifest(infile):
+    
+    manifest_file = getManifestFile(infile)
+    
+    if not os.path.exists(manifest_file):
+        return None
+    
+    with open(manifest_file, "r") as reader:
+        manifest = json.load(reader)
+    
+    if manifest.get("bytes") != os.path.getsize(infile):
+        return None
+    
+    return manifest
+
+
+#------------------------------------------------------------------------------
+# Gets the number of records (lines) of a tagAlign/bed file from its 
+# manifest, only if there is no manifest the file is read to count them.
+#
+# Inputs:
+#    -infile: tagAlign/bed file (compressed or uncompressed)
+#
+# Outputs:
+#    -records: number of lines of the file
+def countRecords(infile):
+    
+    manifest = readManifest(infile)
+    
+    if manifest is not None:
+        return manifest["records"]
+    
+    records = 0
+    
+    with openCompressedFile(infile, "r") as reader:
+        for line in reader:
+            records += 1
+    
+    return records
+
+
+#------------------------------------------------------------------------------
+# Writes a tagAlign/bed file (BGZF compressed if the name ends with .gz, see
+# openCompressedFile) keeping the counts for its manifest, which is written 
+# when the file is closed.
+#
+# Inputs:
+#    -outfile: tagAlign/bed file
+#    -threads: Number of threads compressing the file
+#    -compresslevel: zlib compression level
+class ManifestWriter(object):
+    
+    def __init__(self, outfile, threads=1, compresslevel=FINAL_COMPRESSION_LEVEL):
+        
+        self.outfile = outfile
+        self.writer = openCompressedFile(outfile, "w", threads=threads, 
+                                         compresslevel=compresslevel)
+        
+        self.records = 0
+        self.uncompressed_bytes = 0
+        self.md5 = hashlib.md5()
+    
+    def __enter__(self):
+        
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        
+        self.close()
+    
+    def write(self, text):
+        
+        data = text.encode("utf-8")
+        
+        self.records += text.count("\n")
+        self.uncompressed_bytes += len(data)
+        self.md5.update(data)
+        
+        self.writer.write(text)
+    
+    def close(self):
+        
+        if self.writer is None:
+            return
+        
+        self.writer.close()
+        self.writer = None
+        
+        manifest = collections.OrderedDict([
+            ("records", self.records),
+            ("uncompressed_bytes", self.uncompressed_bytes),
+            ("md5", self.md5.hexdigest()),
+            ("bytes", os.path.getsize(self.outfile))])
+        
+        with open(getManifestFile(self.outfile), "w") as writer:
+            json.dump(manifest, writer, indent=4)
+            writer.write("\n")
+
+
+#------------------------------------------------------------------------------
+# Checks that intervals don't surpass the start and end of their chromosome.
+# Intervals for which its ends are before the beginning of the chr or its 
+# starts are after the end of the chr are considered empty (outside).
+# After that, starts which are past the beginning of the chr are put at 0
+# and ends which are past the end of the chr are put at the chromosome length
+# Any intervals where the start and end positions mean the interval is empty
+# (start >= end) should be disregarded too.
+#
+# Inputs:
+#    -starts: numpy array with the starts of the intervals
+#    -ends: numpy array with the ends of the intervals
+#    -contig_lengths: length of the contig of the intervals, or numpy array
+#        with the length of the contig of each interval
+#
+# Outputs:
+#    -starts: numpy array with the corrected starts
+#    -ends: numpy array with the corrected ends
+#    -outside: boolean numpy array, True for the intervals outside the contig
+#    -clipped: boolean numpy array, True for the intervals not outside the
+#        contig with the start or end corrected
+#    -empty: boolean numpy array, True for the intervals not outside the 
+#        contig which are empty after the correction
+def correctContigEdges(starts, ends, contig_lengths):
+    
+    outside = (starts >= contig_lengths) | (ends <= 0)
+    
+    clipped = ~outside & ((starts < 0) | (ends > contig_lengths))
+    
+    starts = np.maximum(starts, 0)
+    ends = np.minimum(ends, contig_lengths)
+    
+    empty = ~outside & (starts >= ends)
+    
+    return starts, ends, outside, clipped, empty
+
+
+#------------------------------------------------------------------------------
+# First checks that all the bed segments don't surpass the start and end of the chr.
+# Regions for which its ends are before the beginning of the chr, are considered empty and disregarded.
+# Regions for which its starts are after the end of the chr, are considered empty and disregarded.
+# After those filters, starts which are past the beginning of the chr are put at 0
+# and ends which are past the end of the chr are put at the chromosome length
+# Any regions where the start and end positions mean the region is empty are disregarded.
+# The contig lengths are loaded once (see ContigRegistry) and the regions are
+# processed in chunks of lines (see correctContigEdges).
+# Inputs:
+#    -infile: bed file with strand information after being processed with bedtools slop.
+#             In theory, any bed file should serve since all fields are outputted, this includes bedgraph files.
+#             Tested formats:
+#             -bed:    chr1    0    100
+#             -bedgraph:    chr1    0    100    1.2345
+#             -bed6 (with strand): chr1    10213   10256   HSQ-700220:198:C5WA4ACXX:5:1304:17892:7253      7       +
+#    -contigs: file with contig \t length pairs for the infile
+#    -outfile: processed file eliminating the problems described above, with
+#        its manifest (see ManifestWriter)
+#    -log_file: Number of regions deleted or modified for each reason.
+#    -detailed_log_file: If specified, any deleted or modified regions are 
+#        logged here.
+#    -threads: Number of threads decompressing the infile and compressing the
+#        outfile (see openCompressedFile)
+#
+# Outputs:
+#    processed contents to the outfile
+#    Exception if a contig is not found in the list of contigs.
+@cluster_runnable
+def correctSlopChromosomeEdges(infile, 
+                               contigs, 
+                               outfile, 
+                               log_file, 
+                               detailed_log_file=None,
+                               threads=1):
+    
+    chunk_size = 100000
+    
+    contig_registry = ContigRegistry.fromFile(contigs)
+    
+    counts = collections.OrderedDict([("regions", 0),
+                                      ("outside_contig", 0),
+                                      ("clipped_to_contig", 0),
+                                      ("empty_after_clipping", 0),
+                                      ("written", 0)])
+    
+    writer = ManifestWriter(outfile, threads=threads)
+    
+    if detailed_log_file is not None:
+        detailed_log = IOTools.open_file(detailed_log_file, "w")
+    
+    # Chunk of regions: [contig, start, end(, rest of the fields)]
+    chunk = []
+    
+    def processChunk():
+        
+        ids = contig_registry.getIds([fields[0] for fields in chunk])
+        
+        if (ids == -1).any():
+            
+            contig = chunk[int(np.flatnonzero(ids == -1)[0])][0]
+            
+            raise Exception("Correcting positions, contig " + contig +
+                            " not found in the list of contigs: " + contigs)
+        
+        chunk_lengths = contig_registry.lengths[ids]
+        
+        starts = np.array([int(fields[1]) for fields in chunk], dtype=np.int64)
+        ends = np.array([int(fields[2]) for fields in chunk], dtype=np.int64)
+        
+        new_starts, new_ends, outside, clipped, empty = \
+            correctContigEdges(starts, ends, chunk_lengths)
+        
+        kept = ~(outside | empty)
+        
+        counts["regions"] += len(chunk)
+        counts["outside_contig"] += int(outside.sum())
+        counts["clipped_to_contig"] += int(clipped.sum())
+        counts["empty_after_clipping"] += int(empty.sum())
+        counts["written"] += int(kept.sum())
+        
+        lines = []
+        
+        for i in np.flatnonzero(kept).tolist():
+            
+            fields = chunk[i]
+            fields[1] = str(new_starts[i])
+            fields[2] = str(new_ends[i])
+            
+            lines.append("\t".join(fields))
+        
+        if len(lines) > 0:
+            writer.write("\n".join(lines) + "\n")
+        
+        if detailed_log_file is None:
+            return
+        
+        for i in np.flatnonzero(~kept | clipped).tolist():
+            
+            # The fields of the kept regions have been corrected
+            before = "\t".join([chunk[i][0], str(starts[i]), str(ends[i])] + 
+                               chunk[i][3:])
+            
+            if outside[i] and starts[i] >= chunk_lengths[i]:
+                detailed_log.write("Correcting positions, file: " + infile + "."
+                                   " Eliminating bed region: " + before + 
+                                   " start >= contig length " + 
+                                   str(chunk_lengths[i]) + "\n")
+            
+            elif outside[i]:
+                detailed_log.write("Correcting positions, file: " + infile + "."
+                                   " Eliminating bed region: " + before + 
+                                   " end <= 0\n")
+            
+            elif empty[i]:
+                detailed_log.write("Correcting positions, file: " + infile + "."
+                                   " Start equal or larger than end (empty). "
+                                   "Start: " + str(new_starts[i]) + 
+                                   " End: " + str(new_ends[i]) + "\n")
+            
+            else:
+                detailed_log.write("Correcting positions, file: " + infile + "."
+                                   " Region surpassing the chromosome edges. "
+                                   "Before: " + before + 
+                                   " Now: " + "\t".join(chunk[i]) + "\n")
+    
+    try:
+        
+        with openCompressedFile(infile, "r", threads=threads) as reader:
+            
+            for line in reader:
+                
+                if line.startswith(("#", "track", "browser")) or \
+                   line.strip() == "":
+                    continue
+                
+                chunk.append(line.rstrip("\n").split("\t"))
+                
+                if len(chunk) == chunk_size:
+                    processChunk()
+                    chunk = []
+            
+            if len(chunk) > 0:
+                processChunk()
+    
+    finally:
+        
+        writer.close()
+        
+        if detailed_log_file is not None:
+            detailed_log.close()
+    
+    with IOTools.open_file(log_file, "w") as log:
+        
+        for category, count in counts.items():
+            log.write("%s\t%i\n" % (category, count))
+
+
+#------------------------------------------------------------------------------
+# Regions to exclude (for example filtering_bed_exclusions) merged per contig
+# into sorted, non-overlapping regions, so that the intervals overlapping them
+# (at least 1bp, as bedtools intersect) are found with numpy.searchsorted.
+#
+# The index is built once from the bed files with ExclusionIndex.build and 
+# saved as an uncompressed .npz with:
+#    -contigs: contig names, their position is the contig ID in the index 
+#        (see self.contigs)
+#    -region_contig_ids, region_starts, region_ends: the merged regions, 
+#        sorted by contig ID and start
+#
+# Inputs:
+#    -infile: .npz created with ExclusionIndex.build
+class ExclusionIndex(object):
+    
+    # The search keys have the contig ID in the bits above the position
+    POSITION_BITS = 32
+    
+    def __init__(self, infile):
+        
+        with np.load(infile) as index:
+            
+            self.contigs = ContigRegistry((contig, -1) for contig 
+                                          in index["contigs"].tolist())
+            
+            self.region_contig_ids = index["region_contig_ids"]
+            self.region_starts = index["region_starts"]
+            self.region_ends = index["region_ends"]
+        
+        self.region_end_keys = (self.region_contig_ids << self.POSITION_BITS) + \
+                               self.region_ends
+    
+    def __len__(self):
+        
+        return len(self.region_starts)
+    
+    # Reads the regions of the excluded bed files (compressed or uncompressed),
+    # a list or a string with the files separated by , and saves the index
+    # to outfile. Overlapping (or touching) regions are merged, which doesn't 
+    # change which intervals overlap them.
+    @staticmethod
+    def build(excluded_beds, outfile):
+        
+        if isinstance(excluded_beds, str):
+            excluded_beds = [excluded_bed for excluded_bed in excluded_beds.split(",")
+                             if excluded_bed != ""]
+        
+        regions = collections.OrderedDict()
+        
+        for excluded_bed in excluded_beds:
+            
+            with IOTools.open_file(excluded_bed, "r") as reader:
+                
+                for line in reader:
+                    
+                    if line.startswith(("#", "track", "browser")) or \
+                       line.strip() == "":
+                        continue
+                    
+                    fields = line.split("\t", 3)
+                    
+                    starts, ends = regions.setdefault(fields[0], ([], []))
+                    starts.append(int(fields[1]))
+                    ends.append(int(fields[2]))
+        
+        region_contig_ids = []
+        region_starts = []
+        region_ends = []
+        
+        for contig_id, (starts, ends) in enumerate(regions.values()):
+            
+            starts = np.array(starts, dtype=np.int64)
+            ends = np.array(ends, dtype=np.int64)
+            
+            order = np.lexsort((ends, starts))
+            starts = starts[order]
+            ends = ends[order]
+            
+            # A region starts a new merged region if it starts after the
+            # furthest end of all the previous ones
+            furthest_ends = np.maximum.accumulate(ends)
+            
+            new_region = np.ones(len(starts), dtype=bool)
+            new_region[1:] = starts[1:] > furthest_ends[:-1]
+            
+            first_regions = np.flatnonzero(new_region)
+            
+            region_contig_ids.append(np.full(len(first_regions), contig_id, 
+                                             dtype=np.int64))
+            region_starts.append(starts[first_regions])
+            region_ends.append(np.maximum.reduceat(ends, first_regions))
+        
+        if len(regions) == 0:
+            region_contig_ids = region_starts = region_ends = \
+                [np.zeros(0, dtype=np.int64)]
+        
+        with open(outfile, "wb") as writer:
+            np.savez(writer,
+                     contigs=np.array(list(regions.keys()), dtype=str),
+                     region_contig_ids=np.concatenate(region_contig_ids),
+                     region_starts=np.concatenate(region_starts),
+                     region_ends=np.concatenate(region_ends))
+    
+    # Boolean numpy array, True for the intervals overlapping a region.
+    # contig_ids are the contig IDs in the index (self.contigs.getIds), -1 
+    # for contigs without regions
+    def maskOverlapping(self, contig_ids, starts, ends):
+        
+        contig_ids = np.asarray(contig_ids, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        
+        overlaps = np.zeros(len(starts), dtype=bool)
+        
+        # First merged region of the contig ending after the start of the 
+        # interval, the interval overlaps a region only if it overlaps this one
+        keys = (contig_ids << self.POSITION_BITS) + np.maximum(starts, 0)
+        
+        first_regions = np.searchsorted(self.region_end_keys, keys, side="right")
+        
+        found = (contig_ids >= 0) & (first_regions < len(self.region_end_keys))
+        
+        first_regions = first_regions[found]
+        
+        overlaps[found] = \
+            (self.region_contig_ids[first_regions] == contig_ids[found]) & \
+            (self.region_starts[first_regions] < ends[found])
+        
+        return overlaps
+
+
+#------------------------------------------------------------------------------
+# Filters out of a bed file (any format with contig, start and end in the 
+# first three fields) the lines overlapping the regions of an ExclusionIndex,
+# as bedtools intersect -v -a infile -b <excluded beds>. The lines are 
+# processed in chunks.
+#
+# Inputs:
+#    -infile: bed file (compressed or uncompressed) to process
+#    -outfile: processed file without the lines overlapping the regions, with
+#        its manifest (see ManifestWriter)
+#    -exclusion_index: .npz created with ExclusionIndex.build
+#    -threads: Number of threads decompressing the infile and compressing the
+#        outfile (see openCompressedFile)
+#
+# Outputs:
+#    -Writes the processed file to outfile.
+@cluster_runnable
+def filterExcludedRegions(infile, outfile, exclusion_index, threads=1):
+    
+    chunk_size = 100000
+    
+    index = ExclusionIndex(exclusion_index)
+    
+    chunk = []
+    
+    with openCompressedFile(infile, "r", threads=threads) as reader, \
+         ManifestWriter(outfile, threads=threads) as writer:
+        
+        def processChunk():
+            
+            fields = [line.split("\t", 3) for line in chunk]
+            
+            contig_ids = index.contigs.getIds([f[0] for f in fields])
+            starts = np.array([int(f[1]) for f in fields], dtype=np.int64)
+            ends = np.array([int(f[2]) for f in fields], dtype=np.int64)
+            
+            kept = ~index.maskOverlapping(contig_ids, starts, ends)
+            
+            writer.write("".join([chunk[i] for i in np.flatnonzero(kept).tolist()]))
+        
+        for line in reader:
+            
+            if line.startswith(("#", "track", "browser")) or \
+               line.strip() == "":
+                continue
+            
+            chunk.append(line.rstrip("\n") + "\n")
+            
+            if len(chunk) == chunk_size:
+                processChunk()
+                chunk = []
+        
+        if len(chunk) > 0:
+            processChunk()
+
+
+#------------------------------------------------------------------------------
+# Goes once through a tagAlign/bed file and writes random subsamples of its
+# lines, any number of them, each with the lines in the input order.
+# The number of lines of the file is taken from its manifest (see 
+# countRecords), so the lines are selected sequentially: for each chunk of
+# lines the number of lines selected in it is drawn from the hypergeometric 
+# distribution (lines still to select out of the lines still to read) and 
+# that number of lines of the chunk is selected at random. Every subset of
+# the lines of the requested size has the same probability.
+#
+# Inputs:
+#    -infile: tagAlign/bed file (compressed or uncompressed)
+#    -outfiles: list of outfiles, one per subsample
+#    -sample_sizes: list with the number of lines of each subsample. If it
+#        is not less than the lines of the infile, all the lines are written.
+#    -seed: seed of the random number generator of each subsample
+#    -threads: Number of threads decompressing the infile and compressing
+#        each outfile
+#
+# Outputs:
+#    -Writes the subsamples to the outfiles, each with its manifest 
+#        (see ManifestWriter)
+#
+# Exception:
+#    -If the number of lines of the infile is not the one in the manifest
+@cluster_runnable
+def downsampleTagAlign(infile, outfiles, sample_sizes, seed=51, threads=1):
+    
+    chunk_size = 100000
+    
+    n_records = countRecords(infile)
+    
+    writers = [ManifestWriter(outfile, threads=threads) for outfile in outfiles]
+    
+    random_states = [np.random.RandomState(seed) for outfile in outfiles]
+    
+    # Lines still to select for each subsample
+    remaining_sizes = [min(int(sample_size), n_records) 
+                       for sample_size in sample_sizes]
+    
+    # Lines still to read
+    remaining_records = n_records
+    
+    chunk = []
+    
+    def processChunk():
+        
+        for i, writer in enumerate(writers):
+            
+            if remaining_sizes[i] == 0:
+                continue
+            
+            if remaining_sizes[i] == remaining_records:
+                
+                selected = range(len(chunk))
+            
+            else:
+                
+                n_selected = random_states[i].hypergeometric(
+                    len(chunk), remaining_records - len(chunk), 
+                    remaining_sizes[i])
+                
+                selected = np.sort(random_states[i].choice(len(chunk), 
+                                                           n_selected, 
+                                                           replace=False))
+                
+                selected = selected.tolist()
+            
+            writer.write("".join([chunk[j] for j in selected]))
+            
+            remaining_sizes[i] -= len(selected)
+    
+    try:
+        
+        with openCompressedFile(infile, "r", threads=threads) as reader:
+            
+            for line in reader:
+                
+                if not line.endswith("\n"):
+                    line += "\n"
+                
+                chunk.append(line)
+                
+                if len(chunk) == chunk_size:
+                    
+                    if len(chunk) > remaining_records:
+                        break
+                    
+                    processChunk()
+                    remaining_records -= len(chunk)
+                    chunk = []
+            
+            if len(chunk) != remaining_records:
+                raise ValueError("%s doesn't have the %i lines of its manifest" % 
+                                 (infile, n_records))
+            
+            if len(chunk) > 0:
+                processChunk()
+    
+    finally:
+        
+        for writer in writers:
+            writer.close()
+
+
+#------------------------------------------------------------------------------
+# Compressed I/O: gzip files are written as BGZF (see BGZF_MAGIC): a series of
+# gzip members of up to BGZF_BLOCK_SIZE bytes of uncompressed data followed by
+# the BGZF_EOF block. They can be read as any gzip file, BGZF files can be
+# concatenated without decompressing them (see concatenateBgzfFiles) and, 
+# because the blocks are independent and zlib releases the GIL, the blocks
+# are compressed and decompressed by a pool of threads.
+
+
+#------------------------------------------------------------------------------
+# Writes text (or bytes) as BGZF.
+#
+# Inputs:
+#    -outfile: BGZF file, or binary file object
+#    -compresslevel: zlib compression level
+#    -threads: Number of threads compressing the blocks
+class BgzfWriter(object):
+    
+    def __init__(self, outfile, compresslevel=FINAL_COMPRESSION_LEVEL, threads=1):
+        
+        if hasattr(outfile, "write"):
+            self.writer = outfile
+        else:
+            self.writer = open(outfile, "wb")
+        
+        self.compresslevel = compresslevel
+        
+        # Blocks compressed at once
+        if threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+            self.batch_size = BGZF_BLOCK_SIZE * threads * 8
+        else:
+            self.executor = None
+            self.batch_size = BGZF_BLOCK_SIZE
+        
+        self.buffer = []
+        self.buffer_size = 0
+    
+    def __enter__(self):
+        
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        
+        self.close()
+    
+    def write(self, text):
+        
+        if isinstance(text, str):
+            data = text.encode("utf-8")
+        else:
+            data = text
+        
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        
+        if self.buffer_size >= self.batch_size:
+            self.flushBlocks(last=False)
+    
+    # Compresses and writes the full blocks of the buffer (all of it if last)
+    def flushBlocks(self, last):
+        
+        data = b"".join(self.buffer)
+        
+        if last:
+            end = len(data)
+        else:
+            end = len(data) - len(data) % BGZF_BLOCK_SIZE
+        
+        blocks = [data[start:start + BGZF_BLOCK_SIZE] 
+                  for start in range(0, end, BGZF_BLOCK_SIZE)]
+        
+        compresslevels = [self.compresslevel] * len(blocks)
+        
+        if self.executor is None:
+            compressed_blocks = map(compressBgzfBlock, blocks, compresslevels)
+        else:
+            compressed_blocks = self.executor.map(compressBgzfBlock, blocks, 
+                                                  compresslevels)
+        
+        for compressed_block in compressed_blocks:
+            self.writer.write(compressed_block)
+        
+        self.buffer = [data[end:]]
+        self.buffer_size = len(data) - end
+    
+    def close(self):
+        
+        if self.writer is None:
+            return
+        
+        self.flushBlocks(last=True)
+        
+        if self.executor is not None:
+            self.executor.shutdown()
+        
+        self.writer.write(BGZF_EOF)
+        self.writer.close()
+        self.writer = None
+
+
+#------------------------------------------------------------------------------
+# Compresses up to BGZF_BLOCK_SIZE bytes into a BGZF block.
+#
+# Inputs:
+#    -data: bytes to compress
+#    -compresslevel: zlib compression level
+#
+# Outputs:
+#    -block: the BGZF block
+def compressBgzfBlock(data, compresslevel=FINAL_COMPRESSION_LEVEL):
+    
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    
+    # MTIME=0, XFL=0, OS=255 (unknown) and BSIZE=total block size - 1
+    return b"".join([BGZF_MAGIC,
+                     b"\x00\x00\x00\x00\x00\xff",
+                     BGZF_EXTRA_FIELD,
+                     struct.pack("<H", len(compressed) + 25),
+                     compressed,
+                     struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))])
+
+
+#------------------------------------------------------------------------------
+# Removes the BGZF header and footer from a raw BGZF block and decompresses 
+# its data.
+def decompressBgzfBlock(block):
+    
+    return zlib.decompress(block[18:-8], -15)
+
+
+#------------------------------------------------------------------------------
+# Reads a gzip file. If it is BGZF its blocks are read sequentially (no 
+# seeking, so it can read a pipe) and decompressed by a pool of threads, 
+# otherwise it is decompressed by gzip in this thread. Iterating gives the
+# lines as text.
+#
+# Inputs:
+#    -infile: gzip file, or binary file object
+#    -threads: Number of threads decompressing the blocks
+class BgzfReader(object):
+    
+    def __init__(self, infile, threads=1):
+        
+        if hasattr(infile, "read"):
+            self.reader = infile
+        else:
+            self.reader = open(infile, "rb")
+        
+        header = self.reader.peek(16)[:16]
+        
+        self.bgzf = header[:4] == BGZF_MAGIC and header[10:16] == BGZF_EXTRA_FIELD
+        
+        self.threads = threads
+    
+    def __enter__(self):
+        
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        
+        self.close()
+    
+    def close(self):
+        
+        self.reader.close()
+    
+    # Yields the raw BGZF blocks
+    def iterateBlocks(self):
+        
+        while True:
+            
+            header = self.reader.read(18)
+            
+            if len(header) < 18:
+                break
+            
+            # BSIZE is the total block size - 1
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            
+            yield header + self.reader.read(block_size - 18)
+    
+    # Yields the decompressed data, in order
+    def iterateData(self):
+        
+        if not self.bgzf:
+            
+            with gzip.GzipFile(fileobj=self.reader, mode="rb") as reader:
+                
+                for data in iter(lambda: reader.read(1 << 22), b""):
+                    yield data
+            
+            return
+        
+        if self.threads == 1:
+            
+            for block in self.iterateBlocks():
+                yield decompressBgzfBlock(block)
+            
+            return
+        
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+            
+            batch = []
+            
+            for block in self.iterateBlocks():
+                
+                batch.append(block)
+                
+                if len(batch) == self.threads * 8:
+                    
+                    for data in executor.map(decompressBgzfBlock, batch):
+                        yield data
+                    
+                    batch = []
+            
+            for data in executor.map(decompressBgzfBlock, batch):
+                yield data
+    
+    def __iter__(self):
+        
+        remainder = b""
+        
+        for data in self.iterateData():
+            
+            lines = (remainder + data).split(b"\n")
+            
+            remainder = lines.pop()
+            
+            for line in lines:
+                yield line.decode("utf-8") + "\n"
+        
+        if remainder != b"":
+            yield remainder.decode("utf-8")
+    
+    def read(self):
+        
+        return b"".join(self.iterateData()).decode("utf-8")
+
+
+#------------------------------------------------------------------------------
+# Opens a file for reading or writing text, as BGZF (see BgzfReader and 
+# BgzfWriter) if the name ends with .gz.
+#
+# Inputs:
+#    -filename: Name of the file
+#    -mode: "r" or "w"
+#    -threads: Number of threads compressing/decompressing the blocks
+#    -compresslevel: zlib compression level when writing
+#
+# Outputs:
+#    -returns the file object
+def openCompressedFile(filename, mode="r", threads=1, 
+                       compresslevel=FINAL_COMPRESSION_LEVEL):
+    
+    if mode not in ("r", "w"):
+        raise ValueError("Mode not recognised: %s" % mode)
+    
+    if not filename.endswith(".gz"):
+        return open(filename, mode)
+    
+    if mode == "r":
+        return BgzfReader(filename, threads=threads)
+    else:
+        return BgzfWriter(filename, compresslevel=compresslevel, 
+                          threads=threads)
+
+
+#------------------------------------------------------------------------------
+# Creates the command to compress (or decompress) BGZF from stdin to stdout
+# with this module (see main), for P.run statements. Eg:
+#    zcat file.gz | ... | <compress command> > outfile.gz
+#
+# Inputs:
+#    -threads: Number of threads compressing/decompressing the blocks
+#    -compresslevel: zlib compression level
+#    -decompress: Create the command to decompress instead
+#
+# Outputs:
+#    -returns the command
+def getBgzipCommand(threads=1, compresslevel=FINAL_COMPRESSION_LEVEL, 
+                    decompress=False):
+    
+    command = "python %s bgzip -@ %i -l %i" % (os.path.abspath(__file__), 
+                                               threads, 
+                                               compresslevel)
+    
+    if decompress:
+        command += " -d"
+    
+    return command
+
+
+#------------------------------------------------------------------------------
+# Pools files by concatenating their compressed contents, which is a valid
+# gzip file. The BGZF_EOF block at the end of each BGZF infile is removed and
+# one is written at the end, so that BGZF infiles give a BGZF outfile.
+# If all the infiles have a manifest, the outfile gets one too (without md5,
+# which would need the uncompressed contents).
+#
+# Inputs:
+#    -infiles: gzip (preferably BGZF) files
+#    -outfile: pooled file
+#
+# Outputs:
+#    -Writes the outfile
+def concatenateBgzfFiles(infiles, outfile):
+    
+    manifests = [readManifest(infile) for infile in infiles]
+    
+    with open(outfile, "wb") as writer:
+        
+        for infile in infiles:
+            
+            with open(infile, "rb") as reader:
+                
+                size = os.fstat(reader.fileno()).st_size
+                
+                # Copy everything except the EOF block
+                if size >= len(BGZF_EOF):
+                    reader.seek(size - len(BGZF_EOF))
+                    
+                    if reader.read() == BGZF_EOF:
+                        size -= len(BGZF_EOF)
+                    
+                    reader.seek(0)
+                
+                while size > 0:
+                    
+                    data = reader.read(min(size, 1 << 22))
+                    writer.write(data)
+                    size -= len(data)
+        
+        writer.write(BGZF_EOF)
+    
+    if all(manifest is not None for manifest in manifests):
+        
+        manifest = collections.OrderedDict([
+            ("records", sum(m["records"] for m in manifests)),
+            ("uncompressed_bytes", sum(m["uncompressed_bytes"] for m in manifests)),
+            ("md5", None),
+            ("bytes", os.path.getsize(outfile))])
+        
+        with open(getManifestFile(outfile), "w") as writer:
+            json.dump(manifest, writer, indent=4)
+            writer.write("\n")
+
+
+#------------------------------------------------------------------------------
+# Pools tagAlign/bed files sorted by contig and start (as sort -k1,1 -k2,2n)
+# with a k-way merge, keeping the order.
+#
+# Inputs:
+#    -infiles: tagAlign/bed files (compressed or uncompressed) sorted by 
+#        contig and start
+#    -outfile: pooled BGZF file, with its manifest (see ManifestWriter)
+#
+# Outputs:
+#    -Writes the outfile
+def mergeSortedTagAligns(infiles, outfile):
+    
+    def getSortKey(line):
+        
+        fields = line.split("\t", 2)
+        
+        return fields[0], int(fields[1])
+    
+    readers = [openCompressedFile(infile, "r") for infile in infiles]
+    
+    try:
+        
+        with ManifestWriter(outfile) as writer:
+            
+            lines = []
+            
+            for line in heapq.merge(*readers, key=getSortKey):
+                
+                lines.append(line if line.endswith("\n") else line + "\n")
+                
+                if len(lines) == 100000:
+                    writer.write("".join(lines))
+                    lines = []
+            
+            writer.write("".join(lines))
+    
+    finally:
+        
+        for reader in readers:
+            reader.close()
+
+
+#------------------------------------------------------------------------------
+# Pools tagAlign/bed files. By default by concatenating the compressed 
+# files (see concatenateBgzfFiles), without decompressing them. If sort, the
+# infiles must be sorted by contig and start and are merged keeping the order
+# (see mergeSortedTagAligns).
+#
+# Inputs:
+#    -infiles: tagAlign/bed files (BGZF)
+#    -outfile: pooled file
+#    -sort: Merge the sorted infiles into a sorted outfile
+#
+# Outputs:
+#    -Writes the outfile
+@cluster_runnable
+def poolTagAligns(infiles, outfile, sort=False):
+    
+    if sort:
+        mergeSortedTagAligns(infiles, outfile)
+    else:
+        concatenateBgzfFiles(infiles, outfile)
+
+
+#------------------------------------------------------------------------------
+# Collapses each tag of a tagAlign file to a 1bp region with its 5' end 
+# (strand-aware) and sorts the outfile by contig and start (as 
+# sort -k1,1 -k2,2n, with ties ordered by the whole line).
+# The infile must have the tags of each contig together and sorted by start,
+# except for tags moved back up to window bp (like the Tn5 shift of 
+# processTagAlign). As the 5' end of a tag is at most a read length after its
+# start, the tags are reordered in a single pass with a heap which only holds 
+# the tags in the last read length + window bp, instead of sorting the file.
+# Each contig is written to a temporal file and the contigs are concatenated
+# in order (see concatenateBgzfFiles).
+#
+# Inputs:
+#    -infile: tagAlign file with the tags of each contig sorted by start
+#    -outfile: BGZF tagAlign with the 1bp 5' ends, with its manifest (see 
+#        ManifestWriter)
+#    -window: Maximum number of bp a tag can start before the start of a tag
+#        preceding it in the infile
+#    -tmp_dir: Directory for the temporal files
+#    -threads: Number of threads decompressing the infile and compressing 
+#        the outfile
+#
+# Outputs:
+#    -Writes the outfile
+#
+# Exception:
+#    -If the tags of a contig are not together or are not sorted within the 
+#        window
+@cluster_runnable
+def getFivePrimeEnds(infile, outfile, window=100, tmp_dir=None, threads=1):
+    
+    parts_dir = tempfile.mkdtemp(dir=tmp_dir)
+    
+    # Temporal file of each contig
+    parts = collections.OrderedDict()
+    
+    # Writes the tags of the heap starting before max_start (all the tags if
+    # not specified) and returns the last one
+    def writeContig(contig, heap, max_start=None):
+        
+        tags = []
+        
+        while len(heap) > 0 and (max_start is None or heap[0][0] < max_start):
+            
+            tags.append(heapq.heappop(heap))
+        
+        parts[contig].write("".join(line for start, line in tags))
+        
+        return tags[-1] if len(tags) > 0 else None
+    
+    try:
+        
+        with openCompressedFile(infile, "r", threads=threads) as reader:
+            
+            contig = None
+            heap = []
+            
+            # Last tag written, (start, line)
+            last_tag = None
+            
+            for line in reader:
+                
+                fields = line.rstrip("\n").split("\t")
+                
+                if fields[0] != contig:
+                    
+                    if contig is not None:
+                        writeContig(contig, heap)
+                        parts[contig].close()
+                    
+                    contig = fields[0]
+                    
+                    if contig in parts:
+                        raise ValueError("The tags of contig %s are not together "
+                                         "in %s" % (contig, infile))
+                    
+                    parts[contig] = ManifestWriter(
+                        os.path.join(parts_dir, "%i.tagAlign.gz" % len(parts)),
+                        compresslevel=TEMPORARY_COMPRESSION_LEVEL)
+                    
+                    heap = []
+                    last_tag = None
+                
+                start = int(fields[1])
+                
+                # The tags starting before start - window are final
+                if len(heap) > 0 and heap[0][0] < start - window:
+                    
+                    last_tag = writeContig(contig, heap, start - window)
+                
+                if len(fields) > 5 and fields[5] == "+":
+                    fields[2] = str(start + 1)
+                
+                elif len(fields) > 5 and fields[5] == "-":
+                    start = int(fields[2]) - 1
+                    fields[1] = str(start)
+                
+                tag = (start, "\t".join(fields) + "\n")
+                
+                if last_tag is not None and tag < last_tag:
+                    raise ValueError("The tags of contig %s in %s are not "
+                                     "sorted within %i bp" 
+                                     % (contig, infile, window))
+                
+                heapq.heappush(heap, tag)
+            
+            if contig is not None:
+                writeContig(contig, heap)
+                parts[contig].close()
+        
+        # The contigs in order
+        concatenateBgzfFiles([parts[contig].outfile for contig in sorted(parts)],
+                             outfile)
+    
+    finally:
+        
+        for part in parts.values():
+            part.close()
+        
+        shutil.rmtree(parts_dir)
+
+
+#------------------------------------------------------------------------------
+# Sources of the intervals of a merged bed file (see mergePeaks): the contig,
+# start and end of each merged interval and the input sets with intervals
+# merged into it (separated by ,). It is written next to the file
+# (<file>.sources.tsv.gz).
+#
+# Inputs:
+#    -infile: merged bed file
+#
+# Outputs:
+#    -sources_file: Name of the sources file of the file
+def getSourcesFile(infile):
+    
+    return infile + ".sources.tsv.gz"
+
+
+#------------------------------------------------------------------------------
+# Merges the intervals of a contig closer than distance bp (as bedtools merge
+# -d distance, so overlapping and book-ended intervals are always merged).
+# The intervals are sorted by start and an interval starts a new merged 
+# interval when its start is past the furthest end of the previous intervals 
+# + distance.
+#
+# Inputs:
+#    -starts: numpy array with the starts of the intervals
+#    -ends: numpy array with the ends of the intervals
+#    -distance: Maximum distance between intervals merged
+#
+# Outputs:
+#    -merged_starts: numpy array with the starts of the merged intervals
+#    -merged_ends: numpy array with the ends of the merged intervals
+#    -order: numpy array with the indexes sorting the intervals by start
+#    -first: numpy array with the index (in order) of the first interval of 
+#        each merged interval
+def mergeIntervals(starts, ends, distance=0):
+    
+    order = np.argsort(starts, kind="mergesort")
+    
+    starts = starts[order]
+    ends = ends[order]
+    
+    if len(starts) == 0:
+        return starts, ends, order, np.zeros(0, dtype=np.int64)
+    
+    running_ends = np.maximum.accumulate(ends)
+    
+    breaks = starts[1:] > running_ends[:-1] + distance
+    
+    first = np.concatenate([[0], np.flatnonzero(breaks) + 1])
+    
+    return starts[first], np.maximum.reduceat(ends, first), order, first
+
+
+#------------------------------------------------------------------------------
+# Reads the contig, start and end of the intervals of a bed file.
+#
+# Inputs:
+#    -infile: bed file (compressed or uncompressed)
+#
+# Outputs:
+#    -returns a pandas dataframe with the columns contig, start and end
+def readIntervals(infile):
+    
+    try:
+        intervals = pd.read_csv(infile, 
+                                sep="\t", 
+                                header=None, 
+                                usecols=[0, 1, 2],
+                                names=["contig", "start", "end"],
+                                dtype={"contig": str, 
+                                       "start": np.int64, 
+                                       "end": np.int64},
+                                comment="#")
+    
+    except pd.errors.EmptyDataError:
+        intervals = pd.DataFrame({"contig": pd.Series([], dtype=str),
+                                  "start": pd.Series([], dtype=np.int64),
+                                  "end": pd.Series([], dtype=np.int64)})
+    
+    return intervals
+
+
+#------------------------------------------------------------------------------
+# Merges the peaks of several peak files closer than distance bp, doing in 
+# memory what was done with:
+#    zcat infiles | sort -k1,1 -k2,2n | bedtools merge -d distance 
+#        | sort -k1,1 -k2,2n
+# The peaks are merged per contig (see mergeIntervals), and the input set 
+# of each peak is kept to write which input sets have peaks in each merged
+# peak (see getSourcesFile).
+#
+# Inputs:
+#    -infiles: peak/bed files (compressed or uncompressed)
+#    -outfile: BGZF bed file with the contig, start and end of the merged 
+#        peaks sorted by contig and start, with its manifest (see 
+#        ManifestWriter) and sources file
+#    -distance: Maximum distance between peaks merged
+#    -labels: Name of the input set of each infile. By default the name of
+#        the infile.
+#    -threads: Number of threads compressing the outfile
+#
+# Outputs:
+#    -Writes the outfile and its sources file
+@cluster_runnable
+def mergePeaks(infiles, outfile, distance=0, labels=None, threads=1):
+    
+    if labels is None:
+        labels = [os.path.basename(infile) for infile in infiles]
+    
+    if len(labels) != len(infiles):
+        raise ValueError("%i labels specified for %i infiles" 
+                         % (len(labels), len(infiles)))
+    
+    intervals = []
+    
+    for source, infile in enumerate(infiles):
+        
+        infile_intervals = readIntervals(infile)
+        infile_intervals["source"] = source
+        
+        intervals.append(infile_intervals)
+    
+    intervals = pd.concat(intervals, ignore_index=True)
+    
+    with ManifestWriter(outfile, threads=threads) as writer, \
+         openCompressedFile(getSourcesFile(outfile), "w") as sources_writer:
+        
+        for contig, contig_intervals in intervals.groupby("contig", sort=True):
+            
+            merged_starts, merged_ends, order, first = \
+                mergeIntervals(contig_intervals["start"].values,
+                               contig_intervals["end"].values,
+                               distance)
+            
+            sources = contig_intervals["source"].values[order]
+            
+            # Whether each input set has peaks in each merged peak
+            has_source = [np.logical_or.reduceat(sources == source, first)
+                          for source in range(len(infiles))]
+            
+            merged_sources = [",".join(label 
+                                       for label, has in zip(labels, row) 
+                                       if has)
+                              for row in zip(*has_source)]
+            
+            lines = ["%s\t%i\t%i\n" % (contig, start, end) 
+                     for start, end in zip(merged_starts, merged_ends)]
+            
+            writer.write("".join(lines))
+            
+            sources_writer.write("".join(
+                "%s\t%s\n" % (line.rstrip("\n"), merged_source) 
+                for line, merged_source in zip(lines, merged_sources)))
+
+
+#------------------------------------------------------------------------------
+# Counts the tags overlapping each peak of a contig, for peaks which don't 
+# overlap each other (eg. merged with mergeIntervals). The peaks overlapping
+# a tag go from the first peak ending after its start to the last peak
+# starting before its end, so each tag adds 1 to a range of peaks, which is
+# accumulated with bincount.
+#
+# Inputs:
+#    -starts: numpy array with the starts of the tags
+#    -ends: numpy array with the ends of the tags
+#    -peak_starts: numpy array with the starts of the peaks, sorted
+#    -peak_ends: numpy array with the ends of the peaks, sorted
+#
+# Outputs:
+#    -counts: numpy array with the number of tags overlapping each peak
+def countOverlaps(starts, ends, peak_starts, peak_ends):
+    
+    n_peaks = len(peak_starts)
+    
+    first = np.searchsorted(peak_ends, starts, side="right")
+    last = np.searchsorted(peak_starts, ends, side="left")
+    
+    overlapping = first < last
+    
+    changes = np.bincount(first[overlapping], minlength=n_peaks + 1) - \
+              np.bincount(last[overlapping], minlength=n_peaks + 1)
+    
+    return np.cumsum(changes[:n_peaks])
+
+
+#------------------------------------------------------------------------------
+# Peaks of a peak set (a bed file) grouped by contig to count overlaps with
+# countOverlaps.
+#
+# Inputs:
+#    -infile: bed file (compressed or uncompressed) with peaks which don't 
+#        overlap each other
+#
+# Exception:
+#    -If peaks of the infile overlap each other
+class PeakSet(object):
+    
+    def __init__(self, infile):
+        
+        self.infile = infile
+        
+        self.peaks = readIntervals(infile)
+        
+        # contig: (indexes of the peaks sorted by start, starts, ends)
+        self.contigs = {}
+        
+        for contig, indexes in self.peaks.groupby("contig").indices.items():
+            
+            starts = self.peaks["start"].values[indexes]
+            ends = self.peaks["end"].values[indexes]
+            
+            order = np.argsort(starts, kind="mergesort")
+            
+            indexes = indexes[order]
+            starts = starts[order]
+            ends = ends[order]
+            
+            if np.any(starts[1:] < ends[:-1]):
+                raise ValueError("Peaks of contig %s in %s overlap each other"
+                                 % (contig, infile))
+            
+            self.contigs[contig] = (indexes, starts, ends)
+        
+        self.counts = np.zeros(len(self.peaks), dtype=np.int64)
+    
+    # Adds the tags of a contig overlapping each peak to the counts
+    def addTags(self, contig, starts, ends):
+        
+        if contig not in self.contigs:
+            return
+        
+        indexes, peak_starts, peak_ends = self.contigs[contig]
+        
+        self.counts[indexes] += countOverlaps(starts, ends, 
+                                              peak_starts, peak_ends)
+    
+    # Writes the peaks (contig, start and end) in the order of the infile, 
+    # each with the number of tags overlapping it
+    def writeCounts(self, outfile, threads=1):
+        
+        with ManifestWriter(outfile, threads=threads) as writer:
+            
+            writer.write("".join(
+                "%s\t%i\t%i\t%i\n" % row 
+                for row in zip(self.peaks["contig"].values, 
+                               self.peaks["start"].values,
+                               self.peaks["end"].values,
+                               self.counts)))
+
+
+#------------------------------------------------------------------------------
+# Counts the tags of a tagAlign file overlapping each peak of several peak
+# sets (as bedtools intersect -c -a peak_file -b infile for each peak 
+# file), reading the tagAlign file once. The tags are read in chunks and 
+# counted for every peak set (see PeakSet).
+# The infile can also be a CutSiteIndex directory, then the cut sites in 
+# each peak are counted with the index.
+#
+# Inputs:
+#    -infile: tagAlign/bed file (compressed or uncompressed) or CutSiteIndex
+#        directory
+#    -peak_files: bed files with the peaks of each peak set, which don't 
+#        overlap each other
+#    -outfiles: BGZF bed file for each peak file with the peaks and the number
+#        of tags overlapping them, each with its manifest (see 
+#        ManifestWriter)
+#    -threads: Number of threads compressing the outfiles
+#
+# Outputs:
+#    -Writes the outfiles
+@cluster_runnable
+def countTagsInPeaks(infile, peak_files, outfiles, threads=1):
+    
+    if len(peak_files) != len(outfiles):
+        raise ValueError("%i outfiles specified for %i peak files" 
+                         % (len(outfiles), len(peak_files)))
+    
+    peak_sets = [PeakSet(peak_file) for peak_file in peak_files]
+    
+    if os.path.isdir(infile):
+        
+        index = CutSiteIndex(infile)
+        
+        for peak_set, outfile in zip(peak_sets, outfiles):
+            
+            peak_set.counts = index.count(peak_set.peaks)
+            peak_set.writeCounts(outfile, threads=threads)
+        
+        return
+    
+    try:
+        chunks = pd.read_csv(infile, 
+                             sep="\t", 
+                             header=None, 
+                             usecols=[0, 1, 2],
+                             names=["contig", "start", "end"],
+                             dtype={"contig": str, 
+                                    "start": np.int64, 
+                                    "end": np.int64},
+                             chunksize=1000000)
+        
+        for chunk in chunks:
+            
+            for contig, tags in chunk.groupby("contig", sort=False):
+                
+                for peak_set in peak_sets:
+                    peak_set.addTags(contig, 
+                                     tags["start"].values, 
+                                     tags["end"].values)
+    
+    except pd.errors.EmptyDataError:
+        pass
+    
+    for peak_set, outfile in zip(peak_sets, outfiles):
+        peak_set.writeCounts(outfile, threads=threads)
+
+
+#------------------------------------------------------------------------------
+# Binary store of the cut sites (1bp 5' ends, see getFivePrimeEnds) of a
+# sample, to count them in any regions without reading the tagAlign again.
+# The positions of the cut sites of each contig are sorted, so the cut sites
+# in a region are found with numpy.searchsorted.
+#
+# The index is built once from the tagAlign file with CutSiteIndex.build and
+# saved as a directory with:
+#    -contigs.tsv: contig, index of its first cut site and number of cut 
+#        sites, for each contig
+#    -positions.npy: uint32 positions of the cut sites, sorted by contig (in
+#        the order of contigs.tsv) and position
+#    -reverse.npy: (optional) True for the cut sites of the - strand
+# The .npy files are memory-mapped, so only the parts used are read.
+#
+# Inputs:
+#    -indir: directory created with CutSiteIndex.build
+class CutSiteIndex(object):
+    
+    MAX_POSITION = np.iinfo(np.uint32).max
+    
+    def __init__(self, indir):
+        
+        self.indir = indir
+        
+        # contig: (index of the first cut site, number of cut sites)
+        self.contigs = collections.OrderedDict()
+        
+        with open(os.path.join(indir, "contigs.tsv"), "r") as reader:
+            
+            for line in reader:
+                
+                contig, first, sites = line.rstrip("\n").split("\t")
+                
+                self.contigs[contig] = (int(first), int(sites))
+        
+        self.positions = np.load(os.path.join(indir, "positions.npy"), 
+                                 mmap_mode="r")
+        
+        reverse_file = os.path.join(indir, "reverse.npy")
+        
+        if os.path.exists(reverse_file):
+            self.reverse = np.load(reverse_file, mmap_mode="r")
+        else:
+            self.reverse = None
+    
+    def __len__(self):
+        
+        return len(self.positions)
+    
+    # Reads the cut sites of a tagAlign/bed file (compressed or uncompressed)
+    # with the tags of each contig together and saves the index to outdir.
+    # With strand, the strand of each cut site is taken from the 6th field.
+    @staticmethod
+    def build(infile, outdir, strand=True):
+        
+        columns = [0, 1, 5] if strand else [0, 1]
+        
+        # contig: list of chunks of positions (and of reverse)
+        positions = collections.OrderedDict()
+        reverse = collections.OrderedDict()
+        
+        try:
+            chunks = pd.read_csv(infile,
+                                 sep="\t",
+                                 header=None,
+                                 usecols=columns,
+                                 dtype={0: str, 1: np.int64, 5: str},
+                                 chunksize=1000000)
+            
+            for chunk in chunks:
+                
+                for contig, sites in chunk.groupby(0, sort=False):
+                    
+                    starts = sites[1].values
+                    
+                    if len(starts) > 0 and (starts.min() < 0 or 
+                                            starts.max() > CutSiteIndex.MAX_POSITION):
+                        raise ValueError("Cut sites of contig %s in %s out of "
+                                         "the uint32 range" % (contig, infile))
+                    
+                    positions.setdefault(contig, []).append(starts)
+                    
+                    if strand:
+                        reverse.setdefault(contig, []).append(
+                            sites[5].values == "-")
+        
+        except pd.errors.EmptyDataError:
+            pass
+        
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        
+        all_positions = []
+        all_reverse = []
+        
+        first = 0
+        
+        with open(os.path.join(outdir, "contigs.tsv"), "w") as writer:
+            
+            for contig, contig_positions in positions.items():
+                
+                contig_positions = np.concatenate(contig_positions)
+                
+                order = np.argsort(contig_positions, kind="mergesort")
+                
+                all_positions.append(contig_positions[order].astype(np.uint32))
+                
+                if strand:
+                    all_reverse.append(np.concatenate(reverse[contig])[order])
+                
+                writer.write("%s\t%i\t%i\n" % (contig, first, len(order)))
+                
+                first += len(order)
+        
+        np.save(os.path.join(outdir, "positions.npy"),
+                np.concatenate(all_positions) if len(all_positions) > 0 
+                else np.zeros(0, dtype=np.uint32))
+        
+        if strand:
+            np.save(os.path.join(outdir, "reverse.npy"),
+                    np.concatenate(all_reverse) if len(all_reverse) > 0 
+                    else np.zeros(0, dtype=bool))
+    
+    # Positions of the cut sites of a contig (empty if it has none)
+    def getPositions(self, contig):
+        
+        first, sites = self.contigs.get(contig, (0, 0))
+        
+        return self.positions[first:first + sites]
+    
+    # Index (in the positions of the contig) of the first cut site at or 
+    # after each position
+    def search(self, contig, positions):
+        
+        positions = np.clip(np.asarray(positions, dtype=np.int64), 
+                            0, self.MAX_POSITION).astype(np.uint32)
+        
+        return np.searchsorted(self.getPositions(contig), positions, 
+                               side="left")
+    
+    # Number of cut sites in each region (start <= position < end) of a 
+    # pandas dataframe with the columns contig, start and end (see 
+    # readIntervals)
+    def count(self, regions):
+        
+        counts = np.zeros(len(regions), dtype=np.int64)
+        
+        starts = regions["start"].values
+        ends = regions["end"].values
+        
+        for contig, indexes in regions.groupby("contig").indices.items():
+            
+            counts[indexes] = self.search(contig, ends[indexes]) - \
+                              self.search(contig, starts[indexes])
+        
+        return np.maximum(counts, 0)
+    
+    # Number of cut sites in each bin of bin_size bp from start to end of a
+    # contig (the last bin can be shorter)
+    def coverage(self, contig, start, end, bin_size=1):
+        
+        edges = np.append(np.arange(start, end, bin_size), end)
+        
+        return np.diff(self.search(contig, edges)).astype(np.int64)
+    
+    # Aggregated profile of the cut sites around the sites of a pandas 
+    # dataframe with the columns contig and position (and optionally strand,
+    # the profile of the - strand sites is reversed). Returns the number of 
+    # cut sites at each distance from -window to window from the sites.
+    def profile(self, sites, window):
+        
+        profile = np.zeros(2 * window + 1, dtype=np.int64)
+        
+        site_positions = sites["position"].values
+        
+        if "strand" in sites:
+            site_reverse = sites["strand"].values == "-"
+        else:
+            site_reverse = np.zeros(len(sites), dtype=bool)
+        
+        for contig, indexes in sites.groupby("contig").indices.items():
+            
+            contig_positions = self.getPositions(contig)
+            
+            centers = site_positions[indexes].astype(np.int64)
+            
+            firsts = self.search(contig, centers - window)
+            lasts = self.search(contig, centers + window + 1)
+            
+            sizes = lasts - firsts
+            
+            # The cut sites around each site, one after the other
+            site_index = np.repeat(np.arange(len(centers)), sizes)
+            
+            cut_sites = np.arange(sizes.sum()) - \
+                        np.repeat(np.cumsum(sizes) - sizes, sizes) + \
+                        np.repeat(firsts, sizes)
+            
+            distances = contig_positions[cut_sites].astype(np.int64) - \
+                        centers[site_index]
+            
+            distances = np.where(site_reverse[indexes][site_index], 
+                                 -distances, distances)
+            
+            profile += np.bincount(distances + window, 
+                                   minlength=2 * window + 1)
+        
+        return profile
+
+
+#------------------------------------------------------------------------------
+# Builds the CutSiteIndex of a cut sites tagAlign file (see 
+# CutSiteIndex.build).
+#
+# Inputs:
+#    -infile: tagAlign file with the cut sites (1bp 5' ends)
+#    -outdir: directory of the index
+#
+# Outputs:
+#    -Writes the index to outdir
+@cluster_runnable
+def buildCutSiteIndex(infile, outdir):
+    
+    CutSiteIndex.build(infile, outdir)
+
+
+#------------------------------------------------------------------------------
+# Reads a tag counts file (see countTagsInPeaks): the contig, start, end and
+# number of tags of each peak.
+#
+# Inputs:
+#    -infile: tag counts file (compressed or uncompressed)
+#
+# Outputs:
+#    -returns a pandas dataframe with the columns contig, start, end and count
+def readTagCounts(infile):
+    
+    try:
+        tag_counts = pd.read_csv(infile, 
+                                 sep="\t", 
+                                 header=None, 
+                                 usecols=[0, 1, 2, 3],
+                                 names=["contig", "start", "end", "count"],
+                                 dtype={"contig": str, 
+                                        "start": np.int64, 
+                                        "end": np.int64,
+                                        "count": np.int64})
+    
+    except pd.errors.EmptyDataError:
+        tag_counts = pd.DataFrame({"contig": pd.Series([], dtype=str),
+                                   "start": pd.Series([], dtype=np.int64),
+                                   "end": pd.Series([], dtype=np.int64),
+                                   "count": pd.Series([], dtype=np.int64)})
+    
+    return tag_counts
+
+
+#------------------------------------------------------------------------------
+# Matrix with the tag counts of each peak (rows) of a peak set for each 
+# sample (columns), assembled from the tag counts file of each sample (see
+# countTagsInPeaks).
+#
+# The store is built with CountMatrixStore.build and saved as a directory 
+# with:
+#    -peaks.tsv: contig, start and end of each peak (with header)
+#    -samples.tsv: name of each sample, its tag counts file and the md5 of 
+#        the tag counts file from its manifest (see ManifestWriter), empty if
+#        it has no manifest (with header)
+#    -counts.npy: int32 counts, peaks x samples, with the counts of each 
+#        sample together (Fortran order)
+# counts.npy is memory-mapped, so only the samples used are read.
+# When samples are added, their counts are appended to counts.npy (see
+# CountMatrixStore.addSamples) or, if other samples changed, the store is 
+# rebuilt from the previous one, only reading the tag counts files which are
+# new or have changed (see updateCountMatrixStore).
+#
+# Inputs:
+#    -indir: directory created with CountMatrixStore.build
+class CountMatrixStore(object):
     
+    MAX_COUNT = np.iinfo(np.int32).max
     
-    # We need to know when the read name changes
-    last_read_name = "first"
+    def __init__(self, indir):
+        
+        self.indir = indir
+        
+        self.peaks = pd.read_csv(os.path.join(indir, "peaks.tsv"), 
+                                 sep="\t",
+                                 dtype={"contig": str, 
+                                        "start": np.int64, 
+                                        "end": np.int64})
+        
+        self.samples = pd.read_csv(os.path.join(indir, "samples.tsv"), 
+                                   sep="\t",
+                                   dtype=str)
+        
+        self.counts = np.load(os.path.join(indir, "counts.npy"), mmap_mode="r")
+        
+        if self.counts.shape != (len(self.peaks), len(self.samples)):
+            raise ValueError("The counts of %s don't correspond to its peaks "
+                             "and samples" % indir)
     
-    # We need to know the last read when the read name changes to assign
-    # the read_pair details from the last read when we have seen all the read pair
-    # alignments
-    last_read = ""
+    def __len__(self):
+        
+        return len(self.peaks)
     
-    # Create new dictionary template to store the details
-    read_pair_dict_template = {'read_pair_is_paired':False, # Read pair contains R1 and R2    
-            'read_pair_mapped_in_proper_pair':False, # Read pair contains proper mapped pair
-            'read_pair_is_pcr_duplicate':False, # Read pair is a PCR duplicate
-            'proper_pair_additional_hit_equally_good':False, # If additional hits with equally good score are found
-            'proper_pair_with_chimeric_read':False, # Chimeric read
-            }
+    # Md5 of the contents of each sample (see samples.tsv)
+    def getMd5s(self):
+        
+        if "md5" not in self.samples:
+            return [""] * len(self.samples)
+        
+        return self.samples["md5"].fillna("").tolist()
     
-    # Create new copy of the template dictionary to store
-    read_pair_dict = copy.deepcopy(read_pair_dict_template)
+    # Md5 of each tag counts file from its manifest (see ManifestWriter), 
+    # empty if it has no manifest
+    @staticmethod
+    def getCountFileMd5s(count_files):
+        
+        md5s = []
+        
+        for count_file in count_files:
+            
+            manifest = readManifest(count_file)
             
+            if manifest is None or manifest["md5"] is None:
+                md5s.append("")
+            else:
+                md5s.append(manifest["md5"])
+        
+        return md5s
     
-    # Process the reads
-    for read in samfile:        
+    # Reads the counts of a tag counts file, which must have the peaks of 
+    # peaks_file
+    @staticmethod
+    def readSampleCounts(count_file, peaks, peaks_file):
         
-        # If it is the first read, assign the name (it will consider
-        # it as read name hasn't changed
-        if last_read_name == "first":
-            last_read_name = read.query_name
-            
+        tag_counts = readTagCounts(count_file)
+        
+        if not peaks.equals(tag_counts[["contig", "start", "end"]]):
+            raise ValueError("The peaks of %s are not the ones of %s" 
+                             % (count_file, peaks_file))
         
-        # The read has changed excepting the first read from the file
-        if (last_read_name != read.query_name):
+        if len(tag_counts) > 0 and \
+           tag_counts["count"].max() > CountMatrixStore.MAX_COUNT:
+            raise ValueError("Counts of %s out of the int32 range" 
+                             % count_file)
+        
+        return tag_counts["count"].values
+    
+    # Reads the tag counts files (a list) of the samples (a list with the name
+    # of each sample, in the same order) and saves the store to outdir. All 
+    # the tag counts files must have the same peaks.
+    # If a previous CountMatrixStore is specified, the counts of the samples
+    # with the same name and md5 in it are copied from it instead of reading 
+    # their tag counts files. Returns the number of tag counts files read.
+    @staticmethod
+    def build(count_files, sample_names, outdir, previous=None):
+        
+        if len(count_files) != len(sample_names):
+            raise ValueError("%i sample names specified for %i count files"
+                             % (len(sample_names), len(count_files)))
+        
+        if len(count_files) == 0:
+            raise ValueError("No count files specified")
+        
+        md5s = CountMatrixStore.getCountFileMd5s(count_files)
+        
+        # Sample: column of the sample in previous
+        reused = {}
+        
+        if previous is not None:
             
-            # We have seen all the reads from a pair, update the counters
+            previous_columns = dict(
+                ((sample, md5), column) for column, (sample, md5) 
+                in enumerate(zip(previous.samples["sample"], 
+                                 previous.getMd5s())))
             
-            # Store everything updating the counters
-            c = getCorrectReadPairsUpdateCounters(c, read_pair_dict)
+            for sample, (sample_name, md5) in enumerate(zip(sample_names, md5s)):
+                
+                if md5 != "" and (sample_name, md5) in previous_columns:
+                    reused[sample] = previous_columns[(sample_name, md5)]
+        
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        
+        if len(reused) > 0:
+            peaks = previous.peaks
+        else:
+            peaks = readTagCounts(count_files[0])[["contig", "start", "end"]]
+        
+        counts = np.lib.format.open_memmap(os.path.join(outdir, "counts.npy"),
+                                           mode="w+",
+                                           dtype=np.int32,
+                                           shape=(len(peaks), len(count_files)),
+                                           fortran_order=True)
+        
+        for sample, count_file in enumerate(count_files):
             
+            if sample in reused:
+                counts[:, sample] = previous.counts[:, reused[sample]]
+                continue
             
-            # Create new copy of the template dictionary to store
-            read_pair_dict = copy.deepcopy(read_pair_dict_template)
+            counts[:, sample] = CountMatrixStore.readSampleCounts(
+                count_file, peaks, count_files[0])
+        
+        counts.flush()
+        del counts
+        
+        peaks.to_csv(os.path.join(outdir, "peaks.tsv"), sep="\t", index=False)
         
+        pd.DataFrame({"sample": sample_names, 
+                      "count_file": count_files,
+                      "md5": md5s}).to_csv(
+            os.path.join(outdir, "samples.tsv"), sep="\t", index=False)
         
-        # Checks for the read
-        # For every read pair we check whether it is a proper pair, 
-        # We only need one mapping from the read pair as a proper pair to
-        # consider it a proper pair towards the output
-        if(read.is_paired and read.is_proper_pair):
+        return len(count_files) - len(reused)
+    
+    # Adds samples (their tag counts files and names, in the same order) as
+    # new columns at the end of counts.npy, so the counts of the samples 
+    # already in the store are not rewritten. The tag counts files must have
+    # the peaks of the store. Returns False, without modifying the store, if
+    # the header of counts.npy has no room for the new shape.
+    def addSamples(self, count_files, sample_names):
+        
+        if len(count_files) != len(sample_names):
+            raise ValueError("%i sample names specified for %i count files"
+                             % (len(sample_names), len(count_files)))
+        
+        counts_file = os.path.join(self.indir, "counts.npy")
+        samples_file = os.path.join(self.indir, "samples.tsv")
+        
+        columns = [CountMatrixStore.readSampleCounts(count_file, self.peaks, 
+                                                     self.indir)
+                   for count_file in count_files]
+        
+        n_peaks, n_samples = self.counts.shape
+        dtype = self.counts.dtype
+        
+        # The counts start after the header, which is rewritten in place 
+        # with the new shape
+        data_offset = self.counts.offset
+        
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(
+            header, 
+            {"descr": np.lib.format.dtype_to_descr(dtype),
+             "fortran_order": True,
+             "shape": (n_peaks, n_samples + len(count_files))})
+        header = header.getvalue()
+        
+        with open(counts_file, "rb") as handle:
+            version = np.lib.format.read_magic(handle)
+        
+        if version != (1, 0) or len(header) != data_offset:
+            return False
+        
+        samples = pd.concat(
+            [self.samples, 
+             pd.DataFrame({"sample": sample_names,
+                           "count_file": count_files,
+                           "md5": CountMatrixStore.getCountFileMd5s(count_files)})],
+            ignore_index=True)
+        
+        samples_temp_file = samples_file + "_temp"
+        
+        samples.to_csv(samples_temp_file, sep="\t", index=False)
+        
+        del self.counts
+        
+        with open(counts_file, "r+b") as handle:
             
-            read_pair_dict['read_pair_is_paired'] = read.is_paired
+            # Each sample is a column of the Fortran order matrix
+            handle.seek(data_offset + n_peaks * n_samples * dtype.itemsize)
+            handle.truncate()
             
-            read_pair_dict['read_pair_mapped_in_proper_pair'] = read.is_proper_pair
+            for column in columns:
+                handle.write(column.astype(dtype).tobytes())
             
-            # We only need one proper pair marked as duplicate for a read pair
-            # to consider it a duplicate. 
-            if read.is_duplicate:
-                read_pair_dict['read_pair_is_pcr_duplicate'] = read.is_duplicate
+            handle.flush()
+            os.fsync(handle.fileno())
             
-            # Check additional hits when the read pair happens
-            if read.has_tag("XA"):
-                
-                # If there are additional hits
-                if (len(read.get_tag("XA").split(","))>1):
-                    
-                    # If the score on the additional hit (XS) is as good or better
-                    # than the score of the original hit (AS)
-                    if (read.get_tag("AS") <= read.get_tag("XS")):
-                    
-                        read_pair_dict['proper_pair_additional_hit_equally_good'] = True
-                        
-            # Check chimeric hits (split reads)
-            if read.has_tag("SA"):
-                 
-                # If there are chimeric hits
-                if (len(read.get_tag("SA").split(","))>1):
-                    
-                    read_pair_dict['proper_pair_with_chimeric_read'] = True
+            handle.seek(0)
+            handle.write(header)
         
-        # Last command in the loop: update the last_read with
-        # the read currently viewed
-        last_read = read
+        os.replace(samples_temp_file, samples_file)
         
-        last_read_name = read.query_name
+        self.samples = pd.read_csv(samples_file, sep="\t", dtype=str)
+        self.counts = np.load(counts_file, mmap_mode="r")
         
+        return True
+    
+    # IDs of the peaks (contig:start-end)
+    def getIds(self):
         
-    # Process the last read
-    # We have seen all the reads from a pair, update the counters
-            
-    # Store everything updating the counters
-    c = getCorrectReadPairsUpdateCounters(c, read_pair_dict)
+        return (self.peaks["contig"] + ":" + 
+                self.peaks["start"].astype(str) + "-" + 
+                self.peaks["end"].astype(str)).values
     
-    createOutputStringFromCounters(c, stats_outfile)
+    # Numpy array with the counts of a sample
+    def getSampleCounts(self, sample):
+        
+        sample_index = self.samples["sample"].tolist().index(sample)
+        
+        return np.asarray(self.counts[:, sample_index])
+    
+    # Writes the counts as a table with the column id (see getIds) and a 
+    # column for each sample, in chunks of peaks
+    def writeTsv(self, outfile, threads=1, chunk_size=100000):
+        
+        ids = self.getIds()
+        
+        with openCompressedFile(outfile, "w", threads=threads) as writer:
+            
+            writer.write("\t".join(["id"] + self.samples["sample"].tolist()) 
+                         + "\n")
+            
+            for first in range(0, len(ids), chunk_size):
+                
+                chunk = pd.DataFrame(np.asarray(self.counts[first:first + chunk_size]),
+                                     index=ids[first:first + chunk_size])
+                
+                chunk.to_csv(writer, sep="\t", header=False, 
+                             line_terminator="\n")
 
 
 #------------------------------------------------------------------------------
-# Creates a statement to exclude from the infile the chrs
-# indicated in excluded_chrs and saves the processed file to outfile
+# Builds the CountMatrixStore of the tag counts files of the samples of a 
+# peak set (see CountMatrixStore.build).
 #
 # Inputs:
-#    -infile: peaks infile (compressed or uncompressed) to process.
-#    -excluded_chrs: list of chrs to exclude (separated by ,)
-#    -outfile: processed file without the chrs regions.
+#    -count_files: tag counts file of each sample
+#    -sample_names: name of each sample
+#    -outdir: directory of the store
 #
 # Outputs:
-#    -Writes the processed file to outfile.
-def createExcludingChrFromBedStatement(infile, excluded_chrs, outfile):
-    
-    statement = ""
+#    -Writes the store to outdir
+@cluster_runnable
+def buildCountMatrixStore(count_files, sample_names, outdir):
     
-    # If no excluded chrs provided just copy the file
-    if excluded_chrs == "":
-        statement = "cp "+infile+" "+outfile
-   
-    else:        
-        
-        # See the extension of the file to determine the cat/zcat command
-        _, file_extension = os.path.splitext(infile)
-        
-        if file_extension == ".gz":
-            statement = "zcat "  
-        else:   
-            statement = "cat "
-            
-        # Create the statement
-        statement += infile
-        statement += " | egrep -v '("
-        statement += excluded_chrs
-        statement += ")' | gzip -c > "
-        statement += outfile
-
-    return statement
+    CountMatrixStore.build(count_files, sample_names, outdir)
 
 
 #------------------------------------------------------------------------------
-# Given a contig_name, gets the corresponding length of the contig looking into 
-# contig_file for the corresponding contig_name. If it doesn't find it, returns
-# -1.
+# Updates the CountMatrixStore of the tag counts files of the samples of a 
+# peak set, when samples are added or their counts change:
+#    -If the samples and their counts (md5 of the tag counts files) are the 
+#        ones in the store, the store is not modified, so the tasks using it
+#        are not rerun.
+#    -If the samples in the store are unchanged and the new samples come 
+#        after them, only the new samples are read and added to the store 
+#        (see CountMatrixStore.addSamples).
+#    -Otherwise the store is rebuilt next to outdir from the previous one 
+#        (see CountMatrixStore.build), so only the tag counts files which 
+#        are new or have changed are read, and then replaces it.
+# Without a previous store the store is built from all the tag counts files.
 #
-# contig_file format:
-# chr1    2500000
-# chr2    170000
-# 
 # Inputs:
-#    -contig_name: Name of the contig
-#    -contig_file: Name of the contig file
+#    -count_files: tag counts file of each sample
+#    -sample_names: name of each sample
+#    -outdir: directory of the store
 #
 # Outputs:
-#    -contig_length: The length of the contig. If it doesn't find it, returns -1.
-def getContigLength(contig_name, contig_file):
+#    -Updates the store in outdir
+@cluster_runnable
+def updateCountMatrixStore(count_files, sample_names, outdir):
     
-    contig_length = -1
-    with open(contig_file, 'r') as reader:
-                    
-        for line in reader:  
-            # Remove the new line character from the line (avoids taking this into account downstream)
-            line = line.rstrip('\n') 
-            fields = line.split("\t")
+    previous = None
+    
+    if os.path.exists(os.path.join(outdir, "counts.npy")):
+        
+        previous = CountMatrixStore(outdir)
+        
+        md5s = CountMatrixStore.getCountFileMd5s(count_files)
+        
+        n_samples = len(previous.samples)
+        
+        # Whether the samples in the store are the first samples, unchanged
+        unchanged = ("" not in md5s and 
+                     previous.samples["sample"].tolist() == 
+                     list(sample_names[:n_samples]) and
+                     previous.samples["count_file"].tolist() == 
+                     list(count_files[:n_samples]) and
+                     previous.getMd5s() == md5s[:n_samples])
+        
+        if unchanged and n_samples == len(count_files):
+            E.info("%s is up to date, not modified" % outdir)
+            return
+        
+        if unchanged and previous.addSamples(count_files[n_samples:], 
+                                             sample_names[n_samples:]):
             
-            if( fields[0] == contig_name):
-                # Get the fragment length
-                contig_length = fields[1]
-                break
+            # So that the tasks using the store are rerun
+            os.utime(outdir)
             
-    return contig_length
+            E.info("%s: %i tag counts files added" 
+                   % (outdir, len(count_files) - n_samples))
+            return
+    
+    outdir_temp = outdir + "_temp"
+    
+    if os.path.exists(outdir_temp):
+        shutil.rmtree(outdir_temp)
+    
+    read = CountMatrixStore.build(count_files, sample_names, outdir_temp, 
+                                  previous=previous)
+    
+    E.info("%s: %i of %i tag counts files read" 
+           % (outdir, read, len(count_files)))
+    
+    del previous
+    
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    
+    os.rename(outdir_temp, outdir)
 
 
 #------------------------------------------------------------------------------
-# Performs a lot faster if the infile has been previously chromosome sorted            
-# First checks that all the bed segments don't surpass the start and end of the chr.
-# Regions for which its ends are before the beginning of the chr, are considered empty and disregarded.
-# Regions for which its starts are after the end of the chr, are considered empty and disregarded.
-# After those filters, starts which are past the beginning of the chr are put at 0
-# and ends which are past the end of the chr are put at the chromosome length
-# Any regions where the start and end positions mean the region is empty are disregarded.
+# Writes the counts of a CountMatrixStore as a table (see 
+# CountMatrixStore.writeTsv) for the R scripts.
+#
 # Inputs:
-#    -infile: bed file with strand information after being processed with bedtools slop.
-#             In theory, any bed file should serve since all fields are outputted, this includes bedgraph files.
-#             Tested formats:
-#             -bed:    chr1    0    100
-#             -bedgraph:    chr1    0    100    1.2345
-#             -bed6 (with strand): chr1    10213   10256   HSQ-700220:198:C5WA4ACXX:5:1304:17892:7253      7       +
-#    -contigs: file with contig \t length pairs for the infile
-#    -outfile: processed file eliminating the problems described above
-#    -log_file: Any deleted or modified regions are logged here.
+#    -indir: directory of the store
+#    -outfile: table (BGZF compressed if the name ends with .gz)
+#    -threads: Number of threads compressing the outfile
 #
 # Outputs:
-#    processed contents to the outfile
-#    Exception if a contig is not found in the list of contigs.
+#    -Writes the outfile
 @cluster_runnable
-def correctSlopChromosomeEdges(infile, contigs, outfile, log_file):
-
-    with IOTools.open_file(outfile, "w") as writer, \
-         IOTools.open_file(log_file, "w") as log:
-
-        last_contig = "first"    
-        contig_length = -1
-    
-        # Go through each region
-        for bed_region in Bed.iterator(IOTools.open_file(infile, "r")):
-            
-            # Create and output bed copying the details
-            output_bed = bed_region.copy() 
-            if bed_region.contig != last_contig:
-                # Get the contig length
-                contig_length = int(getContigLength(bed_region.contig, contigs))
-                last_contig = bed_region.contig
-                 
-            # If a contig length is not found in the contigs file raise an exception
-            if contig_length == -1:        
-                raise Exception("Correcting positions, contig "+bed_region.contig+ " not found in the list of contigs: "+contigs)
- 
-            # Start >= length of chromosome
-            if (bed_region.start >= contig_length):
-                log.write("Correcting positions, file: "+infile+"."
-                          +" Eliminating bed region: "+str(bed_region)+
-                          " start >= contig length "+str(contig_length)+ "\n")
-                
-                # Skip outputting this bed
-                continue
-            
-            # end <= 0
-            if (bed_region.end <= 0):
-                log.write("Correcting positions, file: "+infile+"."
-                          +" Eliminating bed region: "+str(bed_region)+
-                          " end <= 0\n")
-                
-                # Skip outputting this bed
-                continue
-            
-            # End surpassing contig length, correct    
-            if (bed_region.end > contig_length):
-                
-                # The last allowable position is the end of the chromosome base
-                # The end coordinate is not included in the region
-                output_bed.end = contig_length
-                
-                log.write("Correcting positions, file: "+infile+"."
-                          +" End surpassing length of chromosome. "
-                          +"Before: "+str(bed_region)+
-                          " Now: "+str(output_bed)+"\n")
-                
-            
-            # End surpassing contig beginning, correct
-            if (bed_region.start < 0):
-                
-                # The last allowable position is the end of the chromosome base
-                output_bed.start = 0
-                
-                log.write("Correcting positions, file: "+infile+"."
-                          +" Beginning surpassing beginning of chromosome. "
-                          +"Before: "+str(bed_region)+
-                          " Now: "+str(output_bed)+"\n")
-                
-            
-            
-            
-            # At this point all the points in the region can't exceed the chromosome edges, now verify if the
-            # region is not empty/is adequate (start < end)
-            if output_bed.start >= output_bed.end:
-                
-                # Print reason to disregard in the log
-                log.write("Correcting positions, file: "+infile+
-                          "Start equal or larger than end (empty). "
-                          +"Start: " +str(output_bed.start)+
-                          " End: " +str(output_bed.end)+ "\n")
-            
-            # If it gets here the bed file can be outputted
-            else:
-                
-                writer.write(str(output_bed))
-                writer.write("\n")
+def exportCountMatrixStore(indir, outfile, threads=1):
+    
+    CountMatrixStore(indir).writeTsv(outfile, threads=threads)
 
 
-# Creates a statement to exclude from the peaks infile the bed regions
-# indicated in excluded_beds and saves the processed file to outfile
+#------------------------------------------------------------------------------
+# Writes tagAlign lines (BED 3+3 with name N and score 1000)
 #
 # Inputs:
-#    -infile: bed infile (compressed or uncompressed) to process.
-#    -excluded_beds: list of chrs to exclude (separated by |)
-#    -outfile: processed file without the chrs.
+#    -writer: open file
+#    -contig: contig of the tags
+#    -starts: numpy array with the starts
+#    -ends: numpy array with the ends
+#    -reverse: boolean numpy array, True for the - strand
 #
 # Outputs:
-#    -Writes the processed file to outfile.
-def createExcludingBedsFromBedStatement(infile, excluded_beds, outfile):
-    
-    statement = ""
-    
-    # Get the string into a list, separating the elements
-    try:
-        list_excluded_beds = excluded_beds.split(",")
-    except AttributeError:
-        list_excluded_beds = excluded_beds
-    
-    # If no excluded beds provided just copy the file
-    if len(list_excluded_beds) == 0:
-        
-        statement = "cp "+infile+" "+outfile
+#    -writes the lines to the writer
+def writeTagAlignLines(writer, contig, starts, ends, reverse):
     
+    strands = np.where(reverse, "-", "+")
     
-    else:                    
-        
-        # Create the statement
-        # Because sometimes inputing a compressed file to bedtools intersect
-        # can cause problems (https://github.com/arq5x/bedtools2/issues/513)
-        # The file is zcat first and inputted to bedtools intersect -a stdin
-        if infile.endswith(".gz"):
-            statement += "zcat "+infile
-            
-        else:
-            statement += "cat "+infile
-        
-        statement += " | bedtools intersect -v -a stdin"
-        statement += " -b "
-        
-        for excluded_bed in list_excluded_beds:
-            statement += excluded_bed
-            statement += " "
-        
-        statement += " | gzip -c > "
-        statement += outfile
-            
-    return statement
-                 
+    writer.write("".join(["%s\t%i\t%i\tN\t1000\t%s\n" % (contig, start, end, strand)
+                          for start, end, strand in zip(starts.tolist(),
+                                                        ends.tolist(),
+                                                        strands.tolist())]))
 
 
-
-# Creates a statement to exclude from the peaks infile the bed regions
-# indicated in excluded_beds and saves the processed file to outfile
+#------------------------------------------------------------------------------
+# Goes once through the deduplicated position sorted Bam file and creates the
+# Tn5 shifted single ends entering the peak calling, doing in memory what
+# was done with a tagAlign file per step:
+#    -Virtual single ends (bedtools bamtobed, name N and score 1000)
+#    -Excludes the contigs matching excluded_chrs (egrep -v)
+#    -Shifts the + strand starts by +4 and the - strand ends by -5 (Tn5 cut
+#        sites) and corrects any 5' trimming (five_prime_correction)
+#    -Corrects the chromosome edges (see correctContigEdges)
+#    -Excludes the single ends overlapping the regions of the exclusion_index
+#        (bedtools intersect -v)
+# The reads are processed in chunks of a contig.
 #
 # Inputs:
-#    -infile: bed infile (compressed or uncompressed) to process.
-#    -excluded_beds: list of chrs to exclude (separated by |)
-#    -outfile: processed file without the chrs.
+#    -infile: deduplicated position sorted Bam file
+#    -outfile: tagAlign with the shifted single ends not overlapping the
+#        excluded regions. If None it is not written.
+#    -contigs: file with contig \t length pairs for the infile
+#    -excluded_chrs: contigs to exclude (separated by |), partial matching
+#    -exclusion_index: .npz created with ExclusionIndex.build with the 
+#        regions to exclude. If None no regions are excluded.
+#    -five_prime_correction: bp trimmed from the 5' ends of the reads. The
+#        correction is -correction on the start of the + strand and
+#        +correction on the end of the - strand
+#    -shifted_outfile: If specified, tagAlign with the shifted single ends
+#        before excluding the regions
+#    -log_file: Summary of the tags excluded or corrected in each step
+#    -tagalign_outfile: If specified, tagAlign with the virtual single ends
+#    -contig_filtered_outfile: If specified, tagAlign with the virtual single 
+#        ends after excluding the contigs
+#    -threads: Number of threads for the BGZF decompression of the Bam file
+#        and the compression of each outfile
 #
 # Outputs:
-#    -Writes the processed file to outfile.
+#    -writes the outfiles, each with its manifest (see ManifestWriter)
+#
+# Exception:
+#    -If the contig of a tag kept is not found in the list of contigs.
 @cluster_runnable
-def createExcludingBedsFromBedStatement(infile, excluded_beds, outfile):
+def processTagAlign(infile,
+                    outfile,
+                    contigs,
+                    excluded_chrs="",
+                    exclusion_index=None,
+                    five_prime_correction=0,
+                    shifted_outfile=None,
+                    log_file=os.devnull,
+                    tagalign_outfile=None,
+                    contig_filtered_outfile=None,
+                    threads=1):
     
-    statement = ""
+    chunk_size = 100000
     
-    # Get the string into a list, separating the elements
-    if isinstance(excluded_beds, str):
-        list_excluded_beds = list(excluded_beds)
-    else:
-        list_excluded_beds = excluded_beds
-
-    # If no excluded beds provided just copy the file
-    if len(list_excluded_beds) == 0:
-        
-        statement = "cp "+infile+" "+outfile
+    contig_registry = ContigRegistry.fromFile(contigs, excluded_chrs)
+    
+    if exclusion_index is not None:
+        exclusion_index = ExclusionIndex(exclusion_index)
+    
+    samfile = pysam.AlignmentFile(infile, "rb", threads=threads)
+    
+    references = samfile.references
     
+    # Contig ID of each reference_id, the contigs not in the contig file are
+    # registered without length
+    reference_contig_ids = contig_registry.getIds(references, register=True)
     
-    else:                    
+    outfiles = [outfile, shifted_outfile, tagalign_outfile, 
+                contig_filtered_outfile]
+    
+    writer, shifted_writer, tagalign_writer, contig_filtered_writer = \
+        [ManifestWriter(f, threads=threads) if f is not None else None 
+         for f in outfiles]
+    
+    counts = collections.OrderedDict([("tags", 0),
+                                      ("excluded_contig", 0),
+                                      ("outside_contig", 0),
+                                      ("clipped_to_contig", 0),
+                                      ("empty_after_clipping", 0),
+                                      ("shifted", 0),
+                                      ("excluded_regions", 0),
+                                      ("filtered", 0)])
+    
+    # Current chunk
+    chunk_reference_id = -1
+    chunk_starts = array.array("l")
+    chunk_ends = array.array("l")
+    chunk_reverse = array.array("b")
+    
+    def processChunk():
         
-        # Create the statement
-        # Because sometimes inputing a compressed file to bedtools intersect
-        # can cause problems (https://github.com/arq5x/bedtools2/issues/513)
-        # The file is zcat first and inputted to bedtools intersect -a stdin
-        if infile.endswith(".gz"):
+        contig = references[chunk_reference_id]
+        
+        contig_id = reference_contig_ids[chunk_reference_id]
+        
+        starts = np.array(chunk_starts, dtype=np.int64)
+        ends = np.array(chunk_ends, dtype=np.int64)
+        reverse = np.array(chunk_reverse, dtype=bool)
+        
+        counts["tags"] += len(starts)
+        
+        if tagalign_writer is not None:
+            writeTagAlignLines(tagalign_writer, contig, starts, ends, reverse)
+        
+        if contig_registry.isExcluded(contig_id):
+            counts["excluded_contig"] += len(starts)
+            return
+        
+        if contig_filtered_writer is not None:
+            writeTagAlignLines(contig_filtered_writer, contig, 
+                               starts, ends, reverse)
+        
+        contig_length = contig_registry.getLength(contig_id)
+        
+        if contig_length == -1:
+            raise Exception("Correcting positions, contig " + contig + 
+                            " not found in the list of contigs: " + contigs)
+        
+        # Tn5 shift and 5' correction
+        starts = np.where(reverse, starts, starts + 4 - five_prime_correction)
+        ends = np.where(reverse, ends - 5 + five_prime_correction, ends)
+        
+        # Chromosome edges
+        starts, ends, outside, clipped, empty = \
+            correctContigEdges(starts, ends, contig_length)
+        
+        counts["outside_contig"] += int(outside.sum())
+        counts["clipped_to_contig"] += int(clipped.sum())
+        counts["empty_after_clipping"] += int(empty.sum())
+        
+        kept = ~(outside | empty)
+        
+        starts = starts[kept]
+        ends = ends[kept]
+        reverse = reverse[kept]
+        
+        counts["shifted"] += len(starts)
+        
+        if shifted_writer is not None:
+            writeTagAlignLines(shifted_writer, contig, starts, ends, reverse)
+        
+        # Excluded regions
+        if exclusion_index is not None:
+            kept = ~exclusion_index.maskOverlapping(
+                np.full(len(starts), exclusion_index.contigs.getId(contig), 
+                        dtype=np.int64),
+                starts, ends)
+        else:
+            kept = np.ones(len(starts), dtype=bool)
+        
+        counts["excluded_regions"] += len(starts) - int(kept.sum())
+        counts["filtered"] += int(kept.sum())
+        
+        if writer is not None:
+            writeTagAlignLines(writer, contig, 
+                               starts[kept], ends[kept], reverse[kept])
+    
+    try:
+        
+        for read in samfile:
             
-            statement += "zcat "+infile
+            if read.is_unmapped:
+                continue
             
-        else:
+            if read.reference_id != chunk_reference_id or \
+               len(chunk_starts) == chunk_size:
+                
+                if len(chunk_starts) > 0:
+                    processChunk()
+                
+                chunk_reference_id = read.reference_id
+                chunk_starts = array.array("l")
+                chunk_ends = array.array("l")
+                chunk_reverse = array.array("b")
             
-            statement += "cat "+infile
+            chunk_starts.append(read.reference_start)
+            chunk_ends.append(read.reference_end)
+            chunk_reverse.append(read.is_reverse)
         
-        statement += " | bedtools intersect -v -a stdin"
-        statement += " -b "
+        if len(chunk_starts) > 0:
+            processChunk()
+    
+    finally:
         
-        for excluded_bed in list_excluded_beds:
-            
-            statement += excluded_bed
-            statement += " "
+        samfile.close()
         
+        for open_writer in [writer, shifted_writer, tagalign_writer, 
+                            contig_filtered_writer]:
+            if open_writer is not None:
+                open_writer.close()
+    
+    with open(log_file, "w") as log:
         
-        statement += " | gzip -c > "
-        statement += outfile
+        for category, count in counts.items():
+            log.write("%s\t%i\n" % (category, count))
 
-            
-    return statement
 
 def gene_to_transcript_map(infile, outfile):
     '''Parses infile GTF and extracts mapping of transcripts to gene, outputs
@@ -883,8 +5536,9 @@ def gene_to_transcript_map(infile, outfile):
 
 
 @cluster_runnable
-def merge_counts(infiles, outfiles):
-    ''' Take salmon inputs from each file and produce a matrix of counts'''
+def merge_counts(infiles, outfiles, threads=1):
+    ''' Take salmon inputs from each file and produce a matrix of counts.
+    The outfiles are written as BGZF with threads compressing'''
     transcript_infiles = [x[0] for x in infiles]
     gene_infiles = [x[1] for x in infiles]
 
@@ -901,17 +5555,19 @@ def merge_counts(infiles, outfiles):
         final_df = final_df.round()
         final_df.sort_index(inplace=True)
         final_df.columns = [re.sub("_RNA", "", x) for x in final_df.columns]
-        final_df.to_csv(outfile, sep="\t", compression="gzip")
+        with BgzfWriter(outfile, threads=threads) as writer:
+            final_df.to_csv(writer, sep="\t")
 
     mergeinfiles(transcript_infiles, transcript_outfile)
     mergeinfiles(gene_infiles, gene_outfile)
 
 
 @cluster_runnable
-def merge_atac_and_rna_de(atac_file, rna_file, outfile, logfile):
+def merge_atac_and_rna_de(atac_file, rna_file, outfile, logfile, threads=1):
     '''Take a table of differentially accessbile peaks (that have been
     annotated with genes) and a table of differentially expressed genes,
-    and combine the two'''
+    and combine the two. The outfile is written as BGZF with threads 
+    compressing'''
     
     logf = IOTools.open_file(logfile, "w")
 
@@ -991,14 +5647,65 @@ def merge_atac_and_rna_de(atac_file, rna_file, outfile, logfile):
     merged_df.drop(["id"], axis=1, inplace=True);
 
    # Output the table (NA -> "")
-    merged_df.to_csv(outfile,
-             sep="\t",
-             header=True,
-             compression="gzip",
-             mode="w",
-             index_label=None,
-             index=False,
-             na_rep="",
-             line_terminator="\n")
+    with BgzfWriter(outfile, threads=threads) as writer:
+        merged_df.to_csv(writer,
+                 sep="\t",
+                 header=True,
+                 index_label=None,
+                 index=False,
+                 na_rep="",
+                 line_terminator="\n")
 
     logf.close()
+
+
+#------------------------------------------------------------------------------
+# Command line interface for the P.run statements (see getBgzipCommand):
+#    python pipelineAtacseq.py bgzip [-d] [-@ threads] [-l compresslevel]
+# compresses stdin to stdout as BGZF, or decompresses it with -d (any gzip).
+def main(argv=None):
+    
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="pipelineAtacseq tools")
+    
+    subparsers = parser.add_subparsers(dest="command")
+    
+    bgzip_parser = subparsers.add_parser("bgzip", 
+                                         help="BGZF compress stdin to stdout")
+    bgzip_parser.add_argument("-d", "--decompress", action="store_true",
+                              help="Decompress instead")
+    bgzip_parser.add_argument("-@", "--threads", type=int, default=1,
+                              help="Number of threads")
+    bgzip_parser.add_argument("-l", "--compresslevel", type=int, 
+                              default=FINAL_COMPRESSION_LEVEL,
+                              help="zlib compression level")
+    
+    args = parser.parse_args(argv)
+    
+    if args.command != "bgzip":
+        parser.print_help()
+        return 1
+    
+    if args.decompress:
+        
+        with BgzfReader(sys.stdin.buffer, threads=args.threads) as reader:
+            for data in reader.iterateData():
+                sys.stdout.buffer.write(data)
+        
+        sys.stdout.buffer.flush()
+    
+    else:
+        
+        with BgzfWriter(sys.stdout.buffer, 
+                        compresslevel=args.compresslevel,
+                        threads=args.threads) as writer:
+            
+            for data in iter(lambda: sys.stdin.buffer.read(1 << 22), b""):
+                writer.write(data)
+    
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
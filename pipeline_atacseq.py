@@ -1,5 +1,4 @@
 from ruffus import follows, transform, add_inputs, mkdir, regex, formatter, merge, subdivide, files, collate, suffix, inputs
-from ruffus.combinatorics import product
 #from ruffus.combinatorics import *
 
 import sys
@@ -43,65 +42,50 @@ PARAMS = P.get_parameters(
            regex("(.+).bam"),
            r"stats.dir/\1.after_mapping.tsv")
 def getInitialMappingStats(infile, outfile):
-    ''' Gets the initial mapping rate in terms of total reads '''
+    ''' Gets the initial mapping rate in terms of total reads. The counting
+    doesn't depend on the order of the reads, so the coordinate sorted
+    mapping file is used directly '''
     
     # Get the temporal dir specified
     tmp_dir = PARAMS["general_temporal_dir"]
     
-    
-    # The mapping file is sorted by coordinate, first sort by readname
-    temp_file = P.snip(outfile, ".tsv") + ".bam"
-    
-    log_file = P.snip(outfile, ".tsv") + ".log"
-    
-    # Samtools creates temporary files with a certain prefix, create a temporal directory name
-    samtools_temp_dir = tempfile.mkdtemp(dir=tmp_dir)
-    
-    samtools_temp_file = os.path.join(samtools_temp_dir, "temp")
-    
-    disk_space_file = P.snip(outfile, ".tsv") + ".txt"
-        
-    statement = ''' mkdir -p %(samtools_temp_dir)s &&
-                    samtools sort -n -o %(temp_file)s 
-                                    -T %(samtools_temp_file)s %(infile)s 
-                                    2> %(log_file)s 
-    '''
-    
-    
-    # Execute the statement
-    P.run(statement)
-    
     # Get the stats
-    pipelineAtacseq.getMappedUnmappedReads(temp_file, 
-                       outfile, 
-                       submit=True)
-    
-    # Remove the temporal file
-    statement = '''rm %(temp_file)s; 
-    '''
-    
-    # Execute the statement
-    P.run(statement)
+    pipelineAtacseq.getMappedUnmappedReadsAnyOrder(infile, 
+                                                   outfile,
+                                                   tmp_dir=tmp_dir,
+                                                   threads=PARAMS["stats_threads"],
+                                                   write_name_sets=PARAMS["stats_read_name_sets"],
+                                                   submit=True,
+                                                   job_memory="4G",
+                                                   job_threads=PARAMS["stats_threads"])
 
 
 #-----------------------------------------------------------------------------
 @follows(mkdir("first_filtering.dir"))
 @transform("*.bam",
            regex("(.+).bam"),
-           r"first_filtering.dir/\1.bam")
-def filterOutIncorrectPairsAndExcessiveMultimappers(infile, outfile):
+           [r"first_filtering.dir/\1.bam",
+            r"first_filtering.dir/\1.after_first_filter.tsv"] +
+           ([r"first_filtering.dir/\1.after_first_filter.mapped.names.npy",
+             r"first_filtering.dir/\1.after_first_filter.unmapped.names.npy"]
+            if PARAMS.get("stats_read_name_sets") else []))
+def filterOutIncorrectPairsAndExcessiveMultimappers(infile, outfiles):
     
     '''Assuming a starting compressed coordinate sorted bam file. 
     Remove  unmapped, mate unmapped and reads failing platform. Keep only
     properly mapped pairs. Sort by name and filter out proper mapped pairs with
-    more than the defined number of proper pair alignments'''
+    more than the defined number of proper pair alignments. 
+    The name sorted proper pairs are filtered straight from the sort, and
+    the mapping stats of the filtered reads are created in the same pass
+    (first_filtering.dir/<sample>.after_first_filter.tsv and the read name
+    sets with stats read_name_sets) for getFirstFilteringStats'''
      
+    outfile, stats_file = outfiles[:2]
+    
     allowed_multimappers = PARAMS["filtering_allowed_multimapper_proper_pairs"]
     
     
     log_file = P.snip(outfile, ".bam") + ".log"
-    
-    first_filtering_bam_output = P.snip(outfile, ".bam") + "_proper_pairs.bam"
        
     # Get the temporal dir specified
     tmp_dir = PARAMS["general_temporal_dir"]
@@ -109,23 +93,23 @@ def filterOutIncorrectPairsAndExcessiveMultimappers(infile, outfile):
     # Temp file: We create a temp file to make sure the whole process goes well
     # before the actual outfile is created
     temp_file = P.snip(outfile, ".bam") + "_temp.bam"
-      
-    # Samtools creates temporary files with a certain prefix
-    samtools_temp_file = (tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
     
-    scripts_dir = os.path.join(os.path.dirname(__file__), "scripts")
-
-
-    statement = '''samtools view -F 524 -f 2 -u %(infile)s | 
-                   samtools sort -n - -o %(first_filtering_bam_output)s 
-                                  -T %(samtools_temp_file)s 2> %(log_file)s &&
-                   samtools view -h %(first_filtering_bam_output)s | 
-                %(scripts_dir)s/assign_multimappers.py -k %(allowed_multimappers)s --paired-end | 
-    samtools view -bS - -o %(temp_file)s 2>> %(log_file)s &&    
-    mv %(temp_file)s %(outfile)s &&    
-    rm %(first_filtering_bam_output)s
+    pipelineAtacseq.filterProperPairsAndMultimappers(infile,
+                                                     temp_file,
+                                                     stats_file,
+                                                     allowed_multimappers,
+                                                     paired_end=True,
+                                                     threads=PARAMS["filtering_threads"],
+                                                     tmp_dir=tmp_dir,
+                                                     log_file=log_file,
+                                                     write_name_sets=len(outfiles) > 2,
+                                                     submit=True,
+                                                     job_memory="4G",
+                                                     job_threads=PARAMS["filtering_threads"])
+    
+    statement = '''mv %(temp_file)s %(outfile)s
     '''
-
+    
     P.run(statement)
 
 
@@ -133,44 +117,18 @@ def filterOutIncorrectPairsAndExcessiveMultimappers(infile, outfile):
 @follows(mkdir("stats.dir"))
 @transform(filterOutIncorrectPairsAndExcessiveMultimappers,
            regex(".+/(.+).bam"),
-           r"stats.dir/\1.after_first_filter.tsv")
-def getFirstFilteringStats(infile, outfile):
-    ''' Gets the mapping rate in terms of total reads after the first filtering '''
-    
-    # Get the temporal dir specified
-    tmp_dir = PARAMS["general_temporal_dir"]
-    
-    
-    # The mapping file is sorted by coordinate, first sort by readname
-    temp_file = P.snip(outfile, ".tsv") + ".bam"
-    
-    log_file = P.snip(outfile, ".tsv") + ".log"
-    
-    # Samtools creates temporary files with a certain prefix, create a temporal directory name
-    samtools_temp_dir = tempfile.mkdtemp(dir=tmp_dir)
+           [r"stats.dir/\1.after_first_filter.tsv"] +
+           ([r"stats.dir/\1.after_first_filter.mapped.names.npy",
+             r"stats.dir/\1.after_first_filter.unmapped.names.npy"]
+            if PARAMS.get("stats_read_name_sets") else []))
+def getFirstFilteringStats(infiles, outfiles):
+    ''' Gets the mapping rate in terms of total reads after the first filtering.
+    The stats (and read name sets) are created by 
+    filterOutIncorrectPairsAndExcessiveMultimappers '''
+    
+    statement = " && ".join("cp %s %s" % (infile, outfile) 
+                            for infile, outfile in zip(infiles[1:], outfiles))
     
-    samtools_temp_file = os.path.join(samtools_temp_dir, "temp")
-    
-    disk_space_file = P.snip(outfile, ".tsv") + ".txt"
-        
-    statement = ''' mkdir -p %(samtools_temp_dir)s &&
-      samtools sort -n -o %(temp_file)s -T %(samtools_temp_file)s %(infile)s 2> %(log_file)s;
-    '''
-    # Execute the statement
-    P.run(statement)
-
-    
-    # Get the stats
-    pipelineAtacseq.getMappedUnmappedReads(temp_file, 
-                       outfile, 
-                       submit=True,
-                       job_memory="6G")
-    
-    # Remove the temporal file
-    statement = '''rm %(temp_file)s; 
-    '''
-    
-    # Execute the statement
     P.run(statement)
 
 
@@ -179,13 +137,15 @@ def getFirstFilteringStats(infile, outfile):
 @transform(filterOutIncorrectPairsAndExcessiveMultimappers,
            regex(".+/(.+).bam"),
            r"second_filtering.dir/\1.bam")
-def filterOutOrphanReadsAndDifferentChrPairs(infile, outfile):
+def filterOutOrphanReadsAndDifferentChrPairs(infiles, outfile):
     
     ''' Remove orphan reads (pair was removed) and read pairs mapping to different 
     chromosomes and read pairs which are "facing against one another" with no overlap. 
     Obtain position sorted BAM. Assumes a starting read name sorted BAM file.
     '''
     
+    infile = infiles[0]
+    
     # Get the sample name
     sample_name , _ = os.path.splitext(os.path.basename(outfile))
     
@@ -197,7 +157,6 @@ def filterOutOrphanReadsAndDifferentChrPairs(infile, outfile):
     
     integer_five_prime_correction = 0
     
-    # To avoid putting "--"
     # Correction is going to be -correction on the start of the + strand
     # Correction is going to be +correction on the end of the - strand
     try:
@@ -205,18 +164,6 @@ def filterOutOrphanReadsAndDifferentChrPairs(infile, outfile):
     except ValueError:
         raise Exception("Five prime trimming argument needs to be an integer.") 
     
-    # String with the correction to apply (Eg. "- 2", "+ 5")
-    positive_strand_correction = ""
-    negative_strand_correction = ""
-    
-    if integer_five_prime_correction < 0:
-        positive_strand_correction = "+ "+str(abs(integer_five_prime_correction))
-        negative_strand_correction = "- "+str(abs(integer_five_prime_correction))
-    elif integer_five_prime_correction > 0:
-        positive_strand_correction = "- "+str(abs(integer_five_prime_correction))
-        negative_strand_correction = "+ "+str(abs(integer_five_prime_correction))
-    
-    # 0 Case: no correction, empty string
     log_file = P.snip(outfile, ".bam") + ".log"  
     
     # Get the temporal dir specified
@@ -225,75 +172,28 @@ def filterOutOrphanReadsAndDifferentChrPairs(infile, outfile):
     # Temp file: We create a temp file to make sure the whole process goes well
     # before the actual outfile is created
     temp_file = P.snip(outfile, ".bam") + "_temp.bam"
-      
-    # Samtools creates temporary files with a certain prefix
-    samtools_temp_file = (tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name 
-    first_filtering_bam_output = P.snip(outfile, ".bam") + "_proper_pairs.bam"
     
-    # Fixmate seems to fix read pairs which are in different chromosomes but not
-    # read pairs "facing away" from each other 
-    # Intermediate file outputted to process these cases
-    read_name_processing_input_bam = (
-        tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name + ".bam"
-
-    read_name_processing_problematic_reads = (
-        tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
-
-    read_name_processing_output_bam = (
-        tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name + ".bam"
-    
-    # Reads are already read name sorted, so fixmate can be run
-    # Next filter the "wrong pairs" and get the read names of read pairs with
-    # each pair on a different chror "facing away" from each other with no
-    # overlap:
+    # The read pairs are checked in memory as samtools fixmate -r,
+    # samtools view -F 1804 -f 2 and the removal of read pairs with
+    # each pair "facing away" from each other with no overlap:
     # <----------                    <--------
     #           --------> Allowed             --------> Not allowed
     # Because the enzyme introduces 4 bp in the start of + strand and 5bp in the
-    # start of the - strand(end coordinate in bedpe file) a minumum overlap of 
-    # 10
+    # start of the - strand a minumum overlap of 10 is needed.
     # The 5' ends of the reads is previously extended by any cuts performed in qc
     # which are indicated.
-
-    # Get a bed with both ends of a read pair in each line
-    # and extract the problematic read names from there.
-    # Then filter them out with picard FilterSamReads
-    statement = '''samtools fixmate -r %(infile)s %(first_filtering_bam_output)s 
-                                    2> %(log_file)s &&
-                   
-                   samtools view -F 1804 -f 2 -u %(first_filtering_bam_output)s 
-                                 -o %(read_name_processing_input_bam)s 
-                                2>> %(log_file)s &&    
-                   
-                   bedtools bamtobed -bedpe -i %(read_name_processing_input_bam)s 
-                   | awk '($1!=$4 || 
-                           ($10=="+" && $9=="-" && 
-                            ($3-1%(negative_strand_correction)s-5)<($5%(positive_strand_correction)s+4))) 
-                          {printf ("%%s\\n", $7)}'
-                           > %(read_name_processing_problematic_reads)s 
-                           2>> %(log_file)s &&
-    
-    if [ -s %(read_name_processing_problematic_reads)s ]; 
-        then 
-        FilterSamReads I=%(read_name_processing_input_bam)s 
-                       O=%(read_name_processing_output_bam)s 
-                       READ_LIST_FILE=%(read_name_processing_problematic_reads)s 
-                            FILTER=excludeReadList 2>> %(log_file)s;
-    else 
-        ln -s %(read_name_processing_input_bam)s %(read_name_processing_output_bam)s;
-    fi &&
-     
-    samtools sort %(read_name_processing_output_bam)s 
-                  -o %(temp_file)s -T %(samtools_temp_file)s 2>> %(log_file)s &&
-
-    mv %(temp_file)s %(outfile)s &&
-    
-    rm %(first_filtering_bam_output)s 
-       %(read_name_processing_input_bam)s 
-       %(read_name_processing_problematic_reads)s 
-       %(read_name_processing_output_bam)s;
-    '''
-    
-    job_memory="4G"
+    # The reads kept go straight into the position sort
+    pipelineAtacseq.filterPairGeometry(infile,
+                                       temp_file,
+                                       five_prime_correction=integer_five_prime_correction,
+                                       threads=PARAMS["filtering_threads"],
+                                       tmp_dir=tmp_dir,
+                                       log_file=log_file,
+                                       submit=True,
+                                       job_memory="4G",
+                                       job_threads=PARAMS["filtering_threads"])
+    
+    statement = '''mv %(temp_file)s %(outfile)s'''
 
     P.run(statement)
 
@@ -306,33 +206,25 @@ def filterOutOrphanReadsAndDifferentChrPairs(infile, outfile):
            r"dedupped.dir/\1.bam")
 def markDuplicates(infile, outfile):
     
-    ''' Use picard to mark duplicates in BAM files (not deleted).
-    The files are assumed to be coordinate sorted'''
-    
-    # Used to be 5G
-    job_memory = "8G"
-    
-    # Get the temporal dir specified
-    tmp_dir = PARAMS["general_temporal_dir"]
-    
-    # Temporal dir, to prevent the "No space left on device" error
-    temp_dir = tempfile.mkdtemp(dir=tmp_dir)
+    ''' Mark duplicates in BAM files (not deleted) as picard MarkDuplicates
+    does for read pairs (without optical duplicates), writing a picard
+    style metrics file. The files are assumed to be coordinate sorted'''
     
     # Temp file: We create a temp file to make sure the whole process goes well
     # before the actual outfile is created
     temp_file = P.snip(outfile, ".bam") + "_temp.bam"
-
-    statement = ''' MarkDuplicates
-                     ASSUME_SORTED=True 
-                     INPUT=%(infile)s
-                     OUTPUT=%(temp_file)s
-                     VALIDATION_STRINGENCY=LENIENT
-                     METRICS_FILE=%(outfile)s.metrics
-                     REMOVE_DUPLICATES=false
-                     TMP_DIR=%(temp_dir)s
-                   > %(outfile)s.log &&
-                   
-                   mv %(temp_file)s %(outfile)s '''
+    
+    metrics_file = outfile + ".metrics"
+    
+    pipelineAtacseq.markDuplicatesPairedEnd(infile,
+                                            temp_file,
+                                            metrics_file,
+                                            threads=PARAMS["filtering_threads"],
+                                            submit=True,
+                                            job_memory="4G",
+                                            job_threads=PARAMS["filtering_threads"])
+    
+    statement = '''mv %(temp_file)s %(outfile)s'''
 
     P.run(statement)
 
@@ -345,8 +237,8 @@ def markDuplicates(infile, outfile):
 def getPostDuplicationStats(infile, outfile):
      
     ''' Assuming multimapping is allowed (multiple best alignments can occur)
-    Sort the reads by readname, make filterings and get the number
-    unique pair mappings:
+    Sort the reads by readname and, in a single pass over the sorted file, 
+    get the number unique pair mappings:
     1) Correctly mapped pairs and primary alignments only.
     2) Correctly mapped pairs and primary or secondary alignments.
     3) Correctly mapped pairs and secondary alignments only.
@@ -357,8 +249,6 @@ def getPostDuplicationStats(infile, outfile):
     tmp_dir = PARAMS["general_temporal_dir"] 
     sorted_bam = P.snip(outfile, ".tsv") + "_sorted.bam"
     log_file = P.snip(outfile, ".tsv") + ".log"
-    bam_outfile_sec = P.snip(outfile, ".tsv") + "_sec.bam"
-    bam_outfile_primary = P.snip(outfile, ".tsv") + "_prim.bam"
     
     
     # Samtools creates temporary files with a certain prefix
@@ -366,57 +256,61 @@ def getPostDuplicationStats(infile, outfile):
         tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
      
     # First sort the bamfile
-    # Then get only the primary alignments 
     statement = '''samtools sort -n 
                             -o %(sorted_bam)s 
                             -T %(samtools_temp_file)s 
                             %(infile)s 
-                            2> %(log_file)s &&
-    
-                   samtools view -h -F 256 
-                            %(sorted_bam)s 
-                            -o %(bam_outfile_primary)s 
-                            -U %(bam_outfile_sec)s 
-                            2>> %(log_file)s;
+                            2> %(log_file)s;
     '''
  
     P.run(statement)
      
-    # Now see the mapped pairs and PCR duplicates in each of the 3 files
+    # Now see the mapped pairs and PCR duplicates in each of the 3 sets
     primary_stats_file = P.snip(outfile, ".tsv") + "_primary.tsv"
     secondary_stats_file = P.snip(outfile, ".tsv") + "_secondary.tsv"
       
-    # Where only primary alignments exist (1 read = 1 alignment) 
-    pipelineAtacseq.getUniquelyMappedPairsNoMultimapping(bam_outfile_primary, 
-                                                  primary_stats_file, 
-                                                  submit=True, 
-                                                  job_memory="4G")
-    
-    # Where multiple alignments can exist (primary + secondary)
-    pipelineAtacseq.getCorrectReadPairs(sorted_bam,
-                                        outfile, 
-                                        submit=True,
-                                        job_memory="4G")
-      
-    # Where multiple alignments can exist (secondary)
-    pipelineAtacseq.getCorrectReadPairs(bam_outfile_sec,
-                                        secondary_stats_file, 
-                                        submit=True,
-                                        job_memory="4G")
+    # Primary alignments only (1 read = 1 alignment), primary + secondary
+    # and secondary only, all filled in the same pass
+    pipelineAtacseq.getPostDuplicationStatsSinglePass(sorted_bam,
+                                                      primary_stats_file,
+                                                      outfile,
+                                                      secondary_stats_file,
+                                                      threads=PARAMS["stats_threads"],
+                                                      submit=True,
+                                                      job_memory="4G",
+                                                      job_threads=PARAMS["stats_threads"])
+    
+    # Remove the temporal file
+    statement = '''rm %(sorted_bam)s; 
+    '''
+    
+    P.run(statement)
 
 
 #------------------------------------------------------------------------------
+# The read name sorted BAM is only created if specified
 @subdivide(markDuplicates,
            regex("(.+)/(.+).bam"),
-           [(r"\1/\2_pos_sorted.bam"), 
-            (r"\1/\2_read_name_sorted.bam")],
+           [(r"\1/\2_pos_sorted.bam"),
+            (r"\1/\2_pos_sorted.bam.bai"),
+            (r"\1/\2_pos_sorted.flagstats")] + 
+           ([(r"\1/\2_read_name_sorted.bam")] 
+            if PARAMS.get("filtering_name_sorted_bam") else []),
             r"\1/\2")
 def deduplicate(infile, outfiles, sample):
-    '''Remove duplicates, create final name sorted BAM. Assumes a starting position sorted BAM'''
+    '''Remove duplicates, create final position sorted BAM (and name sorted BAM
+    if specified). Assumes a starting position sorted BAM.
+    In the same pass, the index and flagstats of the position sorted BAM 
+    (<sample>_pos_sorted.bam.bai and <sample>_pos_sorted.flagstats) are 
+    created for index'''
+    
+    # Get all the outfiles
+    position_sorted_bam, position_sorted_bam_index, flagstats_file = outfiles[:3]
     
-    # Get both outfiles
-    position_sorted_bam = outfiles[0]
-    read_name_sorted_bam = outfiles[1]
+    if len(outfiles) > 3:
+        read_name_sorted_bam = outfiles[3]
+    else:
+        read_name_sorted_bam = None
     
     log_file = sample + ".log"
     
@@ -428,31 +322,32 @@ def deduplicate(infile, outfiles, sample):
     # Temp file: We create a temp file to make sure the whole process goes well
     # before the actual outfile is created
     temp_file_pos_sorted_bam = P.snip(position_sorted_bam, ".bam") + "_temp.bam"
-      
-    # Samtools creates temporary files with a certain prefix
-    samtools_pos_sorted_temp_file = (tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
     
-    temp_file_name_sorted_bam = P.snip(read_name_sorted_bam, ".bam") + "_temp.bam"
-      
-    # Samtools creates temporary files with a certain prefix
-    samtools_name_sorted_temp_file = (tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
+    temp_flagstats_file = P.snip(flagstats_file, ".flagstats") + "_temp.flagstats"
     
-    statement = '''samtools view -F 1804 
-                                 -f 2 
-                                 -b %(infile)s 
-                                 -o %(temp_file_pos_sorted_bam)s 
-                                 2> %(log_file)s &&
-        
-                    samtools sort -n %(temp_file_pos_sorted_bam)s 
-                                 -o %(temp_file_name_sorted_bam)s 
-                                 -T %(samtools_name_sorted_temp_file)s 
-                                 2>> %(log_file)s &&
+    if read_name_sorted_bam is not None:
+        temp_file_name_sorted_bam = P.snip(read_name_sorted_bam, ".bam") + "_temp.bam"
+    else:
+        temp_file_name_sorted_bam = None
     
-                   mv %(temp_file_pos_sorted_bam)s %(position_sorted_bam)s &&
+    pipelineAtacseq.fanOutDeduplicated(infile,
+                                       temp_file_pos_sorted_bam,
+                                       temp_flagstats_file,
+                                       name_sorted_bam=temp_file_name_sorted_bam,
+                                       threads=PARAMS["filtering_threads"],
+                                       tmp_dir=tmp_dir,
+                                       log_file=log_file,
+                                       submit=True,
+                                       job_memory="4G",
+                                       job_threads=PARAMS["filtering_threads"])
     
-                   mv %(temp_file_name_sorted_bam)s %(read_name_sorted_bam)s; 
+    statement = '''mv %(temp_file_pos_sorted_bam)s %(position_sorted_bam)s &&
+                   mv %(temp_file_pos_sorted_bam)s.bai %(position_sorted_bam_index)s &&
+                   mv %(temp_flagstats_file)s %(flagstats_file)s'''
     
-    '''
+    if read_name_sorted_bam is not None:
+        statement += ''' &&
+                   mv %(temp_file_name_sorted_bam)s %(read_name_sorted_bam)s'''
     
     P.run(statement)
 
@@ -463,164 +358,106 @@ def deduplicate(infile, outfiles, sample):
            regex(".+/(.+).bam"),
            r"library_complexity.dir/\1.pbc.qc")
 def calculateLibrarycomplexity(infile, outfile):
-    '''Calculates library complexity'''
+    '''Calculates library complexity. The fragments (read pairs) are counted 
+    straight from the coordinate sorted bam file, the number of distinct 
+    fragments seen each number of times is also written 
+    (library_complexity.dir/<sample>.pbc.hist)'''
       
     # outfile temp file to ensure complete execution before writing outfile
     temp_outfile = P.snip(outfile, ".pbc.qc") + "_temp.pbc.qc"
     
-    # outfile temp file to ensure complete execution before writing outfile
-    temp_header_outfile = P.snip(outfile, ".pbc.qc") + ".header"
-      
-    # Get the temporal dir specified
-    tmp_dir = PARAMS["general_temporal_dir"]
-      
-    # Samtools creates temporary files with a certain prefix
-    samtools_name_sorted_temp_file = (
-        tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
-      
-    temp_file_name_sorted_bam = P.snip(infile, ".bam") + "_temp.bam"
-      
-    log_file = P.snip(outfile, ".pbc.qc") + ".log"
-      
-      
-    # 1) Turns the read name sorted file to bed with both mapped segments in the pair
-    # 2) Gets the fields:
+    histogram_file = P.snip(outfile, ".pbc.qc") + ".pbc.hist"
+    
+    # Counts each fragment: 
     #    -beginning of the most upstream segment
     #    -end of most downstream segment
     #    -mapping strand of each segment.
-    # 3) Removes the mitochondrial chromosome regions
-    # 4) Sees any repeated regions from 2), counting the times each region appears.
-    # 5) Performs calculations for distinct reads, total reads and ratios.
-    # 6) Creates a header file and appends the figures calculated
-    header_file = "TotalReadPairs\\tDistinctReadPairs\\tOneReadPair\\tTwoReadPairs\\tNRF=Distinct/Total\\tPBC1=OnePair/Distinct\\tPBC2=OnePair/TwoPair" 
-    statement = '''samtools sort -n %(infile)s 
-                                 -o %(temp_file_name_sorted_bam)s 
-                                 -T %(samtools_name_sorted_temp_file)s 
-                                 2>> %(log_file)s &&
-          
-                    bedtools bamtobed -bedpe -i %(temp_file_name_sorted_bam)s
-                    | awk 'BEGIN{OFS="\\t"} 
-                           (($1==$4) && ($2==$5) && ($3==$6))
-                           {$9="+";$10="-"} 
-                           {print $0}' 
-                    | awk 'BEGIN{OFS="\\t"}{print $1,$2,$4,$6,$9,$10}'
-                    | grep -v 'chrM' 
-                    | sort 
-                    | uniq -c 
-                    | awk 'BEGIN{mt=0;m0=0;m1=0;m2=0} 
-                           ($1==1)
-                           {m1=m1+1} 
-                           ($1==2){m2=m2+1} 
-                           {m0=m0+1} 
-                           {mt=mt+$1} 
-                           END{printf "%%d\\t%%d\\t%%d\\t%%d\\t%%f\\t%%f\\t%%f\\n",mt,m0,m1,m2,m0/mt,m1/m0,m1/m2}' 
-                           > %(temp_outfile)s &&
-       
-                    rm %(temp_file_name_sorted_bam)s %(samtools_name_sorted_temp_file)s* &&
-                    echo -e '%(header_file)s' > %(temp_header_outfile)s &&      
-                    cat %(temp_outfile)s >> %(temp_header_outfile)s &&
-                    rm %(temp_outfile)s &&      
-                    mv %(temp_header_outfile)s %(outfile)s;
-      
-    '''
+    # Removing the mitochondrial chromosome regions, then performs 
+    # calculations for distinct reads, total reads and ratios.
+    pipelineAtacseq.calculateLibraryComplexity(infile,
+                                               temp_outfile,
+                                               histogram_file,
+                                               excluded_contigs="chrM",
+                                               threads=PARAMS["stats_threads"],
+                                               submit=True,
+                                               job_memory="4G",
+                                               job_threads=PARAMS["stats_threads"])
+    
+    statement = '''mv %(temp_outfile)s %(outfile)s'''
   
     P.run(statement)
 
 
 #------------------------------------------------------------------------------
-@follows(mkdir("flagstats.dir"), deduplicate)
+@follows(mkdir("flagstats.dir"))
 @transform(deduplicate,
-           formatter(".+/(?P<SAMPLE>.+)_pos_sorted\.bam"),
+           formatter(".+/(?P<SAMPLE>.+)_pos_sorted\.flagstats$"),
+           add_inputs("{path[0]}/{SAMPLE[0]}_pos_sorted.bam.bai"),
            "flagstats.dir/{SAMPLE[0]}.flagstats")
-def index(infile, outfile):    
-    '''Index final position sorted BAM, get flag stats.'''
+def index(infiles, outfile):    
+    '''Index final position sorted BAM, get flag stats. Both are created by
+    deduplicate (the index next to the BAM), the flag stats are copied here.'''
     
-    log_file = P.snip(outfile, ".flagstats") + ".log"
+    flagstats_file = infiles[0]
     
-    # Temp file: We create a temp file to make sure the whole process goes well
-    # before the actual outfile is created
-    temp_file = P.snip(outfile, ".flagstats") + "_temp.flagstats"
-      
-    
-    # Index Final BAM file
-    statement = '''samtools index %(infile)s 2> %(log_file)s &&
-                   samtools flagstat %(infile)s > %(temp_file)s &&    
-                   mv %(temp_file)s %(outfile)s;
-    
-    '''
-    
-    P.run(statement)    
-    
-    
-#------------------------------------------------------------------------------   
-@follows(mkdir("tag_align.dir"), index, deduplicate)
-@transform(deduplicate,
-           formatter(".+/(?P<SAMPLE>.+)_pos_sorted\.bam"),
-           "tag_align.dir/{SAMPLE[0]}.PE2SE.tagAlign.gz")
-def createTagAlign(infile, outfile):
-    '''creates tagAlign file (virtual single end) with (BED 3+3 format)'''
-    
-    log_file = P.snip(outfile, ".PE2SE.tagAlign.gz") + ".log"
-    
-    # Temp file: We create a temp file to make sure the whole process goes well
-    # before the actual outfile is created
-    temp_file = P.snip(outfile, ".PE2SE.tagAlign.gz") + "_temp.PE2SE.tagAlign.gz"
-    
-    # Create virtual SE file containing both read pairs
-    statement = '''bedtools bamtobed -i %(infile)s | 
-    awk 'BEGIN{OFS="\\t"}{$4="N";$5="1000";print $0}' | 
-    gzip -c > %(temp_file)s 2> %(log_file)s &&
-        
-    mv %(temp_file)s %(outfile)s;
-    '''
+    statement = '''cp %(flagstats_file)s %(outfile)s'''
     
     P.run(statement)
-
-
-#------------------------------------------------------------------
-@follows(mkdir("final_tag_align.dir"), index)
-@transform(createTagAlign,
-           regex(".+/(.+?).PE2SE.tagAlign.gz"),
-           r"final_tag_align.dir/\1.PE2SE.tagAlign.gz")    
-def excludeUnwantedContigsPE2SE(infile, outfile):
-    '''Exclude the contigs indicated, performs partial matching for each'''
     
-    excluded_chrs = PARAMS["filtering_contigs_to_remove"]
+    
+#------------------------------------------------------------------------------
+@follows(mkdir("exclusion_index.dir"))
+@merge(PARAMS["filtering_bed_exclusions"],
+       "exclusion_index.dir/bed_exclusions.npz")
+def buildExclusionIndex(infiles, outfile):
+    '''Merges the regions of low mappability and excessive mappability into 
+    an index used to filter them out (see pipelineAtacseq.ExclusionIndex)'''
     
     # Temp file: We create a temp file to make sure the whole process goes well
     # before the actual outfile is created
-    temp_file = P.snip(outfile, ".PE2SE.tagAlign.gz") + "_temp.PE2SE.tagAlign.gz"
+    temp_file = P.snip(outfile, ".npz") + "_temp.npz"
     
-    statement = pipelineAtacseq.createExcludingChrFromBedStatement(infile, 
-                                                                   excluded_chrs,
-                                                                   temp_file)
+    pipelineAtacseq.ExclusionIndex.build(infiles, temp_file)
     
-    statement += '''&&
-                    mv %(temp_file)s %(outfile)s'''
+    statement = '''mv %(temp_file)s %(outfile)s'''
     
     P.run(statement)
 
 
-#----------------------------------------------------------------------
-@follows(mkdir("final_tag_align.dir"))
-@transform(excludeUnwantedContigsPE2SE,
-           regex(".+/(.+?).PE2SE.tagAlign.gz"),
-           r"final_tag_align.dir/\1.PE2SE.tn5_shifted.tagAlign.gz")
-def shiftTagAlign(infile, outfile):
-    '''Shifts tag aligns by the TN5 sites and any 5' trimming from qc'''
-    
-    # Eliminate .PE2SE.tn5_shifted.tagAlign.gz from the sample name
-    sample_name = re.sub('\.PE2SE\.tagAlign\.gz$', '', os.path.basename(infile))
-    
-    # Get samples details table
-    sample_details = PARAMS["samples_details_table"]
+#------------------------------------------------------------------------------
+# The virtual single ends (tag_align.dir/*.PE2SE.tagAlign.gz) and the single
+# ends without the excluded contigs (final_tag_align.dir/*.PE2SE.tagAlign.gz)
+# are only created if specified
+@follows(mkdir("tag_align.dir"), 
+         mkdir("final_tag_align.dir"),
+         mkdir("filtered_tag_align.dir"), 
+         index)
+@transform(deduplicate,
+           formatter(".+/(?P<SAMPLE>(?!pooled_[control|treatment]).+)_pos_sorted\.bam$"),
+           add_inputs(buildExclusionIndex),
+           ["filtered_tag_align.dir/{SAMPLE[0]}.single.end.shifted.filtered.tagAlign.gz",
+            "final_tag_align.dir/{SAMPLE[0]}.PE2SE.tn5_shifted.tagAlign.gz"] +
+           (["tag_align.dir/{SAMPLE[0]}.PE2SE.tagAlign.gz",
+             "final_tag_align.dir/{SAMPLE[0]}.PE2SE.tagAlign.gz"]
+            if PARAMS.get("filtering_tag_align_intermediates") else []),
+           "{SAMPLE[0]}")
+def filterShiftTagAlign(infiles, outfiles, sample_name):
+    '''Creates the single ends (virtual single end tagAlign, BED 3+3) from the
+    final position sorted BAM, excludes the unwanted contigs, shifts them by 
+    the TN5 sites and any 5' trimming from qc, corrects the chromosome edges
+    and filters out regions of low mappability and excessive mappability. 
+    All in one pass, it also writes the shifted single ends before filtering 
+    the regions (second outfile, <sample>.PE2SE.tn5_shifted.tagAlign.gz)'''
+    
+    infile, exclusion_index = infiles
+    
+    outfile, shifted_file = outfiles[:2]
     
     # Get trimmings in the 5' ends done previously (for example in qc).
-    five_prime_trim = 0 # pipelineAtacseq.getSampleQCShift(sample_name, sample_details)
-    
-    integer_five_prime_correction = 0
+    # Not used: pipelineAtacseq.getSampleQCShift(sample_name, 
+    # PARAMS["samples_details_table"])
+    five_prime_trim = 0
     
-    # To avoid putting "--"
     # Correction is going to be -correction on the start of the + strand
     # Correction is going to be +correction on the end of the - strand
     try:
@@ -628,112 +465,70 @@ def shiftTagAlign(infile, outfile):
     except ValueError:   
         raise Exception("Five prime trimming argument needs to be an integer.") 
     
-    # String with the correction to apply (Eg. "- 2", "+ 5")
-    positive_strand_correction = ""
-    negative_strand_correction = ""
-    
-    if integer_five_prime_correction < 0:
-        positive_strand_correction = "+ "+str(abs(integer_five_prime_correction))
-        negative_strand_correction = "- "+str(abs(integer_five_prime_correction))
-    elif integer_five_prime_correction > 0:
-        positive_strand_correction = "- "+str(abs(integer_five_prime_correction))
-        negative_strand_correction = "+ "+str(abs(integer_five_prime_correction))
-    
-    # 0 Case: no correction, empty string
-    
-    # Get the contigs
-    contigs = PARAMS["contigs"]
-    log_file = P.snip(outfile, ".PE2SE.tn5_shifted.tagAlign.gz") + ".tn5_shifted.log"
-    
-    # Temp file: We create a temp file to make sure the whole process goes well
-    # before the actual outfile is created
-    temp_file = P.snip(outfile, ".PE2SE.tn5_shifted.tagAlign.gz") + "_temp.tn5_shifted.tagAlign.gz"
-    
-    # Shift the beginning of the elements in the + strand (where the enzume cuts) by +4
-    # Shift the end of the elements in the - strand (where the enzume cuts) by -5
-    # Apply qc corrections too.
-    statement = '''zcat %(infile)s 
-                   | awk -F $'\\t' 
-                     'BEGIN {OFS = FS}
-                     { if ($6 == "+") {
-                         $2 = $2 + 4 %(positive_strand_correction)s
-                       } else if ($6 == "-") {
-                         $3 = $3 - 5 %(negative_strand_correction)s
-                       } 
-                       print $0}'
-                   | gzip -c 
-                   > %(temp_file)s 
-                   2> %(log_file)s; 
-    '''
-        
-    P.run(statement)
-    
-    log_file_correction = P.snip(outfile, ".PE2SE.tn5_shifted.tagAlign.gz") + \
-                           ".tn5_shifted_slop_correction.log"
-    
-    # Temp file: We create a temp file to make sure the whole process goes well
-    # before the actual outfile is created
-    temp_file2 = P.snip(outfile, ".PE2SE.tn5_shifted.tagAlign.gz") + "_temp_correction.tn5_shifted.tagAlign.gz"
-    
-    # Check that the slop does not surpass the chromosome edges and that the starts are < than ends
-    pipelineAtacseq.correctSlopChromosomeEdges(temp_file, 
-                                                contigs,
-                                                temp_file2,
-                                                log_file_correction,
-                                                submit=True,
-                                                job_memory="4G")
-    
-    # Remove the temp file
-    statement = ''' rm %(temp_file)s &&
-    mv %(temp_file2)s %(outfile)s '''
+    log_file = P.snip(outfile, ".gz") + ".log"
+    
+    # Temp files: We create temp files to make sure the whole process goes 
+    # well before the actual outfiles are created
+    temp_files = [P.snip(f, ".tagAlign.gz") + "_temp.tagAlign.gz" 
+                  for f in outfiles]
+    
+    if len(outfiles) > 2:
+        temp_tag_align_file, temp_contig_filtered_file = temp_files[2:]
+    else:
+        temp_tag_align_file = None
+        temp_contig_filtered_file = None
+    
+    pipelineAtacseq.processTagAlign(infile,
+                                    temp_files[0],
+                                    PARAMS["contigs"],
+                                    excluded_chrs=PARAMS["filtering_contigs_to_remove"],
+                                    exclusion_index=exclusion_index,
+                                    five_prime_correction=integer_five_prime_correction,
+                                    shifted_outfile=temp_files[1],
+                                    log_file=log_file,
+                                    tagalign_outfile=temp_tag_align_file,
+                                    contig_filtered_outfile=temp_contig_filtered_file,
+                                    threads=PARAMS["filtering_threads"],
+                                    submit=True,
+                                    job_memory="4G",
+                                    job_threads=PARAMS["filtering_threads"])
+    
+    # The manifests (see pipelineAtacseq.ManifestWriter) are moved too
+    statement = " && ".join('''mv %(temp_file)s %(final_file)s &&
+                   mv %(temp_file)s.manifest.json %(final_file)s.manifest.json''' 
+                            % {"temp_file": temp_file, "final_file": final_file}
+                            for temp_file, final_file in zip(temp_files, outfiles))
     
     P.run(statement)
 
 
-#------------------------------------------------------------------------------
-@follows(mkdir("filtered_tag_align.dir"))
-@transform(shiftTagAlign,
-           formatter(".+\.dir/(?P<SAMPLE>(?!pooled_[control|treatment]).+)\.PE2SE\.tn5_shifted\.tagAlign\.gz"),
-           "filtered_tag_align.dir/{SAMPLE[0]}.single.end.shifted.filtered.tagAlign.gz")
-def filterShiftTagAlign(infile, outfile):
-    ''' Filters out regions of low mappability and excessive mappability in the shifted single ends'''
-    
-    temp_file = P.snip(outfile, ".gz") + "_temp.gz"
-    
-    excluded_beds = PARAMS["filtering_bed_exclusions"]
-    
-    statement = pipelineAtacseq.createExcludingBedsFromBedStatement(infile, 
-                                                                    excluded_beds, 
-                                                                    temp_file)
-    
-    statement += ''' && mv %(temp_file)s %(outfile)s'''
-
-    P.run(statement)
-
-
 #--------------------------------------------------------------------------------------
 @follows(mkdir("filtered_tag_align_count_balanced.dir"))
-@transform(filterShiftTagAlign,
-           regex("filtered_tag_align.dir/(.+).single.end.shifted.filtered.tagAlign.gz"),
-           r"filtered_tag_align_count_balanced.dir/\1.tsv",
-           r"\1")
-def calculateNumberOfSingleEnds(infile, outfile, sample):
-    '''Get the number of single end reads entering the peak calling'''
+@merge(filterShiftTagAlign, "filtered_tag_align_count_balanced.dir/reads_per_sample.csv")
+def mergeSingleEndsCount(infiles, outfile):
+    ''' Get the number of single end reads entering the peak calling of each 
+    sample into a single table. The numbers are taken from the manifests of 
+    the tagAlign files (see pipelineAtacseq.ManifestWriter) '''
+    
+    # Temp file: We create a temp file to make sure the whole process goes well
+    # before the actual outfile is created
+    temp_file = P.snip(outfile, ".csv") + "_temp.csv"
+    
+    with IOTools.open_file(temp_file, "w") as writer:
+        
+        writer.write("sample,n_se\n")
         
-    statement = '''echo %(sample)s,`zcat %(infile)s | wc -l` > %(outfile)s
-                    '''
+        # The filtered single ends are the first outfile of filterShiftTagAlign
+        for infile in [filter_shift_outfiles[0] for filter_shift_outfiles in infiles]:
+            
+            sample = P.snip(os.path.basename(infile), 
+                            ".single.end.shifted.filtered.tagAlign.gz")
+            
+            writer.write("%s,%i\n" % (sample, 
+                                       pipelineAtacseq.countRecords(infile)))
+    
+    statement = '''mv %(temp_file)s %(outfile)s'''
     
-    P.run(statement)
-
-
-#----------------------------------------------------------------------------------------
-@merge(calculateNumberOfSingleEnds, "filtered_tag_align_count_balanced.dir/reads_per_sample.csv")
-def mergeSingleEndsCount(infiles, outfile):
-    ''' Merge together all the SE counts into a single table '''
-
-    infiles = " ".join(infiles)
-    statement = ''' echo sample,n_se > %(outfile)s &&
-                    cat %(infiles)s >> %(outfile)s '''
     P.run(statement)
 
 
@@ -758,12 +553,12 @@ def get_balanced_sample_filtered_shifted_SE(infiles, outfiles, sample_name):
     number of reads: the minimum sample single ends. Returns a file with the same sorting
     as the input'''
     
-    # Get the temporal dir specified
-    tmp_dir = PARAMS["general_temporal_dir"]
-    
-    # Separate the infiles
+    # Separate the infiles, the filtered single ends are the first outfile of
+    # filterShiftTagAlign
     bed_tags, read_count_file, sample_info = infiles
     
+    bed_tags = bed_tags[0]
+    
     sample_info = pandas.read_csv(sample_info, sep="\t")
     read_counts = pandas.read_csv(read_count_file, sep=",")
 
@@ -780,25 +575,31 @@ def get_balanced_sample_filtered_shifted_SE(infiles, outfiles, sample_name):
     output_reads = sample_info[sample_info["MM.ND"].isin(["MM","ND"])].n_se.min()
     if sample_name in ["A26.20", "A26.18"]:
         output_reads=output_reads/2
-           
-    # Extract the file and generate the sample
-    statement_template = '''zcat %(bed_tags)s > %(temp_extract_bed)s &&
-                    
-                    sample -o --preserve-order -d 51 -k %(output_reads)s %(temp_extract_bed)s | gzip > %(outfile)s &&
-                    
-                    rm %(temp_extract_bed)s 
-                    
-                    '''
     
-    statements = [] 
-
-    for outfile in outfiles:
-        temp_extract_bed = (tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
-
-        statements.append(statement_template % locals())
-
-    # Samples with number of single ends > 100M
-    job_memory = "8G"
+    # Temp files: We create temp files to make sure the whole process goes 
+    # well before the actual outfiles are created
+    temp_files = [P.snip(outfile, ".gz") + "_temp.gz" for outfile in outfiles]
+    
+    # All the samples are generated in a single pass through the file, with
+    # the same seed as before (sample -d 51). They are written as BGZF to be
+    # pooled without recompressing them
+    pipelineAtacseq.downsampleTagAlign(bed_tags,
+                                       temp_files,
+                                       [int(output_reads)] * len(outfiles),
+                                       seed=51,
+                                       threads=PARAMS["filtering_threads"],
+                                       submit=True,
+                                       job_memory="2G",
+                                       job_threads=PARAMS["filtering_threads"])
+    
+    statements = []
+    
+    # The manifests (see pipelineAtacseq.ManifestWriter) are moved too
+    for temp_file, outfile in zip(temp_files, outfiles):
+        
+        statements.append('''mv %(temp_file)s %(outfile)s &&
+                             mv %(temp_file)s.manifest.json %(outfile)s.manifest.json''' 
+                          % locals())
     
     P.run(statements)
 
@@ -839,8 +640,23 @@ def pool_balanced_single_ends(infiles, outfile):
     '''Pool the downsampled balanced single-end aligned tags for subgroup
     and also for MM and ND'''
 
-    infiles = " ".join(infiles)
-    statement = '''zcat %(infiles)s | gzip > %(outfile)s'''
+    # Temp file: We create a temp file to make sure the whole process goes well
+    # before the actual outfile is created
+    temp_file = P.snip(outfile, ".gz") + "_temp.gz"
+    
+    # The BGZF balanced samples are concatenated without recompressing them, 
+    # unless a sorted pool is specified
+    pipelineAtacseq.poolTagAligns(infiles,
+                                  temp_file,
+                                  sort=bool(PARAMS.get("pooling_sorted", 0)),
+                                  submit=True,
+                                  job_memory="2G")
+    
+    statement = '''mv %(temp_file)s %(outfile)s &&
+                   if [ -f %(temp_file)s.manifest.json ]; then 
+                       mv %(temp_file)s.manifest.json %(outfile)s.manifest.json; 
+                   fi'''
+    
     P.run(statement)
 
 #----------------------------------------------------------------------------------------
@@ -858,6 +674,10 @@ def call_peaks_broad(infile, outfiles, sample):
     Sorts the output by -log10pvalue,
     formats the name of the broad and gapped peaks '''
     
+    # The filtered single ends are the first outfile of filterShiftTagAlign
+    if not isinstance(infile, str):
+        infile = infile[0]
+    
     # Get the thresholding values for MACS2
     threshold_method = PARAMS["macs2_threshold_method"].lower()
     
@@ -968,6 +788,10 @@ def call_peaks_broad(infile, outfiles, sample):
 def call_peaks_narrow(infile, outfiles, sample):
     ''' Use MACS2 to calculate peaks '''
     
+    # The filtered single ends are the first outfile of filterShiftTagAlign
+    if not isinstance(infile, str):
+        infile = infile[0]
+    
     # Get the thresholding values for MACS2
     threshold_method = PARAMS["macs2_threshold_method"].lower()
     
@@ -1066,42 +890,74 @@ def call_peaks_narrow(infile, outfiles, sample):
 @follows(mkdir("filtered_peaks.dir"))
 @transform([call_peaks_broad, call_peaks_narrow],
            regex(".+/(.+).gz"),
+           add_inputs(buildExclusionIndex),
            r"filtered_peaks.dir/\1.gz")
-def filter_peaks(infile, outfile):
+def filter_peaks(infiles, outfile):
     ''' Filters out regions of low mappability and excessive mappability '''
     
+    infile, exclusion_index = infiles
+    
     # Temp file: We create a temp file to make sure the whole process goes well
     # before the actual outfile is created
     temp_file = P.snip(outfile, ".gz") + "_temp.gz"
     
-    excluded_beds = PARAMS["filtering_bed_exclusions"]
+    pipelineAtacseq.filterExcludedRegions(infile,
+                                          temp_file,
+                                          exclusion_index,
+                                          submit=True,
+                                          job_memory="2G")
     
-    statement = pipelineAtacseq.createExcludingBedsFromBedStatement(infile, 
-                                                                    excluded_beds, 
-                                                                    temp_file)
-    
-    statement += ''' &&
-                    mv %(temp_file)s %(outfile)s'''
+    statement = '''mv %(temp_file)s %(outfile)s &&
+                   mv %(temp_file)s.manifest.json %(outfile)s.manifest.json'''
 
     P.run(statement)
 #----------------------------------------------------------------------------------------
 
+def merge_peak_files(infiles, outfile, labels):
+    '''Merge the peaks of the infiles less than macs2 merge_distance (200 by
+    default) nt away from another peak, recording which infiles (labels) have
+    peaks in each merged peak (see pipelineAtacseq.mergePeaks)'''
+    
+    distance = PARAMS.get("macs2_merge_distance", "")
+    
+    # If nothing specified default to 200
+    if distance == "":
+        distance = 200
+    
+    # Temp file: We create a temp file to make sure the whole process goes well
+    # before the actual outfile is created
+    temp_file = P.snip(outfile, ".gz") + "_temp.gz"
+    
+    pipelineAtacseq.mergePeaks(infiles,
+                               temp_file,
+                               distance=int(distance),
+                               labels=labels,
+                               submit=True,
+                               job_memory="4G")
+    
+    temp_sources_file = pipelineAtacseq.getSourcesFile(temp_file)
+    
+    sources_file = pipelineAtacseq.getSourcesFile(outfile)
+    
+    statement = '''mv %(temp_file)s %(outfile)s &&
+                   mv %(temp_file)s.manifest.json %(outfile)s.manifest.json &&
+                   mv %(temp_sources_file)s %(sources_file)s'''
+    
+    P.run(statement)
+
+
 @collate(filter_peaks,
         regex(".+/(.+).(broadPeak|narrowPeak).gz"),
         r"filtered_peaks.dir/\1.mergedpeaks.gz")
 def merge_broad_narrow_peaks(infiles, outfile):
     '''Merge the broad and narrow peak files for each sample, merging any peaks less than
-    100 nt away from another peak'''
-
-    infiles = " ".join(infiles)
-    statement = '''zcat %(infiles)s
-                   | sort -k1,1 -k2,2n 
-                   | awk 'FS="\\t" {printf ("%%s\\t%%s\\t%%s\\t%%s\\n", $1, $2, $3, $6)'} 
-                   | bedtools merge -i stdin -d 200
-                   | sort -k1,1 -k2,2n 
-                   | gzip -c > %(outfile)s '''
-
-    P.run(statement)
+    200 nt away from another peak'''
+    
+    # The input sets are the peak types
+    labels = [re.match(".+/(.+).(broadPeak|narrowPeak).gz", infile).group(2)
+              for infile in infiles]
+    
+    merge_peak_files(infiles, outfile, labels)
 
 
 @collate(merge_broad_narrow_peaks,
@@ -1110,16 +966,12 @@ def merge_broad_narrow_peaks(infiles, outfile):
 def merge_pooled_peaks(infiles, outfile):
     '''Merge MM and ND peaks to get pan merged peaks, and the peaks for each subtype to get
     balanced subtype peaks'''
-
-    infiles = " ".join(infiles)
-    statement = '''zcat %(infiles)s
-                   | sort -k1,1 -k2,2n 
-                   | awk 'FS="\\t" {printf ("%%s\\t%%s\\t%%s\\t%%s\\n", $1, $2, $3, $6)'} 
-                   | bedtools merge -i stdin -d 200
-                   | sort -k1,1 -k2,2n 
-                   | gzip -c > %(outfile)s '''
-
-    P.run(statement)
+    
+    # The input sets are the pools (MM/ND or subtype)
+    labels = [re.match(".+/(.+)_pooled_(.+)_peaks.mergedpeaks.gz", infile).group(1)
+              for infile in infiles]
+    
+    merge_peak_files(infiles, outfile, labels)
 
 
 @follows(merge_pooled_peaks,
@@ -1132,127 +984,184 @@ def call_peaks():
 ##########################################################################################
 # Peak Quantitation
 ##########################################################################################
-@transform(shiftTagAlign,
-           regex(".+\.dir/(.+).PE2SE.tn5_shifted.tagAlign.gz"),
+@transform(filterShiftTagAlign,
+           regex("filtered_tag_align.dir/(.+).single.end.shifted.filtered.tagAlign.gz"),
            r"final_tag_align.dir/\1.five.prime.only.single.end.processed.tagAlign.gz")
-def get_five_prime_only_single_ends(infile, outfile):
+def get_five_prime_only_single_ends(infiles, outfile):
     ''' It creates a 1bp region for each shifted SE with the 5' end only (strand-aware).
-    Sorts the output '''
+    Sorts the output. The shifted SEs are already sorted by start, so they
+    are reordered in a single pass instead of sorting the file '''
+    
+    # The shifted single ends before filtering the regions are the second
+    # outfile of filterShiftTagAlign
+    infile = infiles[1]
     
     # Get the temporal dir specified
     tmp_dir = PARAMS["general_temporal_dir"]
     
     # To make sure the run is complete before copying the result to the outfile
-    outfile_temp = (tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
+    outfile_temp = P.snip(outfile, ".gz") + "_temp.gz"
     
+    pipelineAtacseq.getFivePrimeEnds(infile,
+                                     outfile_temp,
+                                     tmp_dir=tmp_dir,
+                                     threads=PARAMS["filtering_threads"],
+                                     submit=True,
+                                     job_memory="2G",
+                                     job_threads=PARAMS["filtering_threads"])
     
-    
-    # Gets a 1bp region with the 5' end (strand-aware) and sorts the tagAlignFile
-    statement = '''zcat %(infile)s 
-                   | awk 'BEGIN {
-                            FS ="\\t"; OFS = FS
-                          } 
-
-                          { if ($6 == "+") {
-                                $3 = $2+1
-                          } else if ($6 == "-") {
-                                $2 = $3-1
-                          } 
-                          print $0}'
-                   | sort -k 1,1 -k2,2n 
-                   | gzip -c > %(outfile_temp)s  &&
-    
-                   mv %(outfile_temp)s %(outfile)s
-    '''
+    statement = '''mv %(outfile_temp)s %(outfile)s &&
+                   mv %(outfile_temp)s.manifest.json %(outfile)s.manifest.json'''
     
     P.run(statement)
 
 
 @transform(get_five_prime_only_single_ends,
            regex(".+\.dir/(.+).five.prime.only.single.end.processed.tagAlign.gz"),
+           add_inputs(buildExclusionIndex),
            r"filtered_tag_align.dir/\1.five.prime.only.single.end.processed.filtered.tagAlign.gz")
-def filter_five_prime_only_single_ends(infile, outfile):
+def filter_five_prime_only_single_ends(infiles, outfile):
     ''' Filters out regions of low mappability and excessive mappability in the 1bp five prime single ends'''
     
     # Reuse the filter_peaks function
-    filter_peaks(infile, outfile)
+    filter_peaks(infiles, outfile)
 
 
 #------------------------------------------------------------------------------
-@follows(mkdir("tag_counts.fir"))
-@product(filter_five_prime_only_single_ends,
-         formatter(".+\.dir/(?P<SAMPLE>.+).five.prime.only.single.end.processed.filtered.tagAlign.gz"),
-         merge_pooled_peaks,
-         formatter(".+/(?P<PEAKS>.+)_merged_peaks.bed.gz"),
-         "tag_counts.dir/{SAMPLE[0][0]}_vs_{PEAKS[1][0]}.tag_counts.gz")
-def overlap_sample_with_common_peaks(infiles, outfile):
+@follows(mkdir("cut_site_index.dir"))
+@transform(filter_five_prime_only_single_ends,
+           regex(".+\.dir/(.+).five.prime.only.single.end.processed.filtered.tagAlign.gz"),
+           r"cut_site_index.dir/\1.cut_sites")
+def build_cut_site_index(infile, outfile):
+    ''' Stores the filtered 5' 1bp single ends of each sample as a binary index
+    (see pipelineAtacseq.CutSiteIndex), to count them in any regions without
+    reading the tagAlign again '''
+    
+    # To make sure the run is complete before copying the result to the outfile
+    outfile_temp = outfile + "_temp"
+    
+    pipelineAtacseq.buildCutSiteIndex(infile,
+                                      outfile_temp,
+                                      submit=True,
+                                      job_memory="4G")
+    
+    statement = '''rm -rf %(outfile)s &&
+                   mv %(outfile_temp)s %(outfile)s'''
+    
+    P.run(statement)
+
+
+#------------------------------------------------------------------------------
+# Peak sets the samples are counted against (see get_files_for_pooling and
+# merge_pooled_peaks)
+PEAK_SETS = ["pan", "subtype"]
+
+MERGED_PEAK_FILES = ["filtered_peaks.dir/%s_merged_peaks.bed.gz" % peak_set
+                     for peak_set in PEAK_SETS]
+
+# With macs2 freeze_merged_peaks, the merged peak sets which already exist are
+# counted as they are (plain input files instead of merge_pooled_peaks), so 
+# adding samples doesn't call the peaks again: only the new samples are 
+# counted and added to the count matrices
+if PARAMS.get("macs2_freeze_merged_peaks", 0) and \
+   all(os.path.exists(peak_file) for peak_file in MERGED_PEAK_FILES):
+    merged_peak_sets = MERGED_PEAK_FILES
+else:
+    merged_peak_sets = merge_pooled_peaks
+
+
+@follows(mkdir("tag_counts.dir"))
+@subdivide(build_cut_site_index,
+           formatter(".+\.dir/(?P<SAMPLE>.+).cut_sites"),
+           add_inputs(merged_peak_sets),
+           ["tag_counts.dir/{SAMPLE[0]}_vs_%s.tag_counts.gz" % peak_set 
+            for peak_set in PEAK_SETS])
+def overlap_sample_with_common_peaks(infiles, outfiles):
     ''' For each common peak to all the samples, it calculates the number of filtered
     extended 5' 1bp single ends of reads from the sample which fall in that region.
     An overlap is considered valid if all the SE (1bp) is overlapped by a feature
     (common peak). Produces one line for each common peak, regardless of whether
-     there is or not intersection'''
-    extended_tag_align = infiles[0]
-    merged_common_peaks = infiles[1]
-     
-    # Get the temporal dir specified
-    tmp_dir = PARAMS["general_temporal_dir"]
+     there is or not intersection. The cut site index of the sample is loaded
+    once to count it against all the peak sets (<sample>_vs_<peaks>.tag_counts.gz 
+    for each peak set)'''
+    
+    cut_site_index = infiles[0]
+    
+    # The peak sets (merge_pooled_peaks outputs or the frozen peak sets)
+    merged_common_peaks = {}
+    
+    for infile in infiles[1:]:
+        
+        if isinstance(infile, str):
+            infile = [infile]
+        
+        for peaks in infile:
+            peak_set = re.match(".+/(.+)_merged_peaks.bed.gz", peaks).group(1)
+            merged_common_peaks[peak_set] = peaks
+    
+    peak_files = [merged_common_peaks[re.match(".+_vs_(.+).tag_counts.gz", 
+                                               outfile).group(1)]
+                  for outfile in outfiles]
+    
+    # To make sure the run is complete before copying the results to the outfiles
+    temp_files = [P.snip(outfile, ".gz") + "_temp.gz" for outfile in outfiles]
+    
+    pipelineAtacseq.countTagsInPeaks(cut_site_index,
+                                     peak_files,
+                                     temp_files,
+                                     submit=True,
+                                     job_memory="4G")
+    
+    statement = " && ".join('''mv %(temp_file)s %(outfile)s &&
+                   mv %(temp_file)s.manifest.json %(outfile)s.manifest.json''' 
+                            % {"temp_file": temp_file, "outfile": outfile}
+                            for temp_file, outfile in zip(temp_files, outfiles))
     
-    # To make sure the run is complete before copying the result to the outfile
-    outfile_temp = (tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)).name
-     
-    # The common_peaks file is already sorted
-    # Intersect and count the number of reads in each common_peak
-    statement = '''bedtools intersect 
-                              -sorted -c 
-                              -a %(merged_common_peaks)s 
-                              -b %(extended_tag_align)s 
-                   | gzip -c > %(outfile_temp)s &&
-                   
-                   mv %(outfile_temp)s %(outfile)s
-    '''
-     
     P.run(statement)
 
 
 #------------------------------------------------------------------------------
 @collate(overlap_sample_with_common_peaks,
          regex(".+/(.+)_vs_(.+).tag_counts.gz"),
-         r"tag_counts.dir/\2_raw_tag_counts.bed_header.gz")
+         r"tag_counts.dir/\2_raw_tag_counts.counts")
 def group_tag_counts_per_peakset(infiles, outfile):
     '''Take the counts of each sample against each peakset and generate a matrix
-    with peak positions and the counts of every sample across that peakset. 
+    with peak positions and the counts of every sample across that peakset,
+    stored as a binary matrix (see pipelineAtacseq.CountMatrixStore). 
     Sample titles will be shortened. Note that they will have no "A" on the
-    start'''
-
-    col_names = " ".join([re.match("tag_counts.dir/(.+).bowtie2_vs_", infile).groups()[0]
-                         for infile in infiles] )
-    infiles = " ".join(infiles)
-
-    statement = '''bedtools unionbedg 
-                             -header
-                             -names %(col_names)s
-                             -i %(infiles)s
-                    | gzip > %(outfile)s'''
+    start. If the matrix exists, only the counts of the new samples are added
+    to it, and it is not modified if nothing changed (see 
+    pipelineAtacseq.updateCountMatrixStore)'''
 
-    P.run(statement)
+    col_names = [re.match("tag_counts.dir/(.+).bowtie2_vs_", infile).groups()[0]
+                 for infile in infiles]
+    
+    pipelineAtacseq.updateCountMatrixStore(infiles,
+                                           col_names,
+                                           outfile,
+                                           submit=True,
+                                           job_memory="4G")
 
 
 #------------------------------------------------------------------------------
 @transform(group_tag_counts_per_peakset,
-           suffix("bed_header.gz"),
-           "tsv.gz")
+           suffix(".counts"),
+           ".tsv.gz")
 def combine_bed_cols_to_id(infile, outfile):
-    '''Currently the peaks are formatted as bed files - first three columns are contig,
-    start and end. These need to be merged into a single column - id - for DE analysis'''
-
-    statement = '''zcat %(infile)s
-                 | awk 'BEGIN{FS="\\t";OFS=FS}
-                        {$1=$1":"$2"-"$3; 
-                         $2=""; $3=""}
-                        {printf("%%s\\n",$0)}'
-                 | cut --complement -f 2,3
-                 | awk 'BEGIN{FS="\\t";OFS=FS} NR==1 {$1="id"} {print $0}'
-                 | gzip > %(outfile)s'''
+    '''Export the count matrix as a table for DE analysis: the peaks (contig, 
+    start and end) are merged into a single column - id - (contig:start-end)
+    followed by the counts of each sample'''
+
+    # Temp file: We create a temp file to make sure the whole process goes well
+    # before the actual outfile is created
+    temp_file = P.snip(outfile, ".tsv.gz") + "_temp.tsv.gz"
+    
+    pipelineAtacseq.exportCountMatrixStore(infile,
+                                           temp_file,
+                                           submit=True,
+                                           job_memory="4G")
+    
+    statement = '''mv %(temp_file)s %(outfile)s'''
 
     P.run(statement)
 